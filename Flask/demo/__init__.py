@@ -13,6 +13,9 @@ import random, string # To generate random strings for Secondary directory names
 
 from six.moves import range
 
+# The demo's target store (see get_target_store()).
+target_store = None
+
 # Values to plug in below as needed.
 LOCAL = 'localhost'
 HOSTING = '0.0.0.0'
@@ -39,6 +42,11 @@ DIRECTOR_REPO_PORT = 30401
 DIRECTOR_REPO_NAME = 'director'
 DIRECTOR_REPO_DIR = os.path.join(uptane.WORKING_DIR, DIRECTOR_REPO_NAME)
 
+# Target files are stored once here and hard-linked into the targets
+# directories of the Image Repository and of each Director vehicle repository.
+# (See uptane/services/target_store.py.)
+TARGET_STORE_DIR = os.path.join(uptane.WORKING_DIR, 'target_store')
+
 DIRECTOR_SERVER_HOST = HOSTING
 DIRECTOR_SERVER_PORT = 30501
 
@@ -55,6 +63,27 @@ PRIMARY_SERVER_DEFAULT_PORT = 30701
 PRIMARY_SERVER_AVAILABLE_PORTS = [
     30701, 30702, 30703, 30704, 30705, 30706, 30707, 30708, 30709, 30710, 30711]
 
+# The number of worker threads with which each of the demo's XML-RPC servers
+# (Director, Image Repository, Timeserver and Primary) handles requests, and
+# the number of requests that may wait for a worker before the server stops
+# accepting connections. If XMLRPC_SERVER_WORKERS is None or 1, each server
+# handles one request at a time. (See demo/xmlrpc_thread_pool.py.)
+XMLRPC_SERVER_WORKERS = 8
+XMLRPC_SERVER_MAX_QUEUED = 64
+
+# The number of threads with which the demo Primary downloads the targets
+# assigned to its Secondaries in each update cycle. (See the download_workers
+# argument to uptane.clients.primary.Primary.) The threads share the Primary's
+# TUF updater, which has not been shown to be safe to download through from
+# several threads at once, so the demo downloads one target at a time.
+PRIMARY_DOWNLOAD_WORKERS = 1
+
+# The largest number of bytes of an image that the demo Primary sends a
+# Secondary in response to a single request. Secondaries retrieve images in
+# chunks of this size, so that neither side holds a whole image in memory.
+# (See get_image_chunk_for_ecu() in demo/demo_primary.py.)
+IMAGE_TRANSFER_CHUNK_SIZE = 256 * 1024
+
 
 
 
@@ -98,6 +127,23 @@ def import_private_key(keyname):
 
 
 
+def get_target_store():
+  """
+  Returns the demo's content-addressed target store, in TARGET_STORE_DIR,
+  creating it if necessary. The Image Repository and Director demo modules
+  add target files to this store and link them into their repositories
+  instead of copying them.
+  """
+  global target_store
+
+  if target_store is None:
+    import uptane.services.target_store
+    target_store = uptane.services.target_store.TargetStore(TARGET_STORE_DIR)
+
+  return target_store
+
+
+
 def get_random_string(length):
   """
   Returns a random alphanumeric string of length length. Not
@@ -180,8 +180,12 @@ def deliver_update(config):
     try :    
         global image_dic
 
-        vin = config['vin']
-        ecu_name = config['ecu_name']
+        # A campaign config lists 'vins' (for their Primary ECUs) and/or
+        # 'ecu_names' instead of a single 'vin' and 'ecu_name'.
+        vin = config.get('vin')
+        ecu_name = config.get('ecu_name')
+        campaign_vins = config.get('vins')
+        campaign_ecu_names = config.get('ecu_names')
         image_name = config['update_image_name']
         print("\nvin = ", vin, "ecu_name = ", ecu_name,"update_image_name = ", image_name)
         print("image_dic: ", image_dic)
@@ -204,8 +208,12 @@ def deliver_update(config):
             print("normal diliver update")
             di.add_target_to_imagerepo(image_path, image_name)
             di.write_to_live()
-            dd.add_target_to_director(image_path, image_name, vin, ecu_name)
-            dd.write_to_live(vin_to_update=vin)
+            if campaign_vins or campaign_ecu_names:
+                dd.assign_image_to_vehicles(image_path, image_name,
+                    vins=campaign_vins, ecu_serials=campaign_ecu_names)
+            else:
+                dd.add_target_to_director(image_path, image_name, vin, ecu_name)
+                dd.write_to_live(vin_to_update=vin)
         elif config['update_type'] == 'man_in_middle':
             dd.mitm_arbitrary_package_attack(vin, 'firmware.img')
         elif config['update_type'] == 'replace':
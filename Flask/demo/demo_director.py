@@ -24,6 +24,7 @@
   XMLRPC interface presented TO THE DEMO WEBSITE:
     add_new_vehicle(vin)
     add_target_to_director(target_filepath, filepath_in_repo, vin, ecu_serial) <--- assign to vehicle
+    assign_image_to_vehicles(image_filepath, filepath_in_repo, vins, ecu_serials) <--- assign to many vehicles and publish
     write_director_repo() <--- move staged to live / add newly added targets to live repo
     get_last_vehicle_manifest(vin)
     get_last_ecu_manifest(ecu_serial)
@@ -35,9 +36,13 @@ from __future__ import unicode_literals
 
 import demo
 import uptane # Import before TUF modules; may change tuf.conf values.
+import uptane.common
 import uptane.services.director as director
 import uptane.services.inventorydb as inventory
 import tuf.formats
+import tuf.roledb
+import tuf.keydb
+import tuf.conf
 import datetime
 
 import uptane.encoding.asn1_codec as asn1_codec
@@ -45,9 +50,15 @@ import uptane.encoding.asn1_codec as asn1_codec
 import threading # for the director services interface
 import os # For paths and symlink
 import shutil # For copying directory trees
-import sys, subprocess, time # For hosting
+import filecmp # For finding unchanged metadata when publishing
+import tempfile
+import time # For timing writes and checking expiration
+import calendar # For checking expiration
+import multiprocessing # For writing repositories in parallel
 import tuf.repository_tool as rt
 import demo.demo_image_repo as demo_image_repo # for the Image repo directory /:
+import demo.xmlrpc_thread_pool as xmlrpc_thread_pool
+import demo.http_repo_server as http_repo_server
 from uptane import GREEN, RED, YELLOW, ENDCOLORS
 
 from six.moves import xmlrpc_server # for the director services interface
@@ -66,9 +77,32 @@ LOG_PREFIX = uptane.TEAL_BG + 'Director:' + ENDCOLORS + ' '
 
 KNOWN_VINS = ['111', '112', '113', 'democar']
 
+# If True, write_to_live() publishes only the vehicle repositories that have
+# changed, hard-linking unchanged metadata files into a new live directory and
+# switching to it with an atomic symlink flip, instead of re-signing and
+# copying all metadata for every repository it is asked to write.
+INCREMENTAL_PUBLISH = True
+
+# When INCREMENTAL_PUBLISH is True, write_to_live() still re-signs and
+# publishes an unchanged repository if its timestamp metadata expires within
+# this many seconds, so that vehicles do not come to see expired metadata.
+TIMESTAMP_REFRESH_MARGIN = 6 * 60 * 60
+
+# The number of worker processes across which write_to_live() shards the
+# vehicle repositories when writing all of them. If None or 1, repositories are
+# written one at a time in this process.
+PUBLISH_WORKERS = None
+
+# The methods of the Director's XML-RPC interface (see listen()) that may be
+# handled concurrently. These only validate and record manifests and ECU
+# registrations in the inventory db, which is safe for concurrent use.
+DIRECTOR_CONCURRENT_METHODS = [
+    'submit_vehicle_manifest', 'register_ecu_serial',
+    'get_last_vehicle_manifest', 'get_last_ecu_manifest']
+
 # Dynamic global objects
 #repo = None
-repo_server_process = None
+repo_server = None
 director_service_instance = None
 director_service_thread = None
 
@@ -118,7 +152,8 @@ def clean_slate(use_new_keys=False):
       key_snapshot_pri=key_dirsnap_pri,
       key_snapshot_pub=key_dirsnap_pub,
       key_targets_pri=key_dirtarg_pri,
-      key_targets_pub=key_dirtarg_pub)
+      key_targets_pub=key_dirtarg_pub,
+      target_store=demo.get_target_store())
 
   for vin in KNOWN_VINS:
     director_service_instance.add_new_vehicle(vin)
@@ -159,46 +194,505 @@ def clean_slate(use_new_keys=False):
 
 
 def write_to_live(vin_to_update=None):
-  # Release updated metadata.
+  """
+  <Purpose>
+    Release updated metadata: for each vehicle repository, re-sign the
+    metadata (writing it to metadata.staged) and publish it to the live
+    'metadata' directory that is hosted.
+
+    If INCREMENTAL_PUBLISH is True, repositories that have no dirty roles and
+    have already been published are skipped, unless their timestamp metadata
+    expires within TIMESTAMP_REFRESH_MARGIN seconds or the Director wrote
+    them when unloading them (see
+    director.VehicleRepositories.written_on_unload()), and publishing is done by
+    _publish_staged_metadata_incrementally. Otherwise, every repository is
+    re-signed, and its staged metadata is copied in full to the live
+    directory.
+
+    If PUBLISH_WORKERS is greater than 1 and there is more than one
+    repository to write, the repositories are sharded across that many worker
+    processes, each of which signs, writes, and publishes its repositories
+    independently. A failure to write one repository is then reported rather
+    than raised, and does not stop the others from being written. Each
+    repository's live metadata is still replaced atomically. No more than
+    director.MAX_RESIDENT_VEHICLE_REPOSITORIES repositories are sent to the
+    workers at a time, so that the Director need not keep more in memory.
 
-  # For each vehicle repository:
-  #   - write metadata.staged
-  #   - copy metadata.staged to the live metadata directory
-  for vin in director_service_instance.vehicle_repositories:
-    if vin_to_update is not None and vin != vin_to_update:
+  <Arguments>
+    vin_to_update (optional)
+      If not provided, all known vehicle repositories are written. You may
+      also provide a single VIN (string) indicating one vehicle repository to
+      write, or a list of VINs.
+
+  <Exceptions>
+    Any error writing a repository, unless repositories are being written by
+    worker processes.
+
+  <Side Effects>
+    Writes metadata to the metadata.staged and live metadata directories of
+    the repositories.
+
+  <Returns>
+    A dictionary summarizing the write:
+      'published': list of the VINs whose repositories were published
+      'skipped': list of the VINs whose repositories were unchanged
+      'failed': dictionary mapping the VIN of each repository that could not
+          be written to a description of the error
+      'wall_time': the time the whole write took, in seconds
+  """
+  start_time = time.time()
+
+  vins_to_write = []
+  skipped_vins = []
+
+  vehicle_repositories = director_service_instance.vehicle_repositories
+
+  # Repositories that the Director wrote to metadata.staged when unloading
+  # them must be published even if they have no dirty roles.
+  written_on_unload = set(vehicle_repositories.written_on_unload())
+
+  if vin_to_update is None:
+    vins_to_update = list(vehicle_repositories)
+  else:
+    if not isinstance(vin_to_update, list):
+      vin_to_update = [vin_to_update]
+    vins_to_update = [
+        vin for vin in vin_to_update if vin in vehicle_repositories]
+
+  for vin in vins_to_update:
+    if not INCREMENTAL_PUBLISH or vin in written_on_unload:
+      vins_to_write.append(vin)
+      continue
+
+    if not vehicle_repositories.is_resident(vin) and \
+        os.path.exists(os.path.join(
+        director_service_instance.director_repos_dir, vin, 'metadata')) and \
+        not _live_timestamp_expires_soon(os.path.join(
+        director_service_instance.director_repos_dir, vin)):
+      # The Director writes repositories with unwritten changes when it
+      # unloads them, and those are listed in written_on_unload, so there is
+      # no need to load this one to find that it is unchanged.
+      skipped_vins.append(vin)
       continue
-    repo = director_service_instance.vehicle_repositories[vin]
-    repo_dir = repo._repository_directory
 
-    repo.mark_dirty(['timestamp', 'snapshot'])
-    repo.write() # will be writeall() in most recent TUF branch
+    with vehicle_repositories.pinned(vin) as repo:
+      unchanged = not tuf.roledb.get_dirty_roles(repo._repository_name) and \
+          os.path.exists(os.path.join(repo._repository_directory,
+          'metadata')) and not _timestamp_expires_soon(repo)
 
-    assert(os.path.exists(os.path.join(repo_dir, 'metadata.staged'))), \
-        'Programming error: a repository write just occurred; why is ' + \
-        'there no metadata.staged directory where it is expected?'
+    if unchanged:
+      # Nothing has changed in this repository since it was last published,
+      # and its timestamp metadata is not about to expire.
+      skipped_vins.append(vin)
+    else:
+      vins_to_write.append(vin)
 
-    # This shouldn't exist, but just in case something was interrupted,
-    # warn and remove it.
-    if os.path.exists(os.path.join(repo_dir, 'metadata.livetemp')):
-      print(LOG_PREFIX + YELLOW + 'Warning: metadata.livetemp existed already. '
-          'Some previous process was interrupted, or there is a programming '
-          'error.' + ENDCOLORS)
-      shutil.rmtree(os.path.join(repo_dir, 'metadata.livetemp'))
+  if PUBLISH_WORKERS is not None and PUBLISH_WORKERS > 1 and \
+      len(vins_to_write) > 1:
+    failures = _write_repositories_in_worker_processes(vins_to_write)
 
-    # Copy the staged metadata to a temp directory we'll move into place
-    # atomically in a moment.
-    shutil.copytree(
-        os.path.join(repo_dir, 'metadata.staged'),
-        os.path.join(repo_dir, 'metadata.livetemp'))
+  else:
+    failures = {}
+    for vin in vins_to_write:
+      # Each repository is pinned while it is written, so that it is not
+      # unloaded partway through.
+      with vehicle_repositories.pinned(vin) as repo:
+        _write_and_publish_repository(repo)
 
-    # Empty the existing (old) live metadata directory (relatively fast).
-    if os.path.exists(os.path.join(repo_dir, 'metadata')):
-      shutil.rmtree(os.path.join(repo_dir, 'metadata'))
+  report = {
+      'published': [vin for vin in vins_to_write if vin not in failures],
+      'skipped': skipped_vins,
+      'failed': failures,
+      'wall_time': time.time() - start_time}
 
-    # Atomically move the new metadata into place.
-    os.rename(
-        os.path.join(repo_dir, 'metadata.livetemp'),
-        os.path.join(repo_dir, 'metadata'))
+  print(LOG_PREFIX + 'Published ' + str(len(report['published'])) +
+      ' vehicle repositories (' + str(len(skipped_vins)) + ' unchanged) in ' +
+      '%.3f' % report['wall_time'] + ' seconds.')
+  vehicle_repositories.forget_written_on_unload(report['published'])
+  for vin in sorted(failures):
+    print(LOG_PREFIX + RED + 'Failed to write repository for VIN ' +
+        repr(vin) + ': ' + failures[vin] + ENDCOLORS)
+
+  return report
+
+
+
+
+
+def _write_and_publish_repository(repo):
+  """
+  Re-signs and writes the given vehicle repository's metadata to its
+  metadata.staged directory, and publishes it to the live directory.
+  """
+  repo_dir = repo._repository_directory
+
+  # TUF computes the hashes of target files as it writes targets metadata.
+  uptane.common.use_repository_hash_algorithms()
+
+  # The timestamp and snapshot metadata are re-signed with every write, and
+  # are given fresh expiration times (see _timestamp_expires_soon()).
+  repo.timestamp.expiration = tuf.formats.unix_timestamp_to_datetime(
+      int(time.time() + rt.TIMESTAMP_EXPIRATION))
+  repo.snapshot.expiration = tuf.formats.unix_timestamp_to_datetime(
+      int(time.time() + rt.SNAPSHOT_EXPIRATION))
+
+  repo.mark_dirty(['timestamp', 'snapshot'])
+  repo.write() # will be writeall() in most recent TUF branch
+
+  assert(os.path.exists(os.path.join(repo_dir, 'metadata.staged'))), \
+      'Programming error: a repository write just occurred; why is ' + \
+      'there no metadata.staged directory where it is expected?'
+
+  if INCREMENTAL_PUBLISH:
+    _publish_staged_metadata_incrementally(repo_dir)
+  else:
+    _publish_staged_metadata(repo_dir)
+
+
+
+
+
+def _timestamp_expires_soon(repo):
+  """
+  Returns True if the given repository's timestamp metadata expires within
+  TIMESTAMP_REFRESH_MARGIN seconds.
+  """
+  expires = calendar.timegm(repo.timestamp.expiration.utctimetuple())
+  return expires - time.time() < TIMESTAMP_REFRESH_MARGIN
+
+
+
+
+
+def _live_timestamp_expires_soon(repo_dir):
+  """
+  Returns True if the live timestamp metadata of the repository in repo_dir,
+  which is not in memory, may expire within TIMESTAMP_REFRESH_MARGIN seconds.
+  Timestamp metadata is given an expiration time
+  tuf.repository_tool.TIMESTAMP_EXPIRATION seconds after it is written (see
+  _write_and_publish_repository()), so this is judged from the time the file
+  was last modified, without loading the repository.
+  """
+  try:
+    written = os.path.getmtime(os.path.join(
+        repo_dir, 'metadata', 'timestamp.' + tuf.conf.METADATA_FORMAT))
+  except OSError:
+    return True
+
+  return written + rt.TIMESTAMP_EXPIRATION - time.time() < \
+      TIMESTAMP_REFRESH_MARGIN
+
+
+
+
+
+def _write_repositories_in_worker_processes(vins):
+  """
+  Writes and publishes the repositories for the given VINs, sharded across
+  PUBLISH_WORKERS worker processes.
+
+  This process runs server threads, so the workers are spawned rather than
+  forked: a forked child could inherit a lock held by one of those threads and
+  deadlock on it. Each worker is instead sent what it needs to rebuild the
+  repository it is to write (see _get_repository_state()). Writing a
+  repository also updates its role information (e.g. version numbers) in
+  tuf.roledb, so each worker sends back the resulting role information, which
+  is then applied here as though the repository had been written in this
+  process.
+
+  The repositories are sent to the workers in batches of no more than
+  director.MAX_RESIDENT_VEHICLE_REPOSITORIES, each pinned in memory until
+  its role information has been applied.
+
+  Returns a dictionary mapping the VIN of each repository that could not be
+  written to a description of the error.
+  """
+  failures = {}
+
+  vehicle_repositories = director_service_instance.vehicle_repositories
+
+  batch_size = director.MAX_RESIDENT_VEHICLE_REPOSITORIES or len(vins)
+
+  pool = multiprocessing.get_context('spawn').Pool(PUBLISH_WORKERS,
+      initializer=_initialize_publish_worker,
+      initargs=(tuf.conf.METADATA_FORMAT, INCREMENTAL_PUBLISH))
+  try:
+    for start in range(0, len(vins), batch_size):
+      batch = vins[start:start + batch_size]
+
+      # Give each worker a few shards, so that a slow shard does not leave the
+      # other workers idle for long.
+      chunksize = max(1, len(batch) // (PUBLISH_WORKERS * 4))
+
+      repositories = {}
+      try:
+        for vin in batch:
+          repositories[vin] = vehicle_repositories.pin(vin)
+
+        states = [_get_repository_state(vin) for vin in batch]
+
+        for vin, error, roleinfos in pool.imap_unordered(
+            _write_and_publish_repository_in_worker, states, chunksize):
+
+          if error is not None:
+            failures[vin] = error
+            continue
+
+          repository_name = repositories[vin]._repository_name
+          for rolename, roleinfo in roleinfos.items():
+            tuf.roledb.update_roleinfo(rolename, roleinfo,
+                mark_role_as_dirty=False, repository_name=repository_name)
+          tuf.roledb.unmark_dirty(list(roleinfos), repository_name)
+
+      finally:
+        for vin in repositories:
+          vehicle_repositories.unpin(vin)
+
+  finally:
+    pool.close()
+    pool.join()
+
+  return failures
+
+
+
+
+
+def _get_repository_state(vin):
+  """
+  Returns a dictionary holding everything a worker process needs to rebuild
+  the repository for the given VIN: its name and directories, the role
+  information and dirty roles in tuf.roledb, and the keys (including signing
+  keys) in tuf.keydb for the keyids those roles list.
+  """
+  repo = director_service_instance.vehicle_repositories[vin]
+  repository_name = repo._repository_name
+
+  roleinfos = dict(
+      (rolename, tuf.roledb.get_roleinfo(rolename, repository_name))
+      for rolename in tuf.roledb.get_rolenames(repository_name))
+
+  keys = {}
+  for roleinfo in roleinfos.values():
+    for keyid in roleinfo['keyids'] + roleinfo.get('signing_keyids', []):
+      if keyid not in keys:
+        keys[keyid] = tuf.keydb.get_key(keyid, repository_name)
+
+  return {
+      'vin': vin,
+      'repository_name': repository_name,
+      'repository_directory': repo._repository_directory,
+      'metadata_directory': repo._metadata_directory,
+      'targets_directory': repo._targets_directory,
+      'roleinfos': roleinfos,
+      'dirty_roles': tuf.roledb.get_dirty_roles(repository_name),
+      'keys': keys}
+
+
+
+
+
+def _initialize_publish_worker(metadata_format, incremental_publish):
+  """
+  Run in each worker process spawned by
+  _write_repositories_in_worker_processes, to apply the settings of the
+  parent process that affect writing and publishing.
+  """
+  global INCREMENTAL_PUBLISH
+
+  tuf.conf.METADATA_FORMAT = metadata_format
+  INCREMENTAL_PUBLISH = incremental_publish
+
+
+
+
+
+def _write_and_publish_repository_in_worker(state):
+  """
+  Run in a worker process by _write_repositories_in_worker_processes.
+  Rebuilds the repository described by state (see _get_repository_state()),
+  then writes and publishes it, returning a tuple (vin, error, roleinfos):
+  error is None on success or else a description of the error, and roleinfos
+  maps each role in the repository to its role information after the write.
+  """
+  vin = state['vin']
+  repository_name = state['repository_name']
+
+  try:
+    # A worker may write several repositories; discard anything left over
+    # from an earlier one with the same name.
+    if repository_name == 'default':
+      tuf.roledb.clear_roledb(repository_name)
+      tuf.keydb.clear_keydb(repository_name)
+    else:
+      tuf.roledb.remove_roledb(repository_name)
+      tuf.keydb.remove_keydb(repository_name)
+      tuf.roledb.create_roledb(repository_name)
+      tuf.keydb.create_keydb(repository_name)
+
+    for keyid, key in state['keys'].items():
+      key = dict(key, keyid=keyid)
+      tuf.keydb.add_key(key, keyid, repository_name)
+
+    for rolename, roleinfo in state['roleinfos'].items():
+      tuf.roledb.add_role(rolename, roleinfo, repository_name)
+
+    if state['dirty_roles']:
+      tuf.roledb.mark_dirty(state['dirty_roles'], repository_name)
+
+    repo = rt.Repository(state['repository_directory'],
+        state['metadata_directory'], state['targets_directory'],
+        repository_name)
+
+    _write_and_publish_repository(repo)
+
+  except Exception as e: # Reported to, and printed by, the parent process.
+    return vin, repr(e), None
+
+  return vin, None, dict(
+      (rolename, tuf.roledb.get_roleinfo(rolename, repository_name))
+      for rolename in tuf.roledb.get_rolenames(repository_name))
+
+
+
+
+
+def _publish_staged_metadata(repo_dir):
+  """
+  Copies the contents of the repository's metadata.staged directory to its
+  live 'metadata' directory, replacing the old live metadata.
+  """
+  # This shouldn't exist, but just in case something was interrupted,
+  # warn and remove it.
+  _remove_stale_livetemp(repo_dir)
+
+  # Copy the staged metadata to a temp directory we'll move into place
+  # atomically in a moment.
+  shutil.copytree(
+      os.path.join(repo_dir, 'metadata.staged'),
+      os.path.join(repo_dir, 'metadata.livetemp'))
+
+  # Empty the existing (old) live metadata directory (relatively fast).
+  # (If the live metadata was published incrementally, it is a symlink to
+  # a directory, both of which are removed.)
+  _remove_live_metadata(repo_dir)
+
+  # Atomically move the new metadata into place.
+  os.rename(
+      os.path.join(repo_dir, 'metadata.livetemp'),
+      os.path.join(repo_dir, 'metadata'))
+
+
+
+
+
+def _publish_staged_metadata_incrementally(repo_dir):
+  """
+  Publishes the contents of the repository's metadata.staged directory as
+  a new, never-modified directory, metadata.live.*, and atomically repoints
+  the live 'metadata' symlink at it.
+
+  Files in metadata.staged that are the same as the corresponding live files
+  (same size and modification time, which copies preserve, or else the same
+  contents) are hard-linked from the old live directory instead of being
+  copied, so that the cost of publishing is proportional to what has changed.
+  (The staged files themselves are not hard-linked into the live directory,
+  because TUF rewrites staged metadata in place.)
+  """
+  staged_dir = os.path.join(repo_dir, 'metadata.staged')
+  live_link = os.path.join(repo_dir, 'metadata')
+
+  _remove_stale_livetemp(repo_dir)
+
+  # If the old live metadata is a real directory (published in full), move it
+  # aside so that it can be replaced by a symlink. This leaves a short window
+  # with no live metadata, as publishing in full always does.
+  if os.path.isdir(live_link) and not os.path.islink(live_link):
+    old_live_dir = tempfile.mkdtemp(prefix='metadata.live.', dir=repo_dir)
+    os.rmdir(old_live_dir)
+    os.rename(live_link, old_live_dir)
+  elif os.path.islink(live_link):
+    old_live_dir = os.path.join(repo_dir, os.readlink(live_link))
+  else:
+    old_live_dir = None
+
+  new_live_dir = tempfile.mkdtemp(prefix='metadata.live.', dir=repo_dir)
+  # mkdtemp creates the directory readable only by its owner.
+  os.chmod(new_live_dir, 0o755)
+
+  for dirpath, dirnames, filenames in os.walk(staged_dir):
+    relative_dir = os.path.relpath(dirpath, staged_dir)
+    for dirname in dirnames:
+      os.mkdir(os.path.join(new_live_dir, relative_dir, dirname))
+
+    for filename in filenames:
+      staged_file = os.path.join(dirpath, filename)
+      new_live_file = os.path.join(new_live_dir, relative_dir, filename)
+      old_live_file = None if old_live_dir is None else \
+          os.path.join(old_live_dir, relative_dir, filename)
+
+      if old_live_file is not None and os.path.isfile(old_live_file) and \
+          filecmp.cmp(staged_file, old_live_file):
+        try:
+          os.link(old_live_file, new_live_file)
+          continue
+        except OSError: # e.g. if the filesystem does not support hard links
+          pass
+
+      # copy2 preserves the modification time, which lets the next publish
+      # recognize this file as unchanged without reading it.
+      shutil.copy2(staged_file, new_live_file)
+
+  # Atomically repoint the live metadata at the new directory. (Renaming a
+  # symlink over another replaces it in a single step.)
+  os.symlink(os.path.basename(new_live_dir),
+      os.path.join(repo_dir, 'metadata.livetemp'))
+  os.rename(os.path.join(repo_dir, 'metadata.livetemp'), live_link)
+
+  # Files already opened from the old live directory remain readable after it
+  # is removed.
+  if old_live_dir is not None and os.path.exists(old_live_dir):
+    shutil.rmtree(old_live_dir)
+
+
+
+
+
+def _remove_stale_livetemp(repo_dir):
+  """
+  Removes the repository's metadata.livetemp directory or symlink, which
+  should exist only if some previous publish was interrupted.
+  """
+  livetemp = os.path.join(repo_dir, 'metadata.livetemp')
+
+  if os.path.islink(livetemp):
+    os.remove(livetemp)
+
+  elif os.path.exists(livetemp):
+    print(LOG_PREFIX + YELLOW + 'Warning: metadata.livetemp existed already. '
+        'Some previous process was interrupted, or there is a programming '
+        'error.' + ENDCOLORS)
+    shutil.rmtree(livetemp)
+
+
+
+
+
+def _remove_live_metadata(repo_dir):
+  """
+  Removes the repository's live 'metadata' directory, or, if it was published
+  incrementally, the symlink and the directory it points to.
+  """
+  live_link = os.path.join(repo_dir, 'metadata')
+
+  if os.path.islink(live_link):
+    live_dir = os.path.join(repo_dir, os.readlink(live_link))
+    os.remove(live_link)
+    if os.path.exists(live_dir):
+      shutil.rmtree(live_dir)
+
+  elif os.path.exists(live_link):
+    shutil.rmtree(live_link)
 
 
 
@@ -234,18 +728,19 @@ def backup_repositories(vin=None):
     repos_to_backup = [vin]
 
   for vin in repos_to_backup:
-    repo = director_service_instance.vehicle_repositories[vin]
-    repo_dir = repo._repository_directory
+    with director_service_instance.vehicle_repositories.pinned(vin) as \
+        repo:
+      repo_dir = repo._repository_directory
 
-    if os.path.exists(os.path.join(repo_dir, 'metadata.backup')):
-      raise uptane.Error('Backup already exists for repository ' +
-          repr(repo_dir) + '; please delete or restore this backup before '
-          'trying to backup again.')
+      if os.path.exists(os.path.join(repo_dir, 'metadata.backup')):
+        raise uptane.Error('Backup already exists for repository ' +
+            repr(repo_dir) + '; please delete or restore this backup before '
+            'trying to backup again.')
 
-    print(LOG_PREFIX + ' Backing up ' +
-        os.path.join(repo_dir, 'metadata.staged'))
-    shutil.copytree(os.path.join(repo_dir, 'metadata.staged'),
-        os.path.join(repo_dir, 'metadata.backup'))
+      print(LOG_PREFIX + ' Backing up ' +
+          os.path.join(repo_dir, 'metadata.staged'))
+      shutil.copytree(os.path.join(repo_dir, 'metadata.staged'),
+          os.path.join(repo_dir, 'metadata.backup'))
 
 
 
@@ -316,20 +811,10 @@ def restore_repositories(vin=None):
     director_service_instance.vehicle_repositories[vin].root.load_signing_key(
         valid_root_private_key)
 
-    # Copy the staged metadata to a temp directory, which we'll move into place
-    # atomically in a moment.
-    shutil.copytree(os.path.join(repo_dir, 'metadata.staged'),
-        os.path.join(repo_dir, 'metadata.livetemp'))
-
-    # Empty the existing (old) live metadata directory (relatively fast).
-    print(LOG_PREFIX + 'Deleting live hosted dir:' +
-        os.path.join(repo_dir, 'metadata'))
-    if os.path.exists(os.path.join(repo_dir, 'metadata')):
-      shutil.rmtree(os.path.join(repo_dir, 'metadata'))
-
-    # Atomically move the new metadata into place in the hosted directory.
-    os.rename(os.path.join(repo_dir, 'metadata.livetemp'),
+    # Replace the live hosted metadata with the restored metadata.
+    print(LOG_PREFIX + 'Replacing live hosted dir:' +
         os.path.join(repo_dir, 'metadata'))
+    _publish_staged_metadata(repo_dir)
     print(LOG_PREFIX + 'Repository ' + repo_dir + ' restored and hosted.')
 
 
@@ -395,36 +880,38 @@ def revoke_compromised_keys():
   director_service_instance.key_dirsnap_pri = new_snapshot_private_key
 
   for vin in director_service_instance.vehicle_repositories:
-    repository = director_service_instance.vehicle_repositories[vin]
-    repo_dir = repository._repository_directory
+    with director_service_instance.vehicle_repositories.pinned(vin) as \
+        repository:
+      repo_dir = repository._repository_directory
 
-    # Swap verification keys for the three roles.
-    repository.targets.remove_verification_key(old_targets_public_key)
-    repository.targets.add_verification_key(new_targets_public_key)
+      # Swap verification keys for the three roles.
+      repository.targets.remove_verification_key(old_targets_public_key)
+      repository.targets.add_verification_key(new_targets_public_key)
 
-    repository.timestamp.remove_verification_key(old_timestamp_public_key)
-    repository.timestamp.add_verification_key(new_timestamp_public_key)
+      repository.timestamp.remove_verification_key(old_timestamp_public_key)
+      repository.timestamp.add_verification_key(new_timestamp_public_key)
 
-    repository.snapshot.remove_verification_key(old_snapshot_public_key)
-    repository.snapshot.add_verification_key(new_snapshot_public_key)
+      repository.snapshot.remove_verification_key(old_snapshot_public_key)
+      repository.snapshot.add_verification_key(new_snapshot_public_key)
 
-    # Unload the old signing keys so that the new metadata only contains
-    # signatures produced by the new signing keys. Since this is based on
-    # keyid, the public key can be used.
-    repository.targets.unload_signing_key(old_targets_public_key)
-    repository.snapshot.unload_signing_key(old_snapshot_public_key)
-    repository.timestamp.unload_signing_key(old_timestamp_public_key)
+      # Unload the old signing keys so that the new metadata only contains
+      # signatures produced by the new signing keys. Since this is based on
+      # keyid, the public key can be used.
+      repository.targets.unload_signing_key(old_targets_public_key)
+      repository.snapshot.unload_signing_key(old_snapshot_public_key)
+      repository.timestamp.unload_signing_key(old_timestamp_public_key)
 
-    # Load the new signing keys to write metadata. The root key is unchanged,
-    # and in the demo it is already loaded.
-    repository.targets.load_signing_key(new_targets_private_key)
-    repository.snapshot.load_signing_key(new_snapshot_private_key)
-    repository.timestamp.load_signing_key(new_timestamp_private_key)
+      # Load the new signing keys to write metadata. The root key is
+      # unchanged, and in the demo it is already loaded.
+      repository.targets.load_signing_key(new_targets_private_key)
+      repository.snapshot.load_signing_key(new_snapshot_private_key)
+      repository.timestamp.load_signing_key(new_timestamp_private_key)
 
-    # The root role is not automatically marked as dirty when the verification
-    # keys are updated via repository.<non-root-role>.add_verification_key().
-    # TODO: Verify this behavior with the latest version of the TUF codebase.
-    repository.mark_dirty(['root'])
+      # The root role is not automatically marked as dirty when the
+      # verification keys are updated via
+      # repository.<non-root-role>.add_verification_key().
+      # TODO: Verify this behavior with the latest version of the TUF codebase.
+      repository.mark_dirty(['root'])
 
 
   # Push the changes to "live".
@@ -491,40 +978,31 @@ def sign_with_compromised_keys_attack(vin=None):
 
   for vin in vehicles_to_attack:
 
-    repository = director_service_instance.vehicle_repositories[vin]
-    repo_dir = repository._repository_directory
+    with director_service_instance.vehicle_repositories.pinned(vin) as \
+        repository:
+      repo_dir = repository._repository_directory
 
-    repository.targets.unload_signing_key(current_targets_private_key)
-    repository.snapshot.unload_signing_key(current_snapshot_private_key)
-    repository.timestamp.unload_signing_key(current_timestamp_private_key)
+      repository.targets.unload_signing_key(current_targets_private_key)
+      repository.snapshot.unload_signing_key(current_snapshot_private_key)
+      repository.timestamp.unload_signing_key(current_timestamp_private_key)
 
-    # Load the old signing keys to generate the malicious metadata. The root
-    # key is unchanged, and in the demo it is already loaded.
-    repository.targets.load_signing_key(old_targets_private_key)
-    repository.snapshot.load_signing_key(old_snapshot_private_key)
-    repository.timestamp.load_signing_key(old_timestamp_private_key)
+      # Load the old signing keys to generate the malicious metadata. The root
+      # key is unchanged, and in the demo it is already loaded.
+      repository.targets.load_signing_key(old_targets_private_key)
+      repository.snapshot.load_signing_key(old_snapshot_private_key)
+      repository.timestamp.load_signing_key(old_timestamp_private_key)
 
-    repository.timestamp.version = repository.targets.version + 1
-    repository.timestamp.version = repository.snapshot.version + 1
-    repository.timestamp.version = repository.timestamp.version + 1
+      repository.timestamp.version = repository.targets.version + 1
+      repository.timestamp.version = repository.snapshot.version + 1
+      repository.timestamp.version = repository.timestamp.version + 1
 
-    # Metadata must be partially written, otherwise write() will throw
-    # a UnsignedMetadata exception due to the invalid signing keys (i.e.,
-    # we are using the old signing keys, which have since been revoked.
-    repository.write(write_partial=True)
+      # Metadata must be partially written, otherwise write() will throw
+      # a UnsignedMetadata exception due to the invalid signing keys (i.e.,
+      # we are using the old signing keys, which have since been revoked.
+      repository.write(write_partial=True)
 
-    # Copy the staged metadata to a temp directory we'll move into place
-    # atomically in a moment.
-    shutil.copytree(os.path.join(repo_dir, 'metadata.staged'),
-        os.path.join(repo_dir, 'metadata.livetemp'))
-
-    # Empty the existing (old) live metadata directory (relatively fast).
-    if os.path.exists(os.path.join(repo_dir, 'metadata')):
-      shutil.rmtree(os.path.join(repo_dir, 'metadata'))
-
-    # Atomically move the new metadata into place.
-    os.rename(os.path.join(repo_dir, 'metadata.livetemp'),
-        os.path.join(repo_dir, 'metadata'))
+      # Move the staged metadata into place in the live directory.
+      _publish_staged_metadata(repo_dir)
 
   print(LOG_PREFIX + 'COMPLETED ATTACK')
 
@@ -580,13 +1058,14 @@ def undo_sign_with_compromised_keys_attack(vin=None):
 
   for vin in vehicles_to_attack:
 
-    repository = director_service_instance.vehicle_repositories[vin]
-    repo_dir = repository._repository_directory
+    with director_service_instance.vehicle_repositories.pinned(vin) as \
+        repository:
+      repo_dir = repository._repository_directory
 
-    # Load the new signing keys to write metadata.
-    repository.targets.load_signing_key(valid_targets_private_key)
-    repository.snapshot.load_signing_key(valid_snapshot_private_key)
-    repository.timestamp.load_signing_key(valid_timestamp_private_key)
+      # Load the new signing keys to write metadata.
+      repository.targets.load_signing_key(valid_targets_private_key)
+      repository.snapshot.load_signing_key(valid_snapshot_private_key)
+      repository.timestamp.load_signing_key(valid_timestamp_private_key)
 
   print(LOG_PREFIX + 'COMPLETED UNDO ATTACK')
 
@@ -608,7 +1087,8 @@ def add_target_to_director(target_fname, filepath_in_repo, vin, ecu_serial):
     target_fname
       The full filename of the file to be added as a target to the Director's
       targets role metadata. This file doesn't have to be in any particular
-      place; it will be copied into the repository directory structure.
+      place; it will be added to the demo's target store (demo.TARGET_STORE_DIR)
+      and linked into the repository directory structure.
 
     filepath_in_repo
       The path relative to the root of the repository's targets directory
@@ -629,82 +1109,121 @@ def add_target_to_director(target_fname, filepath_in_repo, vin, ecu_serial):
     raise uptane.UnknownVehicle('The VIN provided, ' + repr(vin) + ' is not '
         'that of a vehicle known to this Director.')
 
-  repo = director_service_instance.vehicle_repositories[vin]
-  repo_dir = repo._repository_directory
+  # Keep the repository loaded while the file is linked into it, which may
+  # take a while, and other repositories are looked up in the meantime.
+  with director_service_instance.vehicle_repositories.pinned(vin) as repo:
+    repo_dir = repo._repository_directory
 
-  print(LOG_PREFIX + 'Copying target file into place.')
-  destination_filepath = os.path.join(repo_dir, 'targets', filepath_in_repo)
+    print(LOG_PREFIX + 'Linking target file into place.')
+    destination_filepath = os.path.join(repo_dir, 'targets', filepath_in_repo)
 
-  # TODO: This should probably place the file into a common targets directory
-  # that is then softlinked to all repositories.
-  shutil.copy(target_fname, destination_filepath)
+    # The file is stored once in the demo's target store, which every vehicle
+    # repository (and the Image Repository) hard-links to, rather than copied
+    # into each repository that it is assigned in.
+    demo.get_target_store().add_and_link(target_fname, destination_filepath)
 
-  print(LOG_PREFIX + 'Adding target ' + repr(target_fname) + ' for ECU ' +
-      repr(ecu_serial))
+    print(LOG_PREFIX + 'Adding target ' + repr(target_fname) + ' for ECU ' +
+        repr(ecu_serial))
 
-  # This calls the appropriate vehicle repository.
-  director_service_instance.add_target_for_ecu(
-      vin, ecu_serial, destination_filepath)
+    # This calls the appropriate vehicle repository.
+    director_service_instance.add_target_for_ecu(
+        vin, ecu_serial, destination_filepath)
 
 
 
 
 
-def host():
+def assign_image_to_vehicles(
+    image_fname, filepath_in_repo, vins=None, ecu_serials=None):
   """
-  Hosts the Director repository (http serving metadata files) as a separate
-  process. Should be stopped with kill_server().
+  Assigns an image to many vehicles and publishes the result: a campaign
+  version of add_target_to_director() followed by write_to_live().
 
-  Note that you must also run listen() to start the Director services (run on
-  xmlrpc).
+  The image is hashed once and linked into the repositories of all of the
+  selected vehicles (see uptane.services.director.Director.assign_image()),
+  and then all of the changed repositories are written and published in one
+  call to write_to_live(). Progress and throughput are printed.
+
+  <Arguments>
+    image_fname
+      The full filename of the image file.
+
+    filepath_in_repo
+      The path relative to the root of each repository's targets directory
+      where the image will be kept and accessed by clients.
 
-  If this module already started a server process to host the repo, nothing will
-  be done.
+    vins (optional)
+      A list of VINs of vehicles whose Primary ECUs the image is for.
+
+    ecu_serials (optional)
+      A list of ECU Serials of ECUs the image is for, in whichever vehicles
+      they are registered in.
+
+  <Returns>
+    A dictionary summarizing the campaign: that returned by
+    Director.assign_image(), with the report returned by write_to_live()
+    added under 'publish'.
   """
+  tuf.formats.RELPATH_SCHEMA.check_match(image_fname)
+  tuf.formats.RELPATH_SCHEMA.check_match(filepath_in_repo)
 
+  # Print progress roughly every tenth of the way through.
+  def print_progress(count, total):
+    if count == total or count % max(total // 10, 1) == 0:
+      print(LOG_PREFIX + 'Assigned image to ' + str(count) + ' of ' +
+          str(total) + ' vehicles.')
 
-  global repo_server_process
+  report = director_service_instance.assign_image(image_fname,
+      filepath_in_repo, vins=vins, ecu_serials=ecu_serials,
+      progress_callback=print_progress)
 
-  if repo_server_process is not None:
-    print(LOG_PREFIX + 'Sorry: there is already a server process running.')
-    return
+  print(LOG_PREFIX + 'Hashed ' + repr(image_fname) + ' (' +
+      str(report['fileinfo']['length']) + ' bytes) once, in ' +
+      '%.3f' % report['hash_time'] + ' seconds; assigned it to ' +
+      str(len(report['assignments'])) + ' vehicles at ' +
+      '%.1f' % report['vehicles_per_second'] + ' vehicles per second.')
 
-  # Prepare to host the director repo contents.
+  report['publish'] = write_to_live(list(report['assignments']))
 
-  os.chdir(demo.DIRECTOR_REPO_DIR)
+  return report
 
-  command = []
-  if sys.version_info.major < 3: # Python 2 compatibility
-    command = ['python', '-m', 'SimpleHTTPServer', str(demo.DIRECTOR_REPO_PORT)]
-  else:
-    command = ['python3', '-m', 'http.server', str(demo.DIRECTOR_REPO_PORT)]
 
 
-  # Begin hosting the director's repository.
 
-  repo_server_process = subprocess.Popen(command, stderr=subprocess.PIPE)
 
-  os.chdir(uptane.WORKING_DIR)
+def host():
+  """
+  Hosts the Director repository (http serving metadata files) from a threaded
+  HTTP server in this process (see demo/http_repo_server.py), which supports
+  persistent connections, Range requests, and ETags, so that unchanged
+  metadata is not sent again to Primaries that poll for it. Should be stopped
+  with kill_server().
+
+  Note that you must also run listen() to start the Director services (run on
+  xmlrpc).
+
+  If this module already started a server to host the repo, nothing will be
+  done.
+  """
+
+
+  global repo_server
+
+  if repo_server is not None:
+    print(LOG_PREFIX + 'Sorry: there is already a server running.')
+    return
+
+  # Begin hosting the director's repository.
+  repo_server = http_repo_server.serve_directory(demo.DIRECTOR_REPO_DIR,
+      demo.DIRECTOR_REPO_HOST, demo.DIRECTOR_REPO_PORT)
 
-  print(LOG_PREFIX + 'Director repo server process started, with pid ' +
-      str(repo_server_process.pid) + ', serving on port ' +
+  print(LOG_PREFIX + 'Director repo server started, serving on port ' +
       str(demo.DIRECTOR_REPO_PORT) + '. Director repo URL is: ' +
       demo.DIRECTOR_REPO_HOST + ':' + str(demo.DIRECTOR_REPO_PORT) + '/')
 
-  # Kill server process after calling exit().
+  # Stop the server after calling exit().
   atexit.register(kill_server)
 
-  # Wait / allow any exceptions to kill the server.
-  # try:
-  #   time.sleep(1000000) # Stop hosting after a while.
-  # except:
-  #   print('Exception caught')
-  #   pass
-  # finally:
-  #   if repo_server_process.returncode is None:
-  #     print('Terminating Director repo server process ' + str(repo_server_process.pid))
-  #     repo_server_process.kill()
-
 
 # Restrict director requests to a particular path.
 # Must specify RPC2 here for the XML-RPC interface to work.
@@ -764,9 +1283,15 @@ def listen():
         'listening.')
     return
 
-  # Create server
-  server = xmlrpc_server.SimpleXMLRPCServer(
+  # Create server. Requests are handled by a pool of worker threads, so that
+  # one slow Vehicle Manifest upload does not hold up other vehicles. Only
+  # the methods listed in DIRECTOR_CONCURRENT_METHODS run concurrently; the
+  # rest (which modify and write repositories) run one at a time.
+  server = xmlrpc_thread_pool.ThreadPoolXMLRPCServer(
       (demo.DIRECTOR_SERVER_HOST, demo.DIRECTOR_SERVER_PORT),
+      workers=demo.XMLRPC_SERVER_WORKERS,
+      max_queued=demo.XMLRPC_SERVER_MAX_QUEUED,
+      concurrent_methods=DIRECTOR_CONCURRENT_METHODS,
       requestHandler=RequestHandler, allow_none=True)
 
   # Register function that can be called via XML-RPC, allowing a Primary to
@@ -791,6 +1316,8 @@ def listen():
   # Provide absolute path for this, or path relative to the Director's repo
   # directory.
   server.register_function(add_target_to_director, 'add_target_to_director')
+  server.register_function(
+      assign_image_to_vehicles, 'assign_image_to_vehicles')
   server.register_function(write_to_live, 'write_director_repo')
 
   server.register_function(
@@ -887,6 +1414,11 @@ def mitm_arbitrary_package_attack(vin, target_filepath):
     os.rename(image_repo_full_target_filepath,
         image_repo_backup_full_target_filepath)
 
+  # The target file may be a hard link to a file in the target store, shared
+  # with other repositories, so replace it rather than writing through it.
+  if os.path.exists(full_target_filepath):
+    os.remove(full_target_filepath)
+
   with open(full_target_filepath, 'w') as file_object:
     file_object.write('EVIL UPDATE: ARBITRARY PACKAGE ATTACK TO BE'
         ' DELIVERED FROM MITM (no keys compromised).')
@@ -1220,21 +1752,21 @@ def add_target_and_write_to_live(filename, file_content, vin, ecu_serial):
 
 def kill_server():
   """
-  Kills the forked process that is hosting the Director repositories via
-  Python's simple HTTP server. This does not affect the Director service
-  (which handles manifests and responds to requests from Primaries), nor does
-  it affect the metadata in the repositories or the state of the repositories
-  at all. host() can be run afterwards to begin hosting again.
+  Stops the HTTP server that is hosting the Director repositories. This does
+  not affect the Director service (which handles manifests and responds to
+  requests from Primaries), nor does it affect the metadata in the
+  repositories or the state of the repositories at all. host() can be run
+  afterwards to begin hosting again.
   """
 
-  global repo_server_process
+  global repo_server
 
-  if repo_server_process is None:
-    print(LOG_PREFIX + 'No repository hosting process to stop.')
+  if repo_server is None:
+    print(LOG_PREFIX + 'No repository hosting server to stop.')
     return
 
   else:
-    print(LOG_PREFIX + 'Killing repository hosting process with pid: ' +
-        str(repo_server_process.pid))
-    repo_server_process.kill()
-    repo_server_process = None
+    print(LOG_PREFIX + 'Stopping repository hosting server.')
+    repo_server.shutdown()
+    repo_server.server_close()
+    repo_server = None
@@ -26,12 +26,13 @@ from __future__ import unicode_literals
 import demo
 import uptane # Import before TUF modules; may change tuf.conf values.
 import uptane.formats
+import uptane.common
 import tuf.formats
 import datetime
 
 import threading # for the interface for the demo website
 import os
-import sys, subprocess, time # For hosting and arguments
+import sys, time # For arguments
 import tuf.repository_tool as rt
 import shutil # for rmtree
 from uptane import GREEN, RED, YELLOW, ENDCOLORS
@@ -39,6 +40,8 @@ from uptane import GREEN, RED, YELLOW, ENDCOLORS
 from six.moves import xmlrpc_server # for the director services interface
 
 import atexit # to kill server process on exit()
+import demo.xmlrpc_thread_pool as xmlrpc_thread_pool
+import demo.http_repo_server as http_repo_server
 
 
 # Tell the reference implementation that we're in demo mode.
@@ -51,7 +54,7 @@ uptane.DEMO_MODE = True
 LOG_PREFIX = uptane.PLUM_BG + 'ImageRepo:' + ENDCOLORS + ' '
 
 repo = None
-server_process = None
+repo_server = None
 xmlrpc_service_thread = None
 
 
@@ -159,7 +162,9 @@ def write_to_live():
 
   global repo
 
-  # Write the metadata files out to the Image Repository's 'metadata.staged'
+  # Write the metadata files out to the Image Repository's 'metadata.staged',
+  # listing the target hashes suited to the metadata format in effect.
+  uptane.common.use_repository_hash_algorithms()
   repo.mark_dirty(['timestamp', 'snapshot'])
   repo.write() # will be writeall() in most recent TUF branch
 
@@ -183,13 +188,18 @@ def add_target_to_imagerepo(target_fname, filepath_in_repo):
   Given a filename pointing to a file in the targets directory, adds that file
   as a target file (calculating its cryptographic hash and length)
 
+  The hashes listed are those given by
+  uptane.common.get_repository_hash_algorithms() for the metadata format in
+  effect, which include SM3 with JSON metadata where supported.
+
   This doesn't employ delegations, which would have to be done manually.
 
   <Arguments>
     target_fname
       The full filename of the file to be added as a target to the image
-      repository's targets role metadata. The file will be copied into the
-      repository's targets directory from the given path.
+      repository's targets role metadata. The file will be added to the
+      demo's target store (demo.TARGET_STORE_DIR) from the given path and
+      linked into the repository's targets directory.
 
     filepath_in_repo
       This is the name that will identify the file in the repository, and
@@ -201,11 +211,15 @@ def add_target_to_imagerepo(target_fname, filepath_in_repo):
   tuf.formats.RELPATH_SCHEMA.check_match(target_fname)
 
 
-  print(LOG_PREFIX + 'Copying target file into place.')
+  print(LOG_PREFIX + 'Linking target file into place.')
   repo_dir = repo._repository_directory
   destination_filepath = os.path.join(repo_dir, 'targets', filepath_in_repo)
 
-  shutil.copy(target_fname, destination_filepath)
+  # The file is stored once in the demo's target store and hard-linked here,
+  # so that the Director's vehicle repositories can share it.
+  demo.get_target_store().add_and_link(target_fname, destination_filepath)
+
+  uptane.common.use_repository_hash_algorithms()
 
   repo.targets.add_target(destination_filepath)
 
@@ -214,49 +228,30 @@ def add_target_to_imagerepo(target_fname, filepath_in_repo):
 
 
 def host():
+  """
+  Hosts the Image Repository from a threaded HTTP server in this process (see
+  demo/http_repo_server.py), which supports persistent connections, Range
+  requests for resuming image downloads, and ETags. Should be stopped with
+  kill_server().
+  """
 
-  global server_process
+  global repo_server
 
-  if server_process is not None:
-    print(LOG_PREFIX + 'Sorry: there is already a server process running.')
+  if repo_server is not None:
+    print(LOG_PREFIX + 'Sorry: there is already a server running.')
     return
 
-  # Prepare to host the main repo contents
-
-  os.chdir(demo.IMAGE_REPO_DIR)
-
-  command = []
-  if sys.version_info.major < 3:  # Python 2 compatibility
-    command = ['python', '-m', 'SimpleHTTPServer', str(demo.IMAGE_REPO_PORT)]
-  else:
-    command = ['python3', '-m', 'http.server', str(demo.IMAGE_REPO_PORT)]
-
-
   # Begin hosting Image Repository.
+  repo_server = http_repo_server.serve_directory(
+      demo.IMAGE_REPO_DIR, demo.IMAGE_REPO_HOST, demo.IMAGE_REPO_PORT)
 
-  server_process = subprocess.Popen(command, stderr=subprocess.PIPE)
-
-  os.chdir(uptane.WORKING_DIR)
-
-  print(LOG_PREFIX + 'Main Repo server process started, with pid ' +
-      str(server_process.pid) + '; Main Repo serving on port: ' +
+  print(LOG_PREFIX + 'Main Repo server started; Main Repo serving on port: ' +
       str(demo.IMAGE_REPO_PORT) + '; Main repo URL is ' +
       demo.IMAGE_REPO_HOST + ':' + str(demo.IMAGE_REPO_PORT) + '/')
 
-  # Kill server process after calling exit().
+  # Stop the server after calling exit().
   atexit.register(kill_server)
 
-  # Wait / allow any exceptions to kill the server.
-  #try:
-  #  time.sleep(1000000) # Stop hosting after a while.
-  #except:
-  #  print('Exception caught')
-  #  pass
-  #finally:
-  #  if server_process.returncode is None:
-  #    print('Terminating Main Repo server process ' + str(server_process.pid))
-  #    server_process.kill()
-
 
 
 
@@ -287,9 +282,14 @@ def listen():
         'service thread.')
     return
 
-  # Create server
-  server = xmlrpc_server.SimpleXMLRPCServer(
+  # Create server. All of these methods modify the repository, so they run
+  # one at a time, but in worker threads, so that a long one (e.g. writing
+  # the repository) does not stop further requests from being accepted.
+  server = xmlrpc_thread_pool.ThreadPoolXMLRPCServer(
       (demo.IMAGE_REPO_SERVICE_HOST, demo.IMAGE_REPO_SERVICE_PORT),
+      workers=demo.XMLRPC_SERVER_WORKERS,
+      max_queued=demo.XMLRPC_SERVER_MAX_QUEUED,
+      concurrent_methods=[],
       requestHandler=RequestHandler, allow_none=True)
 
   # Register functions that can be called via XML-RPC, allowing users to add
@@ -357,6 +357,10 @@ def mitm_arbitrary_package_attack(target_filepath):
   if os.path.exists(full_target_filepath):
     shutil.copy(full_target_filepath, backup_target_filepath)
 
+  # The target file may be a hard link to a file in the target store, shared
+  # with other repositories, so replace it rather than writing through it.
+  os.remove(full_target_filepath)
+
   with open(full_target_filepath, 'w') as fobj:
     fobj.write('EVIL UPDATE: ARBITRARY PACKAGE ATTACK TO BE DELIVERED FROM '
         'MITM / bad mirror (no keys compromised).')
@@ -585,17 +589,17 @@ def revoke_compromised_keys():
 
 def kill_server():
   """
-  Kills the forked process that is hosting the Image Repository via
-  Python's simple HTTP server. This does not affect anything in the repository
-  at all. host() can be run afterwards to begin hosting again.
+  Stops the HTTP server that is hosting the Image Repository. This does not
+  affect anything in the repository at all. host() can be run afterwards to
+  begin hosting again.
   """
-  global server_process
-  if server_process is None:
-    print(LOG_PREFIX + 'No repository hosting process to stop.')
+  global repo_server
+  if repo_server is None:
+    print(LOG_PREFIX + 'No repository hosting server to stop.')
     return
 
   else:
-    print(LOG_PREFIX + 'Killing repository hosting process with pid: ' +
-        str(server_process.pid))
-    server_process.kill()
-    server_process = None
+    print(LOG_PREFIX + 'Stopping repository hosting server.')
+    repo_server.shutdown()
+    repo_server.server_close()
+    repo_server = None
@@ -43,6 +43,7 @@ from six.moves import xmlrpc_client
 from six.moves import xmlrpc_server
 from six.moves import range
 import socket # to catch listening failures from six's xmlrpc server
+import demo.xmlrpc_thread_pool as xmlrpc_thread_pool
 
 # Allow tab completion in the interactive Python shell.
 import readline, rlcompleter
@@ -68,6 +69,14 @@ _ecu_serial = 'INFOdemocar'
 
 
 
+# The methods of the Primary's XML-RPC interface (see listen()) that may be
+# handled concurrently: those with which Secondaries read images, metadata and
+# time attestations. The rest, which register Secondaries and their ECU
+# Manifests with the Primary, run one at a time.
+PRIMARY_CONCURRENT_METHODS = [
+    'get_image', 'get_image_info', 'get_image_chunk', 'get_metadata',
+    'get_time_attestation_for_ecu', 'update_exists_for_ecu']
+
 # Dynamic globals
 current_firmware_fileinfo = {}
 primary_ecu = None
@@ -141,7 +150,8 @@ def clean_slate(
       ecu_serial=_ecu_serial,
       primary_key=ecu_key,
       time=clock,
-      timeserver_public_key=key_timeserver_pub)
+      timeserver_public_key=key_timeserver_pub,
+      download_workers=demo.PRIMARY_DOWNLOAD_WORKERS)
 
 
   if listener_thread is None:
@@ -458,6 +468,97 @@ def get_image_for_ecu(ecu_serial):
 
 
 
+def get_image_info_for_ecu(ecu_serial):
+  """
+  Intended to be called via XMLRPC by the Secondary client, before it
+  retrieves its image in chunks using get_image_chunk_for_ecu(). Unlike
+  get_image_for_ecu(), this does not read the image.
+
+  Returns None if this Primary has no update for the given ECU, or else a
+  dictionary:
+     'filename': the filename of the image, relative to the targets directory
+         (as returned by get_image_for_ecu())
+     'length': the length of the image in bytes
+     'image_id': an identifier for the image: a hash of it from the
+         validated target info. The Secondary passes it back with each
+         request for a chunk, so that a transfer interrupted and resumed later
+         never combines parts of different images.
+  """
+  # Ensure serial is correct format & registered
+  primary_ecu._check_ecu_serial(ecu_serial)
+
+  image_fname = primary_ecu.get_image_fname_for_ecu(ecu_serial)
+
+  if image_fname is None:
+    print('ECU Serial ' + repr(ecu_serial) + ' requested an image, but this '
+        'Primary has no update for that ECU.')
+    return None
+
+  relative_fname = os.path.relpath(
+      image_fname, os.path.join(primary_ecu.full_client_dir, 'targets'))
+
+  return {
+      'filename': relative_fname,
+      'length': os.path.getsize(image_fname),
+      'image_id': _get_image_id(ecu_serial)}
+
+
+
+
+
+def get_image_chunk_for_ecu(ecu_serial, image_id, offset, size):
+  """
+  Intended to be called via XMLRPC by the Secondary client, to retrieve part
+  of the image described by get_image_info_for_ecu().
+
+  Returns up to size bytes of the image (and no more than
+  demo.IMAGE_TRANSFER_CHUNK_SIZE), starting at the given offset, in
+  xmlrpc.Binary format. Fewer bytes are returned only at the end of the image.
+
+  Returns None if this Primary no longer has the image identified by image_id
+  for the ECU (e.g. if the Director has since assigned it another), in which
+  case the Secondary should start over.
+
+  <Exceptions>
+    uptane.Error if offset is negative, or is not within the image.
+  """
+  # Ensure serial is correct format & registered
+  primary_ecu._check_ecu_serial(ecu_serial)
+
+  image_fname = primary_ecu.get_image_fname_for_ecu(ecu_serial)
+
+  if image_fname is None or _get_image_id(ecu_serial) != image_id:
+    return None
+
+  with open(image_fname, 'rb') as fobj:
+    image_length = os.fstat(fobj.fileno()).st_size
+    if not isinstance(offset, int) or offset < 0 or offset >= image_length:
+      raise uptane.Error('Requested offset ' + repr(offset) + ' is not '
+          'within the image for ECU ' + repr(ecu_serial) + ', of length ' +
+          str(image_length) + '.')
+
+    fobj.seek(offset)
+    return xmlrpc_client.Binary(
+        fobj.read(max(0, min(size, demo.IMAGE_TRANSFER_CHUNK_SIZE))))
+
+
+
+
+
+def _get_image_id(ecu_serial):
+  """
+  Returns an identifier for the image this Primary has for the given ECU:
+  one of its hashes from the validated target info, which stays the same
+  while the Primary downloads the same image again in later update cycles.
+  """
+  hashes = primary_ecu.assigned_targets[ecu_serial]['fileinfo']['hashes']
+  algorithm = 'sha256' if 'sha256' in hashes else sorted(hashes)[0]
+  return algorithm + '-' + hashes[algorithm]
+
+
+
+
+
 def get_metadata_for_ecu(ecu_serial, force_partial_verification=False):
   """
   Provides the current metadata a Secondary will need to validate updates.
@@ -467,7 +568,10 @@ def get_metadata_for_ecu(ecu_serial, force_partial_verification=False):
   - For Full Verification Secondaries (the norm):
       Send a zip archive of the most recent consistent set of the Primary's
       client metadata directory, containing the current, consistent metadata
-      from all repositories used.
+      from all repositories used. This is the compressed bundle of just the
+      metadata that this Secondary needs, which the Primary keeps in memory
+      (see uptane.clients.primary.Primary.get_metadata_bundle_for_ecu()), or,
+      if there is no bundle for this Secondary yet, the full metadata archive.
 
   - For Partial Verification Secondaries:
       Send the Director's Targets role file.
@@ -492,6 +596,14 @@ def get_metadata_for_ecu(ecu_serial, force_partial_verification=False):
   # Ensure serial is correct format & registered
   primary_ecu._check_ecu_serial(ecu_serial)
 
+  if not force_partial_verification:
+    bundle = primary_ecu.get_metadata_bundle_for_ecu(ecu_serial)
+
+    if bundle is not None:
+      print('Distributing metadata bundle (' + str(len(bundle)) + ' bytes) to '
+          'ECU ' + repr(ecu_serial))
+      return xmlrpc_client.Binary(bundle)
+
   # The filename of the file to return.
   fname = None
 
@@ -589,8 +701,13 @@ def listen():
   last_error = None
   for port in demo.PRIMARY_SERVER_AVAILABLE_PORTS:
     try:
-      server = xmlrpc_server.SimpleXMLRPCServer(
+      # Secondaries' requests for images and metadata are handled
+      # concurrently; see PRIMARY_CONCURRENT_METHODS.
+      server = xmlrpc_thread_pool.ThreadPoolXMLRPCServer(
           (demo.PRIMARY_SERVER_HOST, port),
+          workers=demo.XMLRPC_SERVER_WORKERS,
+          max_queued=demo.XMLRPC_SERVER_MAX_QUEUED,
+          concurrent_methods=PRIMARY_CONCURRENT_METHODS,
           requestHandler=RequestHandler, allow_none=True)
     except socket.error as e:
       print('Failed to bind Primary XMLRPC Listener to port ' + repr(port) +
@@ -641,6 +758,13 @@ def listen():
   # Deployment Considerations document.
   server.register_function(get_image_for_ecu, 'get_image')
 
+  # Secondaries retrieve their images in chunks with these instead of
+  # 'get_image', so that a large image is never held in memory (or encoded in
+  # a single XML-RPC response) as a whole, and an interrupted transfer can be
+  # resumed.
+  server.register_function(get_image_info_for_ecu, 'get_image_info')
+  server.register_function(get_image_chunk_for_ecu, 'get_image_chunk')
+
   server.register_function(get_metadata_for_ecu, 'get_metadata')
 
   # This again is for convenience in the demo. While I don't see an obvious
@@ -30,6 +30,7 @@ import uptane.common # for canonical key construction and signing
 import uptane.clients.secondary as secondary
 from uptane import GREEN, RED, YELLOW, ENDCOLORS
 from demo.uptane_banners import *
+import tuf.formats
 import tuf.keys
 import tuf.repository_tool as rt
 import atexit
@@ -381,16 +382,17 @@ def update_cycle():
     # print_banner(BANNER_NO_UPDATE, color=WHITE+BLACK_BG,
     #     text='Primary reports that there is no update for this ECU.')
     # print(YELLOW + 'Primary reports that there is no update for this ECU.')
-    (image_fname, image) = pserver.get_image(secondary_ecu.ecu_serial)
+    pserver.get_image_info(secondary_ecu.ecu_serial)
     generate_signed_ecu_manifest()
     submit_ecu_manifest_to_primary()
     ecu_result = "no_update"
     return ecu_result
 
-  # Download the image for this ECU from the Primary.
-  (image_fname, image) = pserver.get_image(secondary_ecu.ecu_serial)
+  # Find out which image the Primary has for this ECU. The image itself is
+  # downloaded below, in chunks.
+  image_info = pserver.get_image_info(secondary_ecu.ecu_serial)
 
-  if image is None:
+  if image_info is None:
     print(YELLOW + 'Requested image from Primary but received none. Update '
         'terminated.' + ENDCOLORS)
     attacks_detected += 'Requested image from Primary but received none.\n'
@@ -399,7 +401,9 @@ def update_cycle():
     ecu_result = "request_primary_fail"
     return ecu_result
 
-  elif not secondary_ecu.validated_targets_for_this_ecu:
+  image_fname = image_info['filename']
+
+  if not secondary_ecu.validated_targets_for_this_ecu:
     print(RED + 'Requested and received image from Primary, but metadata '
         'indicates no valid targets from the Director intended for this ECU. '
         'Update terminated.' + ENDCOLORS)
@@ -428,17 +432,11 @@ def update_cycle():
     submit_ecu_manifest_to_primary()
     return ecu_result
 
-  # Write the downloaded image binary data to disk.
-  unverified_targets_dir = os.path.join(CLIENT_DIRECTORY, 'unverified_targets')
-  if not os.path.exists(unverified_targets_dir):
-    os.mkdir(unverified_targets_dir)
-  with open(os.path.join(unverified_targets_dir, image_fname), 'wb') as fobj:
-    fobj.write(image.data)
-
-
-  # Validate the image against the metadata.
+  # Download the image from the Primary to disk, validating it against the
+  # metadata as it arrives.
   try:
-    secondary_ecu.validate_image(image_fname)
+    image_filepath = download_image_from_primary(
+        pserver, image_info, expected_target_info)
   except tuf.DownloadLengthMismatchError:
     # print_banner(
     #     BANNER_DEFENDED, color=WHITE+DARK_BLUE_BG,
@@ -464,6 +462,14 @@ def update_cycle():
     ecu_result = "valid_hash_fail"
     return ecu_result
 
+  if image_filepath is None:
+    print(YELLOW + 'The image the Primary has for this ECU changed during the '
+        'transfer. Update terminated; the new image will be retrieved in the '
+        'next update cycle.' + ENDCOLORS)
+    generate_signed_ecu_manifest()
+    submit_ecu_manifest_to_primary()
+    ecu_result = "request_primary_fail"
+    return ecu_result
 
 
   if secondary_ecu.firmware_fileinfo == expected_target_info:
@@ -476,11 +482,6 @@ def update_cycle():
     ecu_result = "no_update"
     return ecu_result
 
-  # Inspect the contents of 'image_fname' and search for the string: "evil
-  # content".  If this single string is found in any of the images downloaded,
-  # print a BANNER_COMPROMISED banner.
-  image_filepath = os.path.join(CLIENT_DIRECTORY, 'unverified_targets', image_fname)
-
   # Simulate installation. (If the demo eventually uses pictures to move into
   # place or something, here is where to do it.)
   # 1. Move the downloaded image from the unverified targets subdirectory to
@@ -498,28 +499,36 @@ def update_cycle():
   secondary_ecu.firmware_fileinfo = expected_target_info
 
 
-  with open(current_firmware_filepath, 'rb') as file_object:
-    if file_object.read() == b'evil content':
-      # If every safeguard is defeated and a compromised update is delivered, a
-      # real Secondary can't necessarily know it has been compromised, as every
-      # check has passed. For the purposes of the demo, of course, we know when
-      # a compromise has been delivered, and we'll flash a Compromised screen
-      # to indicate a successful attack. We know this has happened because the
-      # demo should include 'evil content' in the file.  This requires,
-      # generally, a compromise of both Image Repo and Director keys.
-      # print_banner(BANNER_COMPROMISED, color=WHITE+RED_BG,
-      #     text='A malicious update has been installed! Arbitrary package attack '
-      #     'successful: this Secondary has been compromised! Image: ' +
-      #     repr(expected_image_fname), sound=WITCH)
-      ecu_result = "compromised"
-
-    else:
-      # print_banner(
-      #     BANNER_UPDATED, color=WHITE+GREEN_BG,
-      #     text='Installed firmware received from Primary that was fully '
-      #     'validated by the Director and Image Repo. Image: ' +
-      #     repr(image_fname), sound=WON)
-      print()
+  # Inspect the contents of 'image_fname' and search for the string: "evil
+  # content".  If this single string is found in any of the images downloaded,
+  # print a BANNER_COMPROMISED banner. (Only an image of that exact length can
+  # match, so no other image is read again.)
+  compromised = False
+  if expected_target_info['fileinfo']['length'] == len(b'evil content'):
+    with open(current_firmware_filepath, 'rb') as file_object:
+      compromised = file_object.read() == b'evil content'
+
+  if compromised:
+    # If every safeguard is defeated and a compromised update is delivered, a
+    # real Secondary can't necessarily know it has been compromised, as every
+    # check has passed. For the purposes of the demo, of course, we know when
+    # a compromise has been delivered, and we'll flash a Compromised screen
+    # to indicate a successful attack. We know this has happened because the
+    # demo should include 'evil content' in the file.  This requires,
+    # generally, a compromise of both Image Repo and Director keys.
+    # print_banner(BANNER_COMPROMISED, color=WHITE+RED_BG,
+    #     text='A malicious update has been installed! Arbitrary package attack '
+    #     'successful: this Secondary has been compromised! Image: ' +
+    #     repr(expected_image_fname), sound=WITCH)
+    ecu_result = "compromised"
+
+  else:
+    # print_banner(
+    #     BANNER_UPDATED, color=WHITE+GREEN_BG,
+    #     text='Installed firmware received from Primary that was fully '
+    #     'validated by the Director and Image Repo. Image: ' +
+    #     repr(image_fname), sound=WON)
+    print()
 
   if expected_target_info['filepath'].endswith('.txt'):
     print('The contents of the newly-installed firmware with filename ' +
@@ -537,6 +546,106 @@ def update_cycle():
 
 
 
+def download_image_from_primary(pserver, image_info, target_info):
+  """
+  Downloads the image described by image_info (as returned by the Primary's
+  'get_image_info' XML-RPC method) from the Primary into this Secondary's
+  unverified targets directory, requesting demo.IMAGE_TRANSFER_CHUNK_SIZE
+  bytes at a time by offset, so that no more than one chunk is held in
+  memory. target_info is the validated target info for the image, whose
+  filepath must match the filename in image_info.
+
+  Each chunk is validated as it arrives by an ImageReceiver (see
+  uptane.clients.secondary), which writes it to a partial file named for the
+  image's hash in the validated target info and renames that into place only
+  once the whole image has been received and matches the validated target
+  info. If a previous transfer of the same image was interrupted, the transfer
+  resumes from the end of its partial file.
+
+  Nothing from the Primary but the filename (which must match target_info)
+  is used in file paths; the image_id in image_info is only sent back to the
+  Primary with each request for a chunk.
+
+  Raises tuf.DownloadLengthMismatchError or tuf.BadHashError if the image
+  does not match the validated target info (as soon as it is longer than it
+  should be, in the former case).
+
+  Returns the path of the downloaded and validated image, or None if the
+  Primary no longer has this image for this ECU.
+  """
+  unverified_targets_dir = os.path.join(CLIENT_DIRECTORY, 'unverified_targets')
+  if not os.path.exists(unverified_targets_dir):
+    os.mkdir(unverified_targets_dir)
+
+  image_fname = image_info['filename']
+  fileinfo = target_info['fileinfo']
+
+  # Name the partial file for the image's trusted hash (preferably SHA-256),
+  # so that a transfer is only ever resumed for the same image.
+  hashes = fileinfo['hashes']
+  hash_algorithm = 'sha256' if 'sha256' in hashes else sorted(hashes)[0]
+  tuf.formats.HEX_SCHEMA.check_match(hashes[hash_algorithm])
+  partial_filepath = os.path.join(unverified_targets_dir, image_fname + '.' +
+      hash_algorithm + '-' + hashes[hash_algorithm] + '.part')
+  length = fileinfo['length']
+
+  # Discard any parts of other images with the same filename.
+  for fname in os.listdir(unverified_targets_dir):
+    if fname.startswith(image_fname + '.') and fname.endswith('.part') and \
+        os.path.join(unverified_targets_dir, fname) != partial_filepath:
+      os.remove(os.path.join(unverified_targets_dir, fname))
+
+  receiver = secondary_ecu.get_image_receiver(image_fname, partial_filepath)
+
+  resumed_from = receiver.length_received
+  start_time = time.time()
+
+  try:
+    while receiver.length_received < length:
+      try:
+        chunk = pserver.get_image_chunk(secondary_ecu.ecu_serial,
+            image_info['image_id'], receiver.length_received,
+            min(demo.IMAGE_TRANSFER_CHUNK_SIZE,
+            length - receiver.length_received))
+      except xmlrpc_client.Fault as e:
+        # The Primary refuses offsets past the end of its image, so its image
+        # is shorter than it should be. Any other fault is an error.
+        if 'is not within the image' not in e.faultString:
+          raise
+        break
+
+      if chunk is None:
+        receiver.abort()
+        return None
+
+      if not chunk.data: # The image is shorter than the Primary said.
+        break
+
+      receiver.write(chunk.data)
+
+  except tuf.DownloadLengthMismatchError:
+    raise
+
+  except:
+    # Keep what has been received, to resume from in the next update cycle.
+    receiver.close()
+    raise
+
+  elapsed = time.time() - start_time
+  transferred = receiver.length_received - resumed_from
+
+  print('Received ' + str(transferred) + ' bytes of image ' +
+      repr(image_fname) + ' from the Primary in ' + '%.2f' % elapsed +
+      ' seconds (' + '%.1f' % (transferred / 1024.0 / max(elapsed, 0.001)) +
+      ' KiB/s)' + (', resuming at byte ' + str(resumed_from)
+      if resumed_from else '') + '.')
+
+  return receiver.commit()
+
+
+
+
+
 def generate_signed_ecu_manifest():
 
   global secondary_ecu
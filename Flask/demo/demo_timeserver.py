@@ -29,6 +29,7 @@ import threading
 from six.moves import xmlrpc_server
 from six.moves import xmlrpc_client # for Binary data encapsulation
 import uptane.services.timeserver as timeserver
+import demo.xmlrpc_thread_pool as xmlrpc_thread_pool
 
 # These two imports are used solely for testing relevant to DER encoding.
 import uptane.encoding.asn1_codec as asn1_codec
@@ -104,9 +105,12 @@ def listen(use_new_keys=False):
   test_demo_timeserver()
 
 
-  # Create server
-  server = xmlrpc_server.SimpleXMLRPCServer(
+  # Create server. Signing time attestations is safe to do concurrently, so
+  # requests from many vehicles are handled at once.
+  server = xmlrpc_thread_pool.ThreadPoolXMLRPCServer(
       (demo.TIMESERVER_HOST, demo.TIMESERVER_PORT),
+      workers=demo.XMLRPC_SERVER_WORKERS,
+      max_queued=demo.XMLRPC_SERVER_MAX_QUEUED,
       requestHandler=RequestHandler)#, allow_none=True)
   #server.register_introspection_functions()
 
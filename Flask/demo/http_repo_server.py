@@ -0,0 +1,268 @@
+"""
+<Program Name>
+  http_repo_server.py
+
+<Purpose>
+  An in-process, threaded HTTP server for the demo's repository directories
+  (the Image Repository and the Director's vehicle repositories), which
+  replaces running Python's simple HTTP server in a separate process.
+
+  Compared to that server, it:
+    - handles each connection in its own thread, and keeps connections open
+      between requests (HTTP/1.1 persistent connections);
+    - sends file contents with socket.sendfile(), which uses os.sendfile() to
+      copy them from the page cache to the socket without passing them
+      through Python, where the platform supports it;
+    - supports single-range Range requests (and If-Range), so that an
+      interrupted image download can be resumed;
+    - sends an ETag with every file, and answers requests whose If-None-Match
+      matches it with 304 Not Modified, so that a client polling unchanged
+      metadata (e.g. timestamp.json) is not sent it again.
+
+  The ETag of a file is derived from its inode number, size and modification
+  time. Repositories publish metadata by writing new files and renaming or
+  linking them into place (see demo.demo_director.write_to_live), which always
+  changes at least one of these.
+
+  Files are looked up in the directory when each request arrives, following
+  symbolic links, so a repository whose live metadata directory is switched
+  by a symlink flip is served consistently. Directory listings are not
+  provided.
+
+  Use:
+    import demo.http_repo_server as http_repo_server
+
+    server = http_repo_server.serve_directory(repo_dir, host, port)
+    ...
+    server.shutdown()
+    server.server_close()
+
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import re
+import posixpath
+import threading
+import email.utils
+
+from six.moves import BaseHTTPServer
+from six.moves import SimpleHTTPServer
+from six.moves import socketserver
+from six.moves.urllib.parse import unquote, urlsplit
+
+# How long, in seconds, an idle persistent connection is kept open.
+KEEP_ALIVE_TIMEOUT = 30
+
+# The size of the chunks in which file contents are sent where
+# socket.sendfile() is not available (e.g. in Python 2).
+CHUNK_SIZE = 64 * 1024
+
+_RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+
+class RepositoryRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+  """
+  Serves GET and HEAD requests for files in the server's root_dir. See the
+  module docstring.
+  """
+
+  protocol_version = 'HTTP/1.1'
+
+  timeout = KEEP_ALIVE_TIMEOUT
+
+
+
+  def do_GET(self):
+    self._send_file(send_body=True)
+
+
+
+  def do_HEAD(self):
+    self._send_file(send_body=False)
+
+
+
+  def translate_path(self, path):
+    """
+    Returns the filesystem path in root_dir for the given URL path, ignoring
+    any query or fragment and any '.' or '..' components.
+    """
+    path = posixpath.normpath(unquote(urlsplit(path).path))
+
+    filepath = self.server.root_dir
+    for component in path.split('/'):
+      if component and component not in (os.curdir, os.pardir) and \
+          os.path.dirname(component) == '':
+        filepath = os.path.join(filepath, component)
+
+    return filepath
+
+
+
+  def log_message(self, format, *args):
+    # Like the separate server process this replaces (whose output was not
+    # shown), do not print a line for every request.
+    pass
+
+
+
+  def _send_file(self, send_body):
+
+    filepath = self.translate_path(self.path)
+
+    try:
+      fileobj = open(filepath, 'rb')
+    except (IOError, OSError): # Including if it is a directory.
+      self.send_error(404, 'File not found')
+      return
+
+    with fileobj:
+      file_stat = os.fstat(fileobj.fileno())
+      size = file_stat.st_size
+      etag = '"%x-%x-%x"' % (
+          file_stat.st_ino, size, int(file_stat.st_mtime * 1000000))
+
+      # Conditional requests: the client already has this version of the file.
+      if_none_match = self.headers.get('If-None-Match')
+      if if_none_match is not None and (if_none_match.strip() == '*' or
+          etag in [tag.strip() for tag in if_none_match.split(',')]):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        return
+
+      start, end = 0, size - 1
+      status = 200
+
+      range_header = self.headers.get('Range')
+      if_range = self.headers.get('If-Range')
+      if range_header is not None and (if_range is None or if_range == etag):
+        byte_range = self._parse_range(range_header, size)
+
+        if byte_range is False:
+          self.send_response(416)
+          self.send_header('Content-Range', 'bytes */' + str(size))
+          self.send_header('Content-Length', '0')
+          self.end_headers()
+          return
+
+        elif byte_range is not None:
+          start, end = byte_range
+          status = 206
+
+      length = end - start + 1
+
+      self.send_response(status)
+      self.send_header('Content-Type', self.guess_type(filepath))
+      self.send_header('Content-Length', str(length))
+      self.send_header('Last-Modified',
+          email.utils.formatdate(file_stat.st_mtime, usegmt=True))
+      self.send_header('ETag', etag)
+      self.send_header('Cache-Control', 'no-cache')
+      self.send_header('Accept-Ranges', 'bytes')
+      if status == 206:
+        self.send_header('Content-Range',
+            'bytes ' + str(start) + '-' + str(end) + '/' + str(size))
+      self.end_headers()
+
+      if send_body and length > 0:
+        self._send_file_contents(fileobj, start, length)
+
+
+
+  def _parse_range(self, range_header, size):
+    """
+    Returns (start, end) for a satisfiable single byte range, False for an
+    unsatisfiable one, or None if the header is not understood (e.g. it has
+    several ranges), in which case the whole file is sent.
+    """
+    match = _RANGE_PATTERN.match(range_header.strip())
+    if match is None:
+      return None
+
+    first, last = match.groups()
+
+    if first == '' and last == '':
+      return None
+
+    elif first == '': # A suffix range: the last so many bytes.
+      if int(last) == 0:
+        return False
+      return max(size - int(last), 0), size - 1
+
+    elif int(first) >= size:
+      return False
+
+    elif last == '':
+      return int(first), size - 1
+
+    elif int(last) < int(first):
+      return None
+
+    else:
+      return int(first), min(int(last), size - 1)
+
+
+
+  def _send_file_contents(self, fileobj, start, length):
+
+    # Anything buffered (the headers) has to be written before the socket is
+    # written to directly.
+    self.wfile.flush()
+
+    if hasattr(self.connection, 'sendfile'):
+      self.connection.sendfile(fileobj, start, length)
+
+    else:
+      fileobj.seek(start)
+      while length > 0:
+        chunk = fileobj.read(min(CHUNK_SIZE, length))
+        if not chunk:
+          break
+        self.wfile.write(chunk)
+        length -= len(chunk)
+
+
+
+
+
+class ThreadingRepositoryServer(
+    socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """
+  An HTTP server that serves the files in root_dir, handling each connection
+  in a new thread.
+  """
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, server_address, root_dir):
+    self.root_dir = os.path.abspath(root_dir)
+    BaseHTTPServer.HTTPServer.__init__(
+        self, server_address, RepositoryRequestHandler)
+
+
+
+
+
+def serve_directory(root_dir, host, port):
+  """
+  <Purpose>
+    Starts serving the files in root_dir over HTTP on the given host and port,
+    in a daemon thread.
+
+  <Returns>
+    The ThreadingRepositoryServer. Call its shutdown() and then its
+    server_close() method to stop serving.
+  """
+  server = ThreadingRepositoryServer((host, port), root_dir)
+
+  server_thread = threading.Thread(target=server.serve_forever)
+  server_thread.setDaemon(True)
+  server_thread.start()
+
+  return server
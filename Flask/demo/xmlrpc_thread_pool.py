@@ -0,0 +1,272 @@
+"""
+<Program Name>
+  xmlrpc_thread_pool.py
+
+<Purpose>
+  A concurrent XML-RPC server for the demo's Director, Image Repository,
+  Timeserver and Primary services.
+
+  xmlrpc_server.SimpleXMLRPCServer handles one request at a time, so one slow
+  request (e.g. a large Vehicle Manifest uploaded over a slow link) delays
+  every other client. ThreadPoolXMLRPCServer accepts connections in the thread
+  that calls serve_forever(), as SimpleXMLRPCServer does, but hands each one
+  to a bounded pool of worker threads.
+
+  Methods that are not safe to run concurrently (e.g. those that modify and
+  write repositories) can still be run one at a time: see the
+  concurrent_methods argument below.
+
+  The server keeps statistics on its queue depth and on the latency of each
+  method, which are available through get_stats(), and to clients through
+  the XML-RPC method 'get_server_stats'.
+
+  Use:
+    import demo.xmlrpc_thread_pool as xmlrpc_thread_pool
+
+    server = xmlrpc_thread_pool.ThreadPoolXMLRPCServer(
+        (host, port), workers=8, requestHandler=RequestHandler,
+        allow_none=True)
+    server.register_function(...)
+    server.serve_forever()
+
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import time
+import concurrent.futures
+
+from six.moves import xmlrpc_server
+
+
+
+class ThreadPoolXMLRPCServer(xmlrpc_server.SimpleXMLRPCServer):
+  """
+  An XML-RPC server that handles requests in a pool of worker threads.
+
+  Fields:
+
+    workers
+      The number of worker threads. If None or 1, requests are handled one at
+      a time in the thread that calls serve_forever(), as by
+      SimpleXMLRPCServer, though statistics are still kept.
+
+    max_queued
+      If not None, the server stops accepting connections while this many
+      requests are waiting for a worker, so that a flood of requests waits in
+      the listen backlog rather than in memory.
+
+    concurrent_methods
+      If None, all methods may run concurrently. Otherwise, only the methods
+      with these names may; all other methods run one at a time (though still
+      in worker threads, and concurrently with the methods named here).
+
+  """
+
+  def __init__(self, addr, workers=None, max_queued=None,
+      concurrent_methods=None, **kwargs):
+
+    # SimpleXMLRPCServer is an old-style class in Python 2, so super() cannot
+    # be used.
+    xmlrpc_server.SimpleXMLRPCServer.__init__(self, addr, **kwargs)
+
+    self.workers = workers
+    self.max_queued = max_queued
+    self.concurrent_methods = None if concurrent_methods is None else \
+        set(concurrent_methods)
+
+    if workers is not None and workers > 1:
+      self._executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=workers)
+    else:
+      self._executor = None
+
+    if max_queued is not None and self._executor is not None:
+      self._queue_slots = threading.BoundedSemaphore(max_queued)
+    else:
+      self._queue_slots = None
+
+    # Held while running each method not in concurrent_methods.
+    self._serial_lock = threading.Lock()
+
+    # Guards the statistics below.
+    self._stats_lock = threading.Lock()
+    self._queued = 0
+    self._max_queued_seen = 0
+    self._active = 0
+    self._requests = 0
+    self._total_queue_time = 0.0
+    # Maps each method name to [calls, errors, total time, max time].
+    self._method_stats = {}
+
+    self.register_function(self.get_stats, 'get_server_stats')
+
+
+
+
+
+  def process_request(self, request, client_address):
+    """
+    Called by serve_forever() for each connection accepted. Hands the request
+    to a worker thread, or, if there are no worker threads, handles it.
+    """
+    if self._executor is None:
+      self._handle_request(request, client_address, time.time())
+      return
+
+    if self._queue_slots is not None:
+      # Blocks accepting further connections while max_queued are waiting.
+      self._queue_slots.acquire()
+
+    with self._stats_lock:
+      self._queued += 1
+      self._max_queued_seen = max(self._max_queued_seen, self._queued)
+
+    self._executor.submit(
+        self._handle_request, request, client_address, time.time())
+
+
+
+
+
+  def _handle_request(self, request, client_address, queued_time):
+
+    with self._stats_lock:
+      if self._executor is not None:
+        self._queued -= 1
+      self._active += 1
+      self._requests += 1
+      self._total_queue_time += time.time() - queued_time
+
+    if self._queue_slots is not None:
+      self._queue_slots.release()
+
+    try:
+      self.finish_request(request, client_address)
+    except Exception:
+      self.handle_error(request, client_address)
+    finally:
+      self.shutdown_request(request)
+      with self._stats_lock:
+        self._active -= 1
+
+
+
+
+
+  def _dispatch(self, method, params):
+    """
+    Runs the registered function for the given method, as SimpleXMLRPCServer
+    does, one at a time if it is not in concurrent_methods, and records how
+    long it took.
+    """
+    start_time = time.time()
+    succeeded = False
+
+    try:
+      if self.concurrent_methods is None or method == 'get_server_stats' or \
+          method in self.concurrent_methods:
+        result = xmlrpc_server.SimpleXMLRPCServer._dispatch(
+            self, method, params)
+      else:
+        with self._serial_lock:
+          result = xmlrpc_server.SimpleXMLRPCServer._dispatch(
+              self, method, params)
+      succeeded = True
+      return result
+
+    finally:
+      elapsed = time.time() - start_time
+      with self._stats_lock:
+        # Calls to methods that are not registered share one entry, so that
+        # clients cannot add an entry for every name they send.
+        if not self._is_registered_method(method):
+          method = '<unknown>'
+        stats = self._method_stats.setdefault(method, [0, 0, 0.0, 0.0])
+        stats[0] += 1
+        if not succeeded:
+          stats[1] += 1
+        stats[2] += elapsed
+        stats[3] = max(stats[3], elapsed)
+
+
+
+
+
+  def _is_registered_method(self, method):
+    """
+    Returns True if the given method name is that of a function registered
+    with this server, or of a method of its registered instance, if any.
+    """
+    if method in self.funcs:
+      return True
+
+    if self.instance is None:
+      return False
+
+    try:
+      xmlrpc_server.resolve_dotted_attribute(
+          self.instance, method, self.allow_dotted_names)
+    except AttributeError:
+      return False
+
+    return True
+
+
+
+
+
+  def get_stats(self):
+    """
+    <Purpose>
+      Returns statistics on the requests this server has handled.
+
+    <Returns>
+      A dictionary:
+        'workers': the number of worker threads (see workers)
+        'queued': the number of requests waiting for a worker thread
+        'max_queued': the largest number of requests that have been waiting
+            for a worker thread at once
+        'active': the number of requests being handled
+        'requests': the number of requests that have been handled, or are
+            being handled
+        'mean_queue_time': the mean time requests waited for a worker thread,
+            in seconds
+        'methods': a dictionary mapping the name of each method called to a
+            dictionary of statistics on its calls: 'calls', 'errors',
+            'total_time', 'mean_time' and 'max_time', with times in seconds
+            (including any time spent waiting to run one at a time). Calls
+            to methods that are not registered are counted under
+            '<unknown>'.
+    """
+    with self._stats_lock:
+      methods = {}
+      for method, (calls, errors, total_time, max_time) in \
+          self._method_stats.items():
+        methods[method] = {
+            'calls': calls,
+            'errors': errors,
+            'total_time': total_time,
+            'mean_time': total_time / calls,
+            'max_time': max_time}
+
+      return {
+          'workers': self.workers or 1,
+          'queued': self._queued,
+          'max_queued': self._max_queued_seen,
+          'active': self._active,
+          'requests': self._requests,
+          'mean_queue_time': self._total_queue_time / self._requests
+              if self._requests else 0.0,
+          'methods': methods}
+
+
+
+
+
+  def server_close(self):
+    """Closes the listening socket, then waits for queued requests."""
+    xmlrpc_server.SimpleXMLRPCServer.server_close(self)
+    if self._executor is not None:
+      self._executor.shutdown(wait=True)
@@ -17,6 +17,9 @@ import os.path
 import shutil # for rmtree
 import copy
 import json
+import io
+import hashlib
+import threading
 
 import tuf
 import tuf.formats
@@ -337,6 +340,198 @@ class TestCommon(unittest.TestCase):
 
 
 
+  def test_verified_signature_cache(self):
+    """
+    Tests the cache of verified signatures used by
+    verify_signature_over_metadata().
+    """
+    if tuf.conf.METADATA_FORMAT == 'json':
+      sample_ecu_manifest = json.load(open(os.path.join(SAMPLES_DIR,
+          'sample_ecu_manifest_TCUdemocar.json')))
+    else:
+      assert tuf.conf.METADATA_FORMAT == 'der' # Or test code is broken/old.
+      sample_ecu_manifest = \
+          asn1_codec.convert_signed_der_to_dersigned_json(open(os.path.join(
+          SAMPLES_DIR, 'sample_ecu_manifest_TCUdemocar.der'), 'rb').read(),
+          DATATYPE_ECU_MANIFEST)
+
+    signature = sample_ecu_manifest['signatures'][0]
+    signed = sample_ecu_manifest['signed']
+
+    common.clear_verified_signature_cache()
+    self.assertEqual({'hits': 0, 'misses': 0}, common.signature_cache_stats)
+
+    # The first check is a miss, and later checks of the same signature over
+    # the same data by the same key are hits.
+    self.assertTrue(common.verify_signature_over_metadata(
+        keys_pub['secondary'], signature, signed, DATATYPE_ECU_MANIFEST))
+    self.assertEqual({'hits': 0, 'misses': 1}, common.signature_cache_stats)
+    self.assertTrue(common.verify_signature_over_metadata(
+        keys_pub['secondary'], signature, signed, DATATYPE_ECU_MANIFEST))
+    self.assertTrue(common.verify_signature_over_metadata(
+        keys_pub['secondary'], signature, copy.deepcopy(signed),
+        DATATYPE_ECU_MANIFEST))
+    self.assertEqual({'hits': 2, 'misses': 1}, common.signature_cache_stats)
+
+    # A different key, or different data, must not hit the cached result.
+    self.assertFalse(common.verify_signature_over_metadata(
+        keys_pub['primary'], signature, signed, DATATYPE_ECU_MANIFEST))
+    modified = copy.deepcopy(signed)
+    modified['attacks_detected'] = 'something else'
+    self.assertFalse(common.verify_signature_over_metadata(
+        keys_pub['secondary'], signature, modified, DATATYPE_ECU_MANIFEST))
+    self.assertEqual({'hits': 2, 'misses': 3}, common.signature_cache_stats)
+
+    # Failures are not cached.
+    self.assertFalse(common.verify_signature_over_metadata(
+        keys_pub['secondary'], signature, modified, DATATYPE_ECU_MANIFEST))
+    self.assertEqual({'hits': 2, 'misses': 4}, common.signature_cache_stats)
+
+    # The cache is bounded.
+    size = common.VERIFIED_SIGNATURE_CACHE_SIZE
+    try:
+      common.VERIFIED_SIGNATURE_CACHE_SIZE = 1
+      self.assertTrue(common.verify_signature_over_metadata(
+          keys_pub['secondary'], signature, signed, DATATYPE_ECU_MANIFEST))
+      self.assertEqual(1, len(common._verified_signatures))
+    finally:
+      common.VERIFIED_SIGNATURE_CACHE_SIZE = size
+
+    common.clear_verified_signature_cache()
+    self.assertFalse(common._verified_signatures)
+    self.assertEqual({'hits': 0, 'misses': 0}, common.signature_cache_stats)
+
+
+
+
+
+  def test_verify_signatures_over_metadata(self):
+    """
+    Tests the batch signature verification function,
+    verify_signatures_over_metadata(), with and without an executor.
+    """
+    import concurrent.futures
+
+    if tuf.conf.METADATA_FORMAT == 'json':
+      sample_ecu_manifest = json.load(open(os.path.join(SAMPLES_DIR,
+          'sample_ecu_manifest_TCUdemocar.json')))
+      sample_time_attestation = json.load(open(os.path.join(
+          SAMPLES_DIR, 'sample_timeserver_attestation.json')))
+    else:
+      assert tuf.conf.METADATA_FORMAT == 'der' # Or test code is broken/old.
+      sample_ecu_manifest = \
+          asn1_codec.convert_signed_der_to_dersigned_json(open(os.path.join(
+          SAMPLES_DIR, 'sample_ecu_manifest_TCUdemocar.der'), 'rb').read(),
+          DATATYPE_ECU_MANIFEST)
+      sample_time_attestation = \
+          asn1_codec.convert_signed_der_to_dersigned_json(open(os.path.join(
+          SAMPLES_DIR, 'sample_timeserver_attestation.der'), 'rb').read(),
+          DATATYPE_TIME_ATTESTATION)
+
+    modified_ecu_manifest = copy.deepcopy(sample_ecu_manifest)
+    modified_ecu_manifest['signed']['attacks_detected'] = 'something else'
+
+    requests = [
+        (keys_pub['secondary'], sample_ecu_manifest['signatures'][0],
+            sample_ecu_manifest['signed'], DATATYPE_ECU_MANIFEST),
+        (keys_pub['primary'], sample_ecu_manifest['signatures'][0],
+            sample_ecu_manifest['signed'], DATATYPE_ECU_MANIFEST),
+        (keys_pub['timeserver'], sample_time_attestation['signatures'][0],
+            sample_time_attestation['signed'], DATATYPE_TIME_ATTESTATION),
+        (keys_pub['secondary'], modified_ecu_manifest['signatures'][0],
+            modified_ecu_manifest['signed'], DATATYPE_ECU_MANIFEST)]
+    expected = [True, False, True, False]
+
+    self.assertEqual([], common.verify_signatures_over_metadata([]))
+
+    common.clear_verified_signature_cache()
+    self.assertEqual(expected, common.verify_signatures_over_metadata(requests))
+
+    # The second time, the valid signatures come from the cache.
+    self.assertEqual(expected, common.verify_signatures_over_metadata(requests))
+    self.assertEqual({'hits': 2, 'misses': 6}, common.signature_cache_stats)
+
+    common.clear_verified_signature_cache()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+      self.assertEqual(expected, common.verify_signatures_over_metadata(
+          requests, executor=executor))
+
+    # Expect the same format checks as verify_signature_over_metadata.
+    with self.assertRaises(tuf.FormatError):
+      common.verify_signatures_over_metadata([(keys_pub['secondary'],
+          'not a signature', sample_ecu_manifest['signed'],
+          DATATYPE_ECU_MANIFEST)])
+
+    common.clear_verified_signature_cache()
+
+
+
+
+
+  def test_compute_file_hashes(self):
+
+    data = b'abc' * 1000
+    chunk_size = common.FILE_HASH_CHUNK_SIZE
+    common.FILE_HASH_CHUNK_SIZE = 100
+
+    try:
+      length, hashes = common.compute_file_hashes(
+          io.BytesIO(data), ['sha256', 'sha512', 'sm3'])
+
+    finally:
+      common.FILE_HASH_CHUNK_SIZE = chunk_size
+
+    self.assertEqual(len(data), length)
+    self.assertEqual(hashlib.sha256(data).hexdigest(), hashes['sha256'])
+    self.assertEqual(hashlib.sha512(data).hexdigest(), hashes['sha512'])
+    self.assertEqual(asn1_codec.SM3(data).hexdigest(), hashes['sm3'])
+
+    self.assertEqual((3, {'sm3': '66c7f0f462eeedd9d1f2d46bdc10e4e2'
+        '4167c4875cf2f7a2297da02b8f4ba8e0'}),
+        common.compute_file_hashes(io.BytesIO(b'abc'), ['sm3']))
+
+    with self.assertRaises(tuf.UnsupportedAlgorithmError):
+      common.compute_file_hashes(io.BytesIO(data), ['not_a_hash_algorithm'])
+
+
+
+
+
+  def test_get_repository_hash_algorithms(self):
+
+    metadata_format = tuf.conf.METADATA_FORMAT
+    repository_hash_algorithms = tuf.conf.REPOSITORY_HASH_ALGORITHMS
+
+    try:
+      # SM3 is never listed with DER metadata, whatever the configuration.
+      tuf.conf.METADATA_FORMAT = 'der'
+      tuf.conf.REPOSITORY_HASH_ALGORITHMS = ['sha256', 'sha512', 'sm3']
+      self.assertEqual(
+          ['sha256', 'sha512'], common.get_repository_hash_algorithms())
+
+      # With JSON metadata, it is listed where hashlib supports it.
+      tuf.conf.METADATA_FORMAT = 'json'
+      expected = ['sha256', 'sha512']
+      if 'sm3' in hashlib.algorithms_available:
+        expected.append('sm3')
+      self.assertEqual(expected, common.use_repository_hash_algorithms())
+      self.assertEqual(expected, tuf.conf.REPOSITORY_HASH_ALGORITHMS)
+
+      # The format in effect when called is the one that counts.
+      tuf.conf.METADATA_FORMAT = 'der'
+      self.assertEqual(
+          ['sha256', 'sha512'], common.use_repository_hash_algorithms())
+      self.assertEqual(
+          ['sha256', 'sha512'], tuf.conf.REPOSITORY_HASH_ALGORITHMS)
+
+    finally:
+      tuf.conf.METADATA_FORMAT = metadata_format
+      tuf.conf.REPOSITORY_HASH_ALGORITHMS = repository_hash_algorithms
+
+
+
+
+
   def test_canonical_key_funcs(self):
     """
     Tests:
@@ -396,6 +591,86 @@ class TestCommon(unittest.TestCase):
 
 
 
+  def test_refresh_repositories(self):
+
+    class FakeUpdater(object):
+      """
+      Stands in for a multi-repository tuf.client.updater.Updater, recording
+      the repositories refreshed. Each refresh waits until all repositories
+      are being refreshed at once, or until timed out.
+      """
+      def __init__(self, repository_names, failing_repository_names=()):
+        self.repositories = dict((name, None) for name in repository_names)
+        self.failing_repository_names = failing_repository_names
+        self.refreshed = []
+        self.all_refreshing = threading.Barrier(len(repository_names)) \
+            if hasattr(threading, 'Barrier') else None
+        self.concurrent = True
+
+      def refresh(self, repo_name):
+        self.refreshed.append(repo_name)
+        if self.all_refreshing is not None:
+          try:
+            self.all_refreshing.wait(timeout=5)
+          except threading.BrokenBarrierError:
+            self.concurrent = False
+        if repo_name in self.failing_repository_names:
+          raise tuf.NoWorkingMirrorError({repo_name: Exception(repo_name)})
+
+
+    # By default, repositories are refreshed one at a time, the Director
+    # first.
+    self.assertFalse(common.PARALLEL_METADATA_REFRESH)
+    updater = FakeUpdater(['imagerepo', 'director'])
+    updater.all_refreshing = None
+    common.refresh_repositories(updater, 'director')
+    self.assertEqual(['director', 'imagerepo'], updater.refreshed)
+
+    # All repositories are refreshed, concurrently.
+    updater = FakeUpdater(['imagerepo', 'director', 'imagerepo2'])
+    self.assertEqual([None, None, None],
+        common.refresh_repositories(updater, 'director', in_parallel=True))
+    self.assertEqual(
+        sorted(['director', 'imagerepo', 'imagerepo2']),
+        sorted(updater.refreshed))
+    self.assertTrue(updater.concurrent)
+
+    # One at a time, the Director is refreshed first.
+    updater = FakeUpdater(['imagerepo', 'director'])
+    updater.all_refreshing = None
+    common.refresh_repositories(updater, 'director', in_parallel=False)
+    self.assertEqual(['director', 'imagerepo'], updater.refreshed)
+
+    # The values returned by a given refresh function are returned, with the
+    # Director's first.
+    updater = FakeUpdater(['imagerepo', 'director'])
+    self.assertEqual(['refreshed director', 'refreshed imagerepo'],
+        common.refresh_repositories(updater, 'director',
+        lambda repository_name: 'refreshed ' + repository_name,
+        in_parallel=True))
+
+    # If several refreshes fail, the Director's error is raised, but only once
+    # all refreshes have finished.
+    updater = FakeUpdater(
+        ['imagerepo', 'director'], ['imagerepo', 'director'])
+    with self.assertRaises(tuf.NoWorkingMirrorError) as context:
+      common.refresh_repositories(updater, 'director', in_parallel=True)
+    self.assertIn('director', context.exception.mirror_errors)
+    self.assertEqual(
+        sorted(['director', 'imagerepo']), sorted(updater.refreshed))
+
+    updater = FakeUpdater(['imagerepo', 'director'], ['imagerepo'])
+    with self.assertRaises(tuf.NoWorkingMirrorError) as context:
+      common.refresh_repositories(updater, 'director', in_parallel=True)
+    self.assertIn('imagerepo', context.exception.mirror_errors)
+
+    with self.assertRaises(tuf.FormatError):
+      common.refresh_repositories(updater, 5)
+
+
+
+
+
   def test_create_directory_structure_for_client(self):
     """
     Tests common.create_directory_structure_for_client()
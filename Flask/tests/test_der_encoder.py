@@ -27,6 +27,7 @@ from pyasn1.type import tag, univ
 
 import sys # to test Python version 2 vs 3, for byte string behavior
 import hashlib
+import binascii
 import unittest
 import os
 import time
@@ -504,6 +505,174 @@ class TestASN1(unittest.TestCase):
 
 
 
+  def test_30_compiled_codec_matches_pyasn1(self):
+    """
+    Tests that the compiled codecs (asn1_codec.USE_COMPILED_CODEC) produce the
+    same DER and the same Python dictionaries as conversion through pyasn1.
+    """
+    samples_dir = os.path.join(uptane.WORKING_DIR, 'samples')
+    samples = [
+        ('sample_timeserver_attestation.der', DATATYPE_TIME_ATTESTATION),
+        ('sample_ecu_manifest_TCUdemocar.der', DATATYPE_ECU_MANIFEST),
+        ('sample_vehicle_version_manifest_democar.der',
+            DATATYPE_VEHICLE_MANIFEST)]
+
+    def convert(der_data, datatype):
+      pydict = asn1_codec.convert_signed_der_to_dersigned_json(
+          der_data, datatype)
+      return (pydict,
+          asn1_codec.convert_signed_metadata_to_der(pydict, datatype),
+          asn1_codec.convert_signed_metadata_to_der(
+              pydict, datatype, only_signed=True))
+
+    try:
+      for fname, datatype in samples:
+        with open(os.path.join(samples_dir, fname), 'rb') as fobj:
+          der_data = fobj.read()
+
+        asn1_codec.USE_COMPILED_CODEC = False
+        pyasn1_results = convert(der_data, datatype)
+        asn1_codec.USE_COMPILED_CODEC = True
+        compiled_results = convert(der_data, datatype)
+
+        self.assertEqual(pyasn1_results, compiled_results)
+        self.assertEqual(der_data, compiled_results[1])
+
+      for signable, datatype in [
+          (SAMPLE_ECU_MANIFEST_SIGNABLE, DATATYPE_ECU_MANIFEST),
+          (SAMPLE_VEHICLE_MANIFEST_SIGNABLE, DATATYPE_VEHICLE_MANIFEST)]:
+        asn1_codec.USE_COMPILED_CODEC = False
+        pyasn1_der = asn1_codec.convert_signed_metadata_to_der(
+            signable, datatype)
+        asn1_codec.USE_COMPILED_CODEC = True
+        self.assertEqual(pyasn1_der,
+            asn1_codec.convert_signed_metadata_to_der(signable, datatype))
+
+      # Malformed DER is rejected.
+      with self.assertRaises(uptane.FailedToDecodeASN1DER):
+        asn1_codec.convert_signed_der_to_dersigned_json(
+            der_data[:-1], DATATYPE_VEHICLE_MANIFEST)
+      with self.assertRaises(uptane.FailedToDecodeASN1DER):
+        asn1_codec.convert_signed_der_to_dersigned_json(
+            der_data, DATATYPE_ECU_MANIFEST)
+
+      # Values violating constraints in the ASN.1 definitions are rejected.
+      bad_manifest = copy.deepcopy(SAMPLE_ECU_MANIFEST_SIGNABLE)
+      bad_manifest['signed']['ecu_serial'] = 'x' * 257
+      with self.assertRaises(uptane.FailedToEncodeASN1DER):
+        asn1_codec.convert_signed_metadata_to_der(
+            bad_manifest, DATATYPE_ECU_MANIFEST)
+
+    finally:
+      asn1_codec.USE_COMPILED_CODEC = True
+
+
+
+
+
+  def test_31_convert_keeping_signed_der(self):
+    """
+    Tests that the 'signed' portion of DER metadata and its digest, as kept by
+    the decoder, match a fresh encoding of the decoded 'signed' portion, and
+    that signature checks over them give the same result.
+    """
+    samples_dir = os.path.join(uptane.WORKING_DIR, 'samples')
+    samples = [
+        ('sample_timeserver_attestation.der', DATATYPE_TIME_ATTESTATION),
+        ('sample_ecu_manifest_TCUdemocar.der', DATATYPE_ECU_MANIFEST),
+        ('sample_vehicle_version_manifest_democar.der',
+            DATATYPE_VEHICLE_MANIFEST)]
+    primary_key = demo.import_public_key('primary')
+
+    try:
+      for use_compiled_codec in [True, False]:
+        asn1_codec.USE_COMPILED_CODEC = use_compiled_codec
+
+        for fname, datatype in samples:
+          with open(os.path.join(samples_dir, fname), 'rb') as fobj:
+            der_data = fobj.read()
+
+          pydict, der_signed, der_signed_digest = \
+              asn1_codec.convert_signed_der_to_dersigned_json_keeping_signed_der(
+              der_data, datatype)
+
+          self.assertEqual(
+              asn1_codec.convert_signed_der_to_dersigned_json(
+              der_data, datatype), pydict)
+          self.assertEqual(asn1_codec.convert_signed_metadata_to_der(
+              pydict, datatype, only_signed=True), der_signed)
+          self.assertEqual(
+              hashlib.sha256(der_signed).digest(), der_signed_digest)
+
+        # The vehicle manifest sample is signed by the Primary.
+        for encoded_data in [None, der_signed_digest]:
+          self.assertTrue(uptane.common.verify_signature_over_metadata(
+              primary_key, pydict['signatures'][0], pydict['signed'],
+              DATATYPE_VEHICLE_MANIFEST, metadata_format='der',
+              encoded_data=encoded_data))
+        self.assertFalse(uptane.common.verify_signature_over_metadata(
+            primary_key, pydict['signatures'][0], pydict['signed'],
+            DATATYPE_VEHICLE_MANIFEST, metadata_format='der',
+            encoded_data=hashlib.sha256(b'other data').digest()))
+
+      with self.assertRaises(uptane.FailedToDecodeASN1DER):
+        asn1_codec.convert_signed_der_to_dersigned_json_keeping_signed_der(
+            der_data[:-1], DATATYPE_VEHICLE_MANIFEST)
+
+    finally:
+      asn1_codec.USE_COMPILED_CODEC = True
+
+
+
+
+
+  def test_40_sm3(self):
+
+    # Test vectors from GB/T 32905-2016.
+    abc_digest = ('66c7f0f462eeedd9d1f2d46bdc10e4e2'
+        '4167c4875cf2f7a2297da02b8f4ba8e0')
+    abcd_digest = ('debe9ff92275b8a138604889c18e5a4d'
+        '6fdb70e5387e5765293dcba39c0c5732')
+
+    self.assertEqual(abc_digest, asn1_codec.SM3(b'abc').hexdigest())
+    self.assertEqual(abcd_digest, asn1_codec.SM3(b'abcd' * 16).hexdigest())
+    self.assertEqual(abc_digest, asn1_codec.new_sm3(b'abc').hexdigest())
+
+    # Hashing data in pieces of any size gives the same result.
+    data = bytes(bytearray(range(256))) * 5
+    expected = asn1_codec.SM3(data).hexdigest()
+    for piece_size in [1, 7, 63, 64, 65, 1000]:
+      sm3 = asn1_codec.SM3()
+      for i in range(0, len(data), piece_size):
+        sm3.update(data[i:i + piece_size])
+      self.assertEqual(expected, sm3.hexdigest())
+      self.assertEqual(expected, binascii.hexlify(sm3.digest()).decode())
+
+    # Copies can be updated independently.
+    sm3 = asn1_codec.SM3(b'ab')
+    sm3_copy = sm3.copy()
+    sm3.update(b'c')
+    self.assertEqual(abc_digest, sm3.hexdigest())
+    sm3_copy.update(b'cd' * 32)
+    self.assertEqual(abcd_digest, sm3_copy.hexdigest())
+
+    # Files are hashed in chunks.
+    if not os.path.exists(TEMP_TEST_DIR):
+      os.makedirs(TEMP_TEST_DIR)
+    fname = os.path.join(TEMP_TEST_DIR, 'sm3_test_file')
+    with open(fname, 'wb') as fobj:
+      fobj.write(data)
+    chunk_size = asn1_codec.SM3_FILE_CHUNK_SIZE
+    asn1_codec.SM3_FILE_CHUNK_SIZE = 100
+    try:
+      self.assertEqual(expected.upper(), asn1_codec.SM3().hashFile(fname))
+    finally:
+      asn1_codec.SM3_FILE_CHUNK_SIZE = chunk_size
+
+
+
+
+
 
 def conversion_tester(signable_pydict, datatype, cls): # cls: clunky
   """
@@ -17,6 +17,7 @@ import os.path
 import shutil
 import copy
 import json
+import threading
 
 import tuf
 import tuf.formats
@@ -54,6 +55,18 @@ def destroy_temp_dir():
 
 
 
+def count_ecu_manifest_sightings(ecu_serial):
+  """
+  Returns how many times ECU Manifests from the given ECU have been saved,
+  counting each save of a manifest collapsed into an earlier one.
+  """
+  return sum(entry['count']
+      for entry in inventory.get_ecu_manifest_history(ecu_serial))
+
+
+
+
+
 class TestDirector(unittest.TestCase):
   """
   "unittest"-style test class for the Director module in the reference
@@ -170,6 +183,7 @@ class TestDirector(unittest.TestCase):
 
     # Check values not copied from parameters.
     self.assertEqual({}, TestDirector.instance.vehicle_repositories)
+    self.assertIsNone(TestDirector.instance.target_store)
 
     # Expect that the inventory db is currently empty.
     self.assertFalse(inventory.ecus_by_vin)
@@ -723,6 +737,71 @@ class TestDirector(unittest.TestCase):
 
 
 
+  def test_17_register_vehicle_manifest_with_verification_pool(self):
+    """
+    Repeats some of test_15, but with the ECU Manifest signature checks spread
+    across a pool of worker processes, expecting the same results.
+    """
+    TestDirector.instance.verification_workers = 2
+
+    try:
+      # An ECU Manifest signed by the wrong key should still be discarded,
+      # while the Vehicle Manifest containing it is saved.
+      previous_ecu_manifest = inventory.get_last_ecu_manifest('TCUdemocar')
+      n_vms_before = len(inventory.get_vehicle_manifests('democar'))
+      # The valid ECU Manifest below was already saved by test_15, so it is
+      # counted as another sighting of that one (see
+      # inventory.COLLAPSE_DUPLICATE_MANIFESTS); count sightings throughout.
+      n_ems_before = count_ecu_manifest_sightings('TCUdemocar')
+
+      if tuf.conf.METADATA_FORMAT == 'json':
+        manifest_bad = json.load(open(os.path.join(TEST_DATA_DIR,
+            'flawed_manifests', 'vm3_ecu_manifest_signed_with_wrong_key.json')))
+      else:
+        assert tuf.conf.METADATA_FORMAT == 'der' # Or test code is broken/old.
+        manifest_bad = open(os.path.join(TEST_DATA_DIR, 'flawed_manifests',
+            'vm3_ecu_manifest_signed_with_wrong_key.der'), 'rb').read()
+
+      TestDirector.instance.register_vehicle_manifest(
+          'democar', 'INFOdemocar', manifest_bad)
+
+      self.assertEqual(previous_ecu_manifest,
+          inventory.get_last_ecu_manifest('TCUdemocar'))
+      self.assertEqual(
+          n_vms_before + 1, len(inventory.get_vehicle_manifests('democar')))
+      self.assertEqual(
+          n_ems_before, count_ecu_manifest_sightings('TCUdemocar'))
+
+
+      # A correctly signed ECU Manifest should be saved.
+      if tuf.conf.METADATA_FORMAT == 'json':
+        manifest = json.load(open(os.path.join(TEST_DATA_DIR,
+            'flawed_manifests', 'vm4_attack_detected_in_ecu_manifest.json')))
+      else:
+        assert tuf.conf.METADATA_FORMAT == 'der' # Or test code is broken/old.
+        manifest = open(os.path.join(TEST_DATA_DIR, 'flawed_manifests',
+            'vm4_attack_detected_in_ecu_manifest.der'), 'rb').read()
+
+      TestDirector.instance.register_vehicle_manifest(
+          'democar', 'INFOdemocar', manifest)
+
+      self.assertEqual(
+          n_vms_before + 2, len(inventory.get_vehicle_manifests('democar')))
+      self.assertEqual(
+          n_ems_before + 1, count_ecu_manifest_sightings('TCUdemocar'))
+      self.assertEqual('some attack detected', inventory.get_last_ecu_manifest(
+          'TCUdemocar')['signed']['attacks_detected'])
+
+      self.assertIsNotNone(TestDirector.instance._verification_pool)
+
+    finally:
+      TestDirector.instance.verification_workers = None
+      TestDirector.instance.close()
+
+
+
+
+
   # Covered well by test_15. May merit duplication?
   # def test_20_validate_primary_certification_in_vehicle_manifest(self):
   #   pass
@@ -739,7 +818,79 @@ class TestDirector(unittest.TestCase):
 
 
   def test_35_create_director_repo_for_vehicle(self):
-    pass
+    """
+    Tests that vehicle repositories are created when first used, share their
+    signed root metadata, and are unloaded (unless pinned) and reloaded from
+    disk beyond director.MAX_RESIDENT_VEHICLE_REPOSITORIES.
+    """
+    repositories = TestDirector.instance.vehicle_repositories
+    vins = ['lazycar1', 'lazycar2', 'lazycar3']
+    root_filename = 'root.' + tuf.conf.METADATA_FORMAT
+
+    previous_max_resident = director.MAX_RESIDENT_VEHICLE_REPOSITORIES
+    director.MAX_RESIDENT_VEHICLE_REPOSITORIES = 2
+
+    try:
+      for vin in vins:
+        TestDirector.instance.create_director_repo_for_vehicle(vin)
+        self.assertIn(vin, repositories)
+        self.assertFalse(repositories.is_resident(vin))
+
+      for vin in vins:
+        repositories[vin].write()
+        self.assertTrue(repositories.is_resident(vin))
+
+      # Only one root metadata file was signed; the later repositories were
+      # given the same one.
+      root_metadata = []
+      for vin in vins:
+        with open(os.path.join(TEST_DIRECTOR_DIR, vin, 'metadata.staged',
+            root_filename), 'rb') as fobj:
+          root_metadata.append(fobj.read())
+      self.assertEqual([root_metadata[0]] * 3, root_metadata)
+
+      # The least recently used repository was unloaded after being written,
+      # and is reloaded from disk, unchanged, with its signing keys.
+      self.assertFalse(repositories.is_resident('lazycar1'))
+      self.assertEqual(2, len(repositories.resident_items()))
+
+      repo = repositories['lazycar1']
+      self.assertTrue(repositories.is_resident('lazycar1'))
+      self.assertFalse(repositories.is_resident('lazycar2'))
+      self.assertEqual(1, repo.root.version)
+      self.assertEqual(1, repo.targets.version)
+      self.assertEqual([keys_pub['targets']['keyid']], repo.targets.keys)
+      self.assertEqual(
+          [keys_pub['targets']['keyid']], repo.targets.signing_keys)
+
+      # Repositories with unwritten changes are written to metadata.staged
+      # when they are unloaded, and listed until they are forgotten.
+      repo.mark_dirty(['timestamp'])
+      repositories['lazycar2']
+      repositories['lazycar3']
+      self.assertFalse(repositories.is_resident('lazycar1'))
+      self.assertEqual(['lazycar1'], repositories.written_on_unload())
+
+      repo = repositories['lazycar1']
+      self.assertEqual(2, repo.timestamp.version)
+      repositories.forget_written_on_unload(['lazycar1'])
+      self.assertEqual([], repositories.written_on_unload())
+
+      # Pinned repositories are not unloaded, until they are unpinned.
+      with repositories.pinned('lazycar1') as pinned_repo:
+        self.assertIs(repo, pinned_repo)
+        repositories['lazycar2']
+        repositories['lazycar3']
+        self.assertTrue(repositories.is_resident('lazycar1'))
+
+      repositories['lazycar2']
+      self.assertFalse(repositories.is_resident('lazycar1'))
+
+      with self.assertRaises(KeyError):
+        repositories['unknown_vin']
+
+    finally:
+      director.MAX_RESIDENT_VEHICLE_REPOSITORIES = previous_max_resident
 
 
 
@@ -752,6 +903,135 @@ class TestDirector(unittest.TestCase):
 
 
 
+  def test_45_assign_image(self):
+    """
+    Tests assigning one image to several vehicles at once, selected by VIN
+    (for their Primary ECUs) and by ECU Serial.
+    """
+    instance = TestDirector.instance
+    vins = ['campaigncar1', 'campaigncar2', 'campaigncar3']
+    image_contents = b'Contents of campaign_firmware.img'
+    image_fname = os.path.join(TEST_DIRECTOR_DIR, 'campaign_firmware.img')
+
+    with open(image_fname, 'wb') as fobj:
+      fobj.write(image_contents)
+
+    for vin in vins:
+      instance.add_new_vehicle(vin)
+      instance.register_ecu_serial(
+          'INFO' + vin, keys_pub['primary'], vin, is_primary=True)
+      instance.register_ecu_serial('TCU' + vin, keys_pub['secondary'], vin)
+
+    def get_assigned_ecus(vin):
+      return [custom['ecu_serial'] for path, custom in
+          instance.vehicle_repositories[vin].targets.target_files.items()
+          if path.endswith('campaign.img')]
+
+    # Invalid selections are expected to leave every repository unchanged.
+    with self.assertRaises(uptane.Error):
+      instance.assign_image(image_fname, 'campaign.img')
+
+    with self.assertRaises(uptane.UnknownVehicle):
+      instance.assign_image(
+          image_fname, 'campaign.img', vins=['campaigncar1', 'unknown_vin'])
+
+    with self.assertRaises(uptane.UnknownECU):
+      instance.assign_image(image_fname, 'campaign.img',
+          ecu_serials=['TCUcampaigncar1', 'unknown_ecu'])
+
+    # Only one ECU in each vehicle may be selected.
+    with self.assertRaises(uptane.Error):
+      instance.assign_image(image_fname, 'campaign.img',
+          vins=['campaigncar1'], ecu_serials=['TCUcampaigncar1'])
+
+    for vin in vins:
+      self.assertEqual([], get_assigned_ecus(vin))
+
+    progress = []
+    report = instance.assign_image(image_fname, 'campaign.img',
+        vins=['campaigncar1'],
+        ecu_serials=['TCUcampaigncar2', 'TCUcampaigncar3'],
+        progress_callback=lambda count, total: progress.append((count, total)))
+
+    self.assertEqual({'campaigncar1': 'INFOcampaigncar1',
+        'campaigncar2': 'TCUcampaigncar2', 'campaigncar3': 'TCUcampaigncar3'},
+        report['assignments'])
+    self.assertEqual([(1, 3), (2, 3), (3, 3)], progress)
+    tuf.formats.FILEINFO_SCHEMA.check_match(report['fileinfo'])
+    self.assertEqual(len(image_contents), report['fileinfo']['length'])
+    self.assertGreater(report['vehicles_per_second'], 0)
+
+    for vin in vins:
+      self.assertEqual([report['assignments'][vin]], get_assigned_ecus(vin))
+
+    # The image was stored once, in a target store created in the Director's
+    # directory, and each repository's target file is a link to it.
+    stored_image = os.path.join(TEST_DIRECTOR_DIR, '.target_store',
+        report['fileinfo']['hashes']['sha256'])
+    self.assertIsNotNone(instance.target_store)
+
+    for vin in vins:
+      target_filepath = os.path.join(
+          TEST_DIRECTOR_DIR, vin, 'targets', 'campaign.img')
+      self.assertTrue(os.path.samefile(stored_image, target_filepath))
+
+      # The repositories can then be written.
+      instance.vehicle_repositories[vin].write()
+      self.assertEqual(1, instance.vehicle_repositories[vin].targets.version)
+
+
+
+
+
+  def test_46_assign_image_bounded_memory(self):
+    """
+    Tests that assigning an image to more vehicles than
+    director.MAX_RESIDENT_VEHICLE_REPOSITORIES keeps no more than that many
+    repositories in memory, writing the others to disk as they are unloaded.
+    """
+    instance = TestDirector.instance
+    repositories = instance.vehicle_repositories
+    vins = ['boundedcar' + str(i) for i in range(5)]
+    image_fname = os.path.join(TEST_DIRECTOR_DIR, 'bounded_firmware.img')
+
+    with open(image_fname, 'wb') as fobj:
+      fobj.write(b'Contents of bounded_firmware.img')
+
+    for vin in vins:
+      instance.add_new_vehicle(vin)
+      instance.register_ecu_serial(
+          'INFO' + vin, keys_pub['primary'], vin, is_primary=True)
+
+    previous_max_resident = director.MAX_RESIDENT_VEHICLE_REPOSITORIES
+    director.MAX_RESIDENT_VEHICLE_REPOSITORIES = 2
+
+    try:
+      report = instance.assign_image(image_fname, 'bounded.img', vins=vins)
+      self.assertEqual(len(vins), len(report['assignments']))
+
+      self.assertLessEqual(len(repositories.resident_items()), 2)
+
+      unloaded_vins = [vin for vin in vins
+          if not repositories.is_resident(vin)]
+      self.assertGreaterEqual(len(unloaded_vins), len(vins) - 2)
+      for vin in unloaded_vins:
+        self.assertIn(vin, repositories.written_on_unload())
+
+      # The assignment survives unloading and reloading each repository.
+      for vin in vins:
+        self.assertTrue(any(path.endswith('bounded.img')
+            for path in repositories[vin].targets.target_files))
+        self.assertLessEqual(len(repositories.resident_items()), 2)
+
+      repositories.forget_written_on_unload(vins)
+
+    finally:
+      director.MAX_RESIDENT_VEHICLE_REPOSITORIES = previous_max_resident
+
+
+
+
+
   def test_60_register_vehicle(self):
     """Tests inventorydb.register_vehicle(), along with check_vin_registered()
     and helper function _check_registration_is_sane()."""
@@ -790,9 +1070,17 @@ class TestDirector(unittest.TestCase):
       inventory.register_vehicle(vin, 'other_ecu', overwrite=False)
     self.assertEqual('tv_primary', inventory.primary_ecus_by_vin[vin])
 
-    # Expect re-registering with overwrite to succeed.
+    # Register an ECU with the vehicle, and expect the ECU to be mapped to it.
+    inventory.register_ecu(False, vin, 'tv_secondary', keys_pub['secondary'])
+    self.assertEqual(
+        {'tv_secondary': vin}, inventory.get_vins_for_ecus(['tv_secondary']))
+
+    # Expect re-registering with overwrite to succeed, removing the vehicle's
+    # ECU associations.
     inventory.register_vehicle(vin, 'tv_primary2', overwrite=True)
     self.assertEqual('tv_primary2', inventory.primary_ecus_by_vin[vin])
+    with self.assertRaises(uptane.UnknownECU):
+      inventory.get_vins_for_ecus(['tv_secondary'])
 
 
     # See that _check_registration_is_sane tests its VIN argument, by providing
@@ -804,6 +1092,169 @@ class TestDirector(unittest.TestCase):
 
 
 
+  def test_65_manifest_retention(self):
+    """
+    Tests inventorydb's manifest retention policy (MAX_MANIFESTS_KEPT and
+    COLLAPSE_DUPLICATE_MANIFESTS) and get_vehicle_manifest_history().
+    """
+    vin = 'democar3'
+    inventory.register_vehicle(vin)
+
+    manifest = json.load(open(os.path.join(
+        SAMPLES_DIR, 'sample_vehicle_version_manifest_democar.json')))
+    manifest2 = copy.deepcopy(manifest)
+    manifest2['signed']['primary_ecu_serial'] = 'something_else'
+
+    previous_max_kept = inventory.MAX_MANIFESTS_KEPT
+    previous_collapse = inventory.COLLAPSE_DUPLICATE_MANIFESTS
+
+    # By default, repeated manifests are collapsed, and history is bounded.
+    self.assertIsNotNone(inventory.MAX_MANIFESTS_KEPT)
+    self.assertTrue(inventory.COLLAPSE_DUPLICATE_MANIFESTS)
+
+    inventory.save_vehicle_manifest(vin, manifest)
+    inventory.save_vehicle_manifest(vin, manifest)
+    self.assertEqual([2], [entry['count'] for entry in
+        inventory.get_vehicle_manifest_history(vin)])
+
+    for i in range(inventory.MAX_MANIFESTS_KEPT + 1):
+      inventory.save_vehicle_manifest(vin, [manifest, manifest2][i % 2])
+    self.assertEqual(inventory.MAX_MANIFESTS_KEPT,
+        len(inventory.get_vehicle_manifests(vin)))
+
+    # With the policy off, every manifest is kept, even if repeated.
+    inventory.register_vehicle(vin)
+    inventory.MAX_MANIFESTS_KEPT = None
+    inventory.COLLAPSE_DUPLICATE_MANIFESTS = False
+
+    try:
+      inventory.save_vehicle_manifest(vin, manifest)
+      inventory.save_vehicle_manifest(vin, manifest)
+      self.assertEqual(2, len(inventory.get_vehicle_manifests(vin)))
+
+    finally:
+      inventory.MAX_MANIFESTS_KEPT = previous_max_kept
+      inventory.COLLAPSE_DUPLICATE_MANIFESTS = previous_collapse
+
+    inventory.register_vehicle(vin)
+    inventory.MAX_MANIFESTS_KEPT = 2
+    inventory.COLLAPSE_DUPLICATE_MANIFESTS = True
+
+    try:
+      # Consecutive duplicates are collapsed into one entry with a count.
+      for m in [manifest, manifest, manifest, manifest2, manifest]:
+        inventory.save_vehicle_manifest(vin, m)
+
+      # Only the last two entries are kept.
+      self.assertEqual([manifest2, manifest],
+          inventory.get_vehicle_manifests(vin))
+      self.assertEqual(manifest, inventory.get_last_vehicle_manifest(vin))
+
+      history = inventory.get_vehicle_manifest_history(vin)
+      self.assertEqual([1, 1], [entry['count'] for entry in history])
+
+      inventory.save_vehicle_manifest(vin, manifest)
+      history = inventory.get_vehicle_manifest_history(vin)
+      self.assertEqual([1, 2], [entry['count'] for entry in history])
+      self.assertEqual(manifest, history[-1]['manifest'])
+      for entry in history:
+        tuf.formats.ISO8601_DATETIME_SCHEMA.check_match(entry['first_seen'])
+        tuf.formats.ISO8601_DATETIME_SCHEMA.check_match(entry['last_seen'])
+
+    finally:
+      inventory.MAX_MANIFESTS_KEPT = previous_max_kept
+      inventory.COLLAPSE_DUPLICATE_MANIFESTS = previous_collapse
+
+
+
+
+
+  def test_70_concurrent_inventory_access(self):
+    """
+    Hammers inventorydb from many threads at once: ECU registrations
+    (including changes of Primary), Vehicle Manifest saves, vehicle
+    reregistrations, and registration checks. Expects no errors (in
+    particular, no failed registration sanity checks) and no lost writes.
+    """
+    N_ITERATIONS = 50
+    stable_vins = ['stresscar' + str(i) for i in range(6)]
+    churning_vins = ['churncar' + str(i) for i in range(2)]
+
+    manifest = json.load(open(os.path.join(
+        SAMPLES_DIR, 'sample_vehicle_version_manifest_democar.json')))
+
+    for vin in stable_vins + churning_vins:
+      inventory.register_vehicle(vin)
+
+    def register_ecus(vin):
+      for i in range(N_ITERATIONS):
+        inventory.register_ecu(False, vin, vin + '_secondary' + str(i % 10),
+            keys_pub['secondary'])
+
+    def switch_primaries(vin):
+      for i in range(N_ITERATIONS):
+        inventory.register_ecu(True, vin, vin + '_primary' + str(i % 3),
+            keys_pub['primary'])
+
+    def save_manifests(vin):
+      for i in range(N_ITERATIONS):
+        inventory.save_vehicle_manifest(vin, manifest)
+
+    def reregister_vehicle(vin):
+      for i in range(N_ITERATIONS):
+        inventory.register_vehicle(vin)
+        inventory.register_ecu(True, vin, vin + '_primary',
+            keys_pub['primary'])
+
+    def check_registration(vin):
+      for i in range(N_ITERATIONS * 2):
+        inventory.check_vin_registered(vin)
+        inventory.get_vehicle_manifests(vin)
+
+    errors = []
+
+    def run(func, vin):
+      try:
+        func(vin)
+      except Exception as e: # pragma: no cover
+        errors.append(e)
+
+    threads = []
+    for vin in stable_vins:
+      for func in [register_ecus, switch_primaries, save_manifests,
+          check_registration]:
+        threads.append(threading.Thread(target=run, args=(func, vin)))
+    for vin in churning_vins:
+      for func in [reregister_vehicle, check_registration, check_registration]:
+        threads.append(threading.Thread(target=run, args=(func, vin)))
+
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual([], errors)
+
+    # The same manifest was saved each time, so (with duplicates collapsed)
+    # every save is counted as a sighting.
+    for vin in stable_vins:
+      self.assertEqual(N_ITERATIONS, sum(entry['count'] for entry in
+          inventory.get_vehicle_manifest_history(vin)))
+      ecus = inventory.ecus_by_vin[vin]
+      self.assertEqual(13, len(ecus))
+      self.assertEqual(len(ecus), len(set(ecus)))
+      self.assertIn(inventory.primary_ecus_by_vin[vin], ecus)
+      inventory._check_registration_is_sane(vin)
+
+    for vin in churning_vins:
+      self.assertEqual(
+          [vin + '_primary'], inventory.ecus_by_vin[vin])
+      inventory._check_registration_is_sane(vin)
+
+
+
+
+
 # Run unit test.
 if __name__ == '__main__':
   unittest.main()
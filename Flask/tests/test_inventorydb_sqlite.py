@@ -0,0 +1,286 @@
+"""
+<Program Name>
+  test_inventorydb_sqlite.py
+
+<Purpose>
+  Unit testing for uptane/services/inventorydb_sqlite.py, exercised through
+  the public functions of uptane/services/inventorydb.py.
+
+<Copyright>
+  See LICENSE for licensing information.
+"""
+from __future__ import unicode_literals
+
+import uptane # Import before TUF modules; may change tuf.conf values.
+
+import unittest
+import os.path
+import shutil
+import copy
+import json
+import threading
+
+import tuf
+import tuf.formats
+
+import uptane.services.inventorydb as inventory
+import uptane.services.inventorydb_sqlite as inventorydb_sqlite
+
+import demo # for import_public_key
+
+TEST_DATA_DIR = os.path.join(uptane.WORKING_DIR, 'tests', 'test_data')
+TEMP_DB_DIR = os.path.join(TEST_DATA_DIR, 'temp_test_inventorydb_sqlite')
+TEMP_DB_FNAME = os.path.join(TEMP_DB_DIR, 'inventory.db')
+SAMPLES_DIR = os.path.join(uptane.WORKING_DIR, 'samples')
+
+
+
+class TestInventoryDBSQLite(unittest.TestCase):
+  """
+  "unittest"-style test class for the SQLite inventory db backend.
+  """
+
+  @classmethod
+  def setUpClass(cls):
+
+    if os.path.exists(TEMP_DB_DIR):
+      shutil.rmtree(TEMP_DB_DIR)
+    os.makedirs(TEMP_DB_DIR)
+
+    cls.key_primary = demo.import_public_key('primary')
+    cls.key_secondary = demo.import_public_key('secondary')
+
+    # The inventory db stores manifests as JSON-compatible dictionaries
+    # regardless of tuf.conf.METADATA_FORMAT, so JSON samples are used here.
+    cls.vehicle_manifest = json.load(open(os.path.join(SAMPLES_DIR,
+        'sample_vehicle_version_manifest_democar.json')))
+    cls.ecu_manifest = json.load(open(os.path.join(SAMPLES_DIR,
+        'sample_ecu_manifest_TCUdemocar.json')))
+
+    cls.previous_backend = inventory.get_backend()
+
+    # These tests expect every manifest to be kept unless they set a retention
+    # policy themselves.
+    cls.previous_max_kept = inventory.MAX_MANIFESTS_KEPT
+    cls.previous_collapse = inventory.COLLAPSE_DUPLICATE_MANIFESTS
+    inventory.MAX_MANIFESTS_KEPT = None
+    inventory.COLLAPSE_DUPLICATE_MANIFESTS = False
+
+
+
+
+
+  @classmethod
+  def tearDownClass(cls):
+    inventory.set_backend(cls.previous_backend)
+    inventory.MAX_MANIFESTS_KEPT = cls.previous_max_kept
+    inventory.COLLAPSE_DUPLICATE_MANIFESTS = cls.previous_collapse
+    shutil.rmtree(TEMP_DB_DIR)
+
+
+
+
+
+  def test_01_register_and_save(self):
+
+    backend = inventorydb_sqlite.SQLiteBackend(TEMP_DB_FNAME)
+    inventory.set_backend(backend)
+
+    with self.assertRaises(uptane.UnknownVehicle):
+      inventory.check_vin_registered('democar')
+
+    inventory.register_vehicle('democar')
+    inventory.register_ecu(True, 'democar', 'INFOdemocar', self.key_primary)
+    inventory.register_ecu(False, 'democar', 'TCUdemocar', self.key_secondary)
+
+    inventory.check_vin_registered('democar')
+    inventory.check_ecu_registered('TCUdemocar')
+    self.assertEqual(
+        self.key_secondary, inventory.get_ecu_public_key('TCUdemocar'))
+    self.assertEqual('INFOdemocar', inventory.get_primary_ecu_serial('democar'))
+    self.assertEqual({'INFOdemocar': 'democar', 'TCUdemocar': 'democar'},
+        inventory.get_vins_for_ecus(['INFOdemocar', 'TCUdemocar']))
+
+    with self.assertRaises(uptane.UnknownECU):
+      inventory.get_vins_for_ecus(['TCUdemocar', 'unknown_ecu'])
+
+    # Registration conflicts are detected as with the in-memory backend.
+    with self.assertRaises(uptane.Spoofing):
+      inventory.register_ecu(
+          True, 'democar', 'other_primary', self.key_primary, overwrite=False)
+    with self.assertRaises(uptane.Spoofing):
+      inventory.register_ecu(
+          False, 'democar', 'TCUdemocar', self.key_primary, overwrite=False)
+    with self.assertRaises(uptane.Spoofing):
+      inventory.register_vehicle('democar', overwrite=False)
+
+    self.assertEqual([], inventory.get_vehicle_manifests('democar'))
+    self.assertIsNone(inventory.get_last_vehicle_manifest('democar'))
+    self.assertIsNone(inventory.get_last_ecu_manifest('TCUdemocar'))
+
+    inventory.save_vehicle_manifest('democar', self.vehicle_manifest)
+    inventory.save_ecu_manifests('democar', [
+        ('TCUdemocar', self.ecu_manifest), ('TCUdemocar', self.ecu_manifest)])
+
+    self.assertEqual(
+        [self.vehicle_manifest], inventory.get_vehicle_manifests('democar'))
+    self.assertEqual(
+        self.vehicle_manifest, inventory.get_last_vehicle_manifest('democar'))
+    self.assertEqual(2, len(inventory.get_ecu_manifests('TCUdemocar')))
+    self.assertEqual(
+        self.ecu_manifest, inventory.get_last_ecu_manifest('TCUdemocar'))
+    self.assertEqual(
+        {'INFOdemocar': [], 'TCUdemocar': [self.ecu_manifest] * 2},
+        inventory.get_all_ecu_manifests_from_vehicle('democar'))
+
+    # Unknown ECUs cannot have manifests saved, and a batch containing one is
+    # rejected entirely.
+    with self.assertRaises(uptane.UnknownECU):
+      inventory.save_ecu_manifests('democar', [
+          ('TCUdemocar', self.ecu_manifest),
+          ('unknown_ecu', self.ecu_manifest)])
+    self.assertEqual(2, len(inventory.get_ecu_manifests('TCUdemocar')))
+
+    # The in-memory globals are not used by this backend.
+    self.assertNotIn('democar', inventory.vehicle_manifests)
+
+    backend.close()
+
+
+
+
+
+  def test_02_persistence(self):
+    """
+    Reopen the database written in test_01 and expect to find the same data.
+    """
+    backend = inventorydb_sqlite.SQLiteBackend(TEMP_DB_FNAME)
+    inventory.set_backend(backend)
+
+    inventory.check_vin_registered('democar')
+    self.assertEqual('INFOdemocar', backend.get_primary_ecu_serial('democar'))
+    self.assertEqual(
+        ['INFOdemocar', 'TCUdemocar'], backend.get_ecus_in_vehicle('democar'))
+    self.assertEqual(
+        self.vehicle_manifest, inventory.get_last_vehicle_manifest('democar'))
+    self.assertEqual(2, len(inventory.get_ecu_manifests('TCUdemocar')))
+
+    # Reregistering an ECU discards its manifests; reregistering a vehicle
+    # discards its manifests and ECU associations.
+    inventory.register_ecu(False, 'democar', 'TCUdemocar', self.key_secondary)
+    self.assertEqual([], inventory.get_ecu_manifests('TCUdemocar'))
+
+    inventory.register_vehicle('democar')
+    self.assertEqual([], inventory.get_vehicle_manifests('democar'))
+    self.assertEqual([], backend.get_ecus_in_vehicle('democar'))
+    self.assertIsNone(backend.get_primary_ecu_serial('democar'))
+
+    backend.close()
+
+
+
+
+
+  def test_03_manifest_retention(self):
+    """
+    Tests the retention policy with this backend, including ECU Manifests
+    stored as references into Vehicle Manifests that are then discarded.
+    """
+    backend = inventorydb_sqlite.SQLiteBackend(':memory:')
+    inventory.set_backend(backend)
+
+    inventory.register_vehicle('democar')
+    inventory.register_ecu(True, 'democar', 'INFOdemocar', self.key_primary)
+    inventory.register_ecu(False, 'democar', 'TCUdemocar', self.key_secondary)
+
+    manifests = []
+    for i in range(3):
+      vehicle_manifest = copy.deepcopy(self.vehicle_manifest)
+      vehicle_manifest['signed']['ecu_version_manifests'] = {
+          'TCUdemocar': [copy.deepcopy(self.ecu_manifest)]}
+      vehicle_manifest['signed']['ecu_version_manifests']['TCUdemocar'][0][
+          'signed']['attacks_detected'] = 'attack ' + str(i)
+      manifests.append(vehicle_manifest)
+
+    inventory.MAX_MANIFESTS_KEPT = 2
+    inventory.COLLAPSE_DUPLICATE_MANIFESTS = True
+
+    try:
+      for vehicle_manifest in [manifests[0], manifests[0], manifests[1],
+          manifests[2]]:
+        inventory.save_vehicle_manifest('democar', vehicle_manifest)
+        ecu_manifest = vehicle_manifest['signed']['ecu_version_manifests'][
+            'TCUdemocar'][0]
+        inventory.save_ecu_manifests('democar', [('TCUdemocar', ecu_manifest)])
+
+      self.assertEqual(
+          manifests[1:], inventory.get_vehicle_manifests('democar'))
+
+      # ECU Manifests are stored as references into the Vehicle Manifests, and
+      # are expected to be read back correctly.
+      ecu_manifests = [m['signed']['ecu_version_manifests']['TCUdemocar'][0]
+          for m in manifests]
+      self.assertEqual(
+          ecu_manifests[1:], inventory.get_ecu_manifests('TCUdemocar'))
+      self.assertEqual(
+          ecu_manifests[2], inventory.get_last_ecu_manifest('TCUdemocar'))
+
+      inventory.MAX_MANIFESTS_KEPT = 3
+      inventory.save_vehicle_manifest('democar', manifests[2])
+      inventory.save_ecu_manifests('democar', [('TCUdemocar',
+          ecu_manifests[2])])
+      self.assertEqual([1, 2], [entry['count'] for entry in
+          inventory.get_ecu_manifest_history('TCUdemocar')])
+
+    finally:
+      inventory.MAX_MANIFESTS_KEPT = None
+      inventory.COLLAPSE_DUPLICATE_MANIFESTS = False
+      backend.close()
+
+
+
+
+
+  def test_04_concurrent_reads(self):
+    """
+    Tests that each thread reads through its own connection, and sees data
+    written through the shared write connection.
+    """
+    backend = inventorydb_sqlite.SQLiteBackend(
+        os.path.join(TEMP_DB_DIR, 'concurrent.db'))
+    inventory.set_backend(backend)
+
+    try:
+      inventory.register_vehicle('democar')
+      inventory.register_ecu(True, 'democar', 'INFOdemocar', self.key_primary)
+      inventory.save_vehicle_manifest('democar', self.vehicle_manifest)
+
+      results = []
+      errors = []
+
+      def read():
+        try:
+          results.append(inventory.get_last_vehicle_manifest('democar'))
+        except Exception as e: # pragma: no cover
+          errors.append(e)
+
+      threads = [threading.Thread(target=read) for i in range(4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+
+      self.assertEqual([], errors)
+      self.assertEqual([self.vehicle_manifest] * 4, results)
+      self.assertEqual(4, len(backend._read_connections))
+
+    finally:
+      backend.close()
+
+
+
+
+
+# Run unit test.
+if __name__ == '__main__':
+  unittest.main()
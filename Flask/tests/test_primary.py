@@ -14,6 +14,8 @@ import uptane # Import before TUF modules; may change tuf.conf values.
 
 import unittest
 import os.path
+import io
+import zipfile
 import time
 import copy
 import shutil
@@ -252,6 +254,19 @@ class TestPrimary(unittest.TestCase):
 
 
 
+    # Invalid number of download workers
+    with self.assertRaises(tuf.FormatError):
+      primary.Primary(
+          full_client_dir=TEMP_CLIENT_DIR,
+          director_repo_name=demo.DIRECTOR_REPO_NAME,
+          vin=VIN,
+          ecu_serial=PRIMARY_ECU_SERIAL,
+          primary_key=TestPrimary.ecu_key, time=TestPrimary.initial_time,
+          timeserver_public_key = TestPrimary.key_timeserver_pub,
+          download_workers='4') # INVALID
+
+
+
     # Try creating a Primary, expecting it to work.
     # Initializes a Primary ECU, making a client directory and copying the root
     # file from the repositories.
@@ -281,6 +296,7 @@ class TestPrimary(unittest.TestCase):
     tuf.formats.ANYKEY_SCHEMA.check_match(
         TestPrimary.instance.timeserver_public_key)
     self.assertEqual([], TestPrimary.instance.my_secondaries)
+    self.assertIsNone(TestPrimary.instance.download_workers)
 
 
 
@@ -530,6 +546,57 @@ class TestPrimary(unittest.TestCase):
 
 
 
+  def test_11_register_ecu_manifest_with_secondary_key(self):
+    """
+    Tests that, once the Primary has been given a Secondary's public key, it
+    accepts ECU Manifests from that Secondary only if they are validly signed
+    by that key.
+    """
+    if tuf.conf.METADATA_FORMAT == 'json':
+      good_manifest = json.load(open(os.path.join(SAMPLE_DATA_DIR,
+          'sample_ecu_manifest_TCUdemocar.json')))
+      bad_manifest = json.load(open(os.path.join(TEST_DATA_DIR,
+          'flawed_manifests', 'em3_ecu_manifest_signed_with_wrong_key.json')))
+
+    else:
+      assert tuf.conf.METADATA_FORMAT == 'der', 'Test code is flawed.'
+      good_manifest = open(os.path.join(SAMPLE_DATA_DIR,
+          'sample_ecu_manifest_TCUdemocar.der'), 'rb').read()
+      bad_manifest = open(os.path.join(TEST_DATA_DIR, 'flawed_manifests',
+          'em3_ecu_manifest_signed_with_wrong_key.der'), 'rb').read()
+
+    # Leave the Primary as it was for the tests that follow.
+    ecu_manifests = copy.deepcopy(TestPrimary.instance.ecu_manifests)
+    nonces_to_send = list(TestPrimary.instance.nonces_to_send)
+
+    try:
+      TestPrimary.instance.register_new_secondary(
+          'TCUdemocar', public_key=demo.import_public_key('secondary'))
+      self.assertIn('TCUdemocar', TestPrimary.instance.secondary_public_keys)
+
+      n_manifests = len(TestPrimary.instance.ecu_manifests['TCUdemocar'])
+
+      TestPrimary.instance.register_ecu_manifest(
+          VIN, 'TCUdemocar', nonce=20, signed_ecu_manifest=good_manifest)
+      self.assertEqual(n_manifests + 1,
+          len(TestPrimary.instance.ecu_manifests['TCUdemocar']))
+
+      with self.assertRaises(tuf.BadSignatureError):
+        TestPrimary.instance.register_ecu_manifest(
+            VIN, 'TCUdemocar', nonce=21, signed_ecu_manifest=bad_manifest)
+      self.assertEqual(n_manifests + 1,
+          len(TestPrimary.instance.ecu_manifests['TCUdemocar']))
+      self.assertNotIn(21, TestPrimary.instance.nonces_to_send)
+
+    finally:
+      TestPrimary.instance.secondary_public_keys.pop('TCUdemocar', None)
+      TestPrimary.instance.ecu_manifests = ecu_manifests
+      TestPrimary.instance.nonces_to_send = nonces_to_send
+
+
+
+
+
   def test_15_get_nonces_to_send_and_rotate(self):
 
     # The Primary's list of nonces to send in the next request to the
@@ -828,8 +895,207 @@ class TestPrimary(unittest.TestCase):
 
 
     # Run the update cycle again to test file/archive replacement when an
-    # update cycle has already occurred.
-    TestPrimary.instance.primary_update_cycle()
+    # update cycle has already occurred. (Without conditional refresh, since
+    # nothing has changed; that is tested below.)
+    try:
+      primary.CONDITIONAL_METADATA_REFRESH = False
+      TestPrimary.instance.primary_update_cycle()
+    finally:
+      primary.CONDITIONAL_METADATA_REFRESH = True
+
+
+
+
+
+  def test_56_conditional_metadata_refresh(self):
+
+    instance = TestPrimary.instance
+    archive_fname = instance.distributable_full_metadata_archive_fname
+
+    # The last update cycle did not save validators for the repositories'
+    # timestamp metadata, so this one refreshes them and runs in full.
+    full_cycles = instance.update_cycle_counts['full']
+    unchanged_cycles = instance.update_cycle_counts['unchanged']
+    instance.primary_update_cycle()
+    self.assertEqual(full_cycles + 1, instance.update_cycle_counts['full'])
+    self.assertEqual(
+        unchanged_cycles, instance.update_cycle_counts['unchanged'])
+
+    for repository_name in ['director', 'imagerepo']:
+      mirror, validator = instance.metadata_validators[repository_name]
+      self.assertEqual(
+          instance.updater.repositories[repository_name].mirrors[0], mirror)
+      self.assertTrue(validator.startswith('sha256:'))
+
+    # Nothing has changed since, so the next update cycle refreshes nothing
+    # and does nothing more, not even saving the distributable metadata.
+    refresh_counts = copy.deepcopy(instance.metadata_refresh_counts)
+    os.remove(archive_fname)
+
+    instance.primary_update_cycle()
+
+    self.assertEqual(full_cycles + 1, instance.update_cycle_counts['full'])
+    self.assertEqual(
+        unchanged_cycles + 1, instance.update_cycle_counts['unchanged'])
+    for repository_name in ['director', 'imagerepo']:
+      self.assertEqual(
+          refresh_counts[repository_name]['refreshed'],
+          instance.metadata_refresh_counts[repository_name]['refreshed'])
+      self.assertEqual(
+          refresh_counts[repository_name]['unchanged'] + 1,
+          instance.metadata_refresh_counts[repository_name]['unchanged'])
+    self.assertFalse(os.path.exists(archive_fname))
+    self.assertTrue(instance.update_exists_for_ecu('TCUdemocar'))
+
+    # A new Secondary may have been assigned updates, so the next update
+    # cycle runs in full, though the metadata is still not refreshed.
+    instance.register_new_secondary('secondary_registered_late')
+    instance.primary_update_cycle()
+    self.assertEqual(full_cycles + 2, instance.update_cycle_counts['full'])
+    self.assertTrue(os.path.exists(archive_fname))
+    self.assertEqual(
+        refresh_counts['director']['refreshed'],
+        instance.metadata_refresh_counts['director']['refreshed'])
+
+    # If a repository's timestamp metadata changes, it is refreshed.
+    instance.metadata_validators['director'] = ('mirror', 'sha256:changed')
+    self.assertTrue(instance.refresh_toplevel_metadata())
+    self.assertEqual(
+        refresh_counts['director']['refreshed'] + 1,
+        instance.metadata_refresh_counts['director']['refreshed'])
+    self.assertFalse(instance.refresh_toplevel_metadata())
+
+
+    # Validators for file URLs are hashes of the files.
+    timestamp_fname = os.path.join(TEMP_CLIENT_DIR, 'director', 'metadata',
+        'timestamp.' + tuf.conf.METADATA_FORMAT)
+    with open(timestamp_fname, 'rb') as fileobj:
+      timestamp_hash = hashlib.sha256(fileobj.read()).hexdigest()
+
+    self.assertEqual('sha256:' + timestamp_hash,
+        primary.get_metadata_validator('file://' + timestamp_fname))
+
+    # No validator is available for files that cannot be reached or URLs with
+    # unsupported schemes.
+    self.assertIsNone(primary.get_metadata_validator(
+        'file://' + timestamp_fname + '.nonexistent'))
+    self.assertIsNone(primary.get_metadata_validator(
+        'ftp://localhost/metadata/timestamp.json'))
+
+
+
+
+
+
+  def test_57_download_targets(self):
+
+    instance = TestPrimary.instance
+    targets_dir = os.path.join(TEMP_CLIENT_DIR, 'targets')
+
+    good_target = instance.assigned_targets['TCUdemocar']
+
+    # A target whose fileinfo no file on the repositories matches.
+    bad_target = copy.deepcopy(good_target)
+    bad_target['fileinfo']['length'] += 1
+    bad_target['fileinfo']['hashes'] = {'sha256': '0' * 64}
+
+    good_fname = os.path.join(targets_dir, good_target['filepath'].lstrip('/'))
+    os.remove(good_fname)
+
+    try:
+      instance.download_workers = 2
+
+      errors = instance._download_targets(
+          [bad_target, good_target], targets_dir)
+
+      # Results are in the order of the targets given.
+      self.assertEqual(2, len(errors))
+      self.assertIsInstance(errors[0], tuf.NoWorkingMirrorError)
+      self.assertIsNone(errors[1])
+      self.assertTrue(os.path.exists(good_fname))
+
+      # Errors other than tuf.NoWorkingMirrorError are raised without waiting
+      # for the downloads not yet started, which are cancelled.
+      downloaded = []
+
+      def download_target(target, destination_directory):
+        if target is bad_target:
+          raise tuf.FormatError('Test error')
+        time.sleep(0.2)
+        downloaded.append(target)
+
+      instance.updater.download_target = download_target
+      try:
+        with self.assertRaises(tuf.FormatError):
+          instance._download_targets([bad_target] + [good_target] * 4,
+              targets_dir)
+      finally:
+        del instance.updater.download_target
+
+      self.assertLess(len(downloaded), 4)
+
+      # A full update cycle with concurrent downloads obtains the target again.
+      os.remove(good_fname)
+      primary.CONDITIONAL_METADATA_REFRESH = False
+      self.assertEqual('success', instance.primary_update_cycle())
+      self.assertTrue(os.path.exists(good_fname))
+
+    finally:
+      instance.download_workers = None
+      primary.CONDITIONAL_METADATA_REFRESH = True
+
+
+
+
+
+  def test_58_save_distributable_metadata_files(self):
+
+    instance = TestPrimary.instance
+    archive_fname = instance.distributable_full_metadata_archive_fname
+    partial_fname = instance.distributable_partial_metadata_fname
+    current_dir = os.path.join(TEMP_CLIENT_DIR, 'metadata', 'director',
+        'current')
+
+    saved = instance.distributable_metadata_counts['saved']
+    unchanged = instance.distributable_metadata_counts['unchanged']
+    archive_stat = os.stat(archive_fname)
+
+    # Nothing has changed since the last update cycle saved the files, so
+    # they are left in place, even if a metadata file is rewritten with the
+    # same contents.
+    timestamp_fname = os.path.join(
+        current_dir, 'timestamp.' + tuf.conf.METADATA_FORMAT)
+    with open(timestamp_fname, 'rb') as fobj:
+      timestamp_contents = fobj.read()
+    with open(timestamp_fname, 'wb') as fobj:
+      fobj.write(timestamp_contents)
+
+    instance.save_distributable_metadata_files()
+    self.assertEqual(saved, instance.distributable_metadata_counts['saved'])
+    self.assertEqual(
+        unchanged + 1, instance.distributable_metadata_counts['unchanged'])
+    self.assertEqual(archive_stat.st_ino, os.stat(archive_fname).st_ino)
+
+    # The files are saved again if either is missing.
+    os.remove(partial_fname)
+    instance.save_distributable_metadata_files()
+    self.assertEqual(saved + 1, instance.distributable_metadata_counts['saved'])
+    self.assertTrue(os.path.exists(partial_fname))
+    self.assertNotEqual(archive_stat.st_ino, os.stat(archive_fname).st_ino)
+
+    # The archive holds the current metadata of each repository.
+    with zipfile.ZipFile(archive_fname) as archive:
+      for repo in ['director', 'imagerepo']:
+        for role in ['root', 'snapshot', 'targets', 'timestamp']:
+          with open(os.path.join(TEMP_CLIENT_DIR, 'metadata', repo, 'current',
+              role + '.' + tuf.conf.METADATA_FORMAT), 'rb') as fobj:
+            self.assertEqual(fobj.read(), archive.read(
+                repo + '/metadata/' + role + '.' + tuf.conf.METADATA_FORMAT))
+
+    with open(os.path.join(current_dir, 'targets.' + tuf.conf.METADATA_FORMAT),
+        'rb') as fobj:
+      with open(partial_fname, 'rb') as partial_fobj:
+        self.assertEqual(fobj.read(), partial_fobj.read())
 
 
 
@@ -887,6 +1153,64 @@ class TestPrimary(unittest.TestCase):
 
 
 
+  def test_63_get_metadata_bundle_for_ecu(self):
+
+    instance = TestPrimary.instance
+
+    bundle = instance.get_metadata_bundle_for_ecu('TCUdemocar')
+
+    # With no delegations in the test repositories, the bundle holds the
+    # top-level metadata of each repository, as validated by the Primary.
+    with zipfile.ZipFile(io.BytesIO(bundle)) as archive:
+      expected_members = []
+      for repo in ['director', 'imagerepo']:
+        for role in ['root', 'snapshot', 'targets', 'timestamp']:
+          member = repo + '/metadata/' + role + '.' + tuf.conf.METADATA_FORMAT
+          expected_members.append(member)
+
+          with open(os.path.join(TEMP_CLIENT_DIR, 'metadata', repo, 'current',
+              role + '.' + tuf.conf.METADATA_FORMAT), 'rb') as fobj:
+            self.assertEqual(fobj.read(), archive.read(member))
+
+      self.assertEqual(expected_members, sorted(archive.namelist()))
+
+    # Secondaries that need the same metadata get the same bundle, and
+    # rebuilding the bundles from unchanged metadata produces the same bytes.
+    self.assertEqual(
+        bundle, instance.get_metadata_bundle_for_ecu('secondary_without_updates'))
+    self.assertEqual(bundle, instance._build_metadata_bundles()['TCUdemocar'])
+
+    with self.assertRaises(uptane.UnknownECU):
+      instance.get_metadata_bundle_for_ecu('unknown_ecu_serial')
+
+    with self.assertRaises(tuf.FormatError):
+      instance.get_metadata_bundle_for_ecu(5)
+
+
+    # Only delegated targets roles trusted with a given target are included.
+    current_metadata = {
+        'targets': {'delegations': {'roles': [
+            {'name': 'brakes', 'paths': ['/brakes/*']},
+            {'name': 'radio', 'paths': ['/radio/*']},
+            {'name': 'bins', 'path_hash_prefixes': [
+                hashlib.sha256(b'/radio/fw.img').hexdigest()[:2]]}]}},
+        'brakes': {'delegations': {'roles': [
+            {'name': 'brakes-v2', 'paths': ['/brakes/v2/*']}]}},
+        'radio': {},
+        'bins': {},
+        'brakes-v2': {}}
+
+    self.assertEqual(['brakes', 'brakes-v2'], primary._get_delegated_rolenames(
+        current_metadata, ['/brakes/v2/fw.img']))
+    self.assertEqual(['radio', 'bins'], primary._get_delegated_rolenames(
+        current_metadata, ['/radio/fw.img']))
+    self.assertEqual([], primary._get_delegated_rolenames(
+        current_metadata, ['/infotainment/fw.img']))
+
+
+
+
+
   def test_65_get_metadata_for_ecu(self):
     pass
 
@@ -727,6 +727,60 @@ class TestSecondary(unittest.TestCase):
 
 
 
+  def test_45_process_unchanged_metadata(self):
+    """
+    Tests that uptane.clients.secondary.Secondary::process_metadata() does not
+    expand or validate again a metadata archive identical to the last one it
+    fully validated.
+    """
+    instance = secondary_instances[0]
+    client_dir = TEMP_CLIENT_DIRS[0]
+    tuf.conf.repository_directory = client_dir
+
+    archive_fname = os.path.join(client_dir, 'full_metadata_archive.zip')
+    unverified_dir = os.path.join(client_dir, 'unverified')
+
+    # The failure to process a nonexistent archive at the end of the previous
+    # test means that the archive is validated once more.
+    instance.process_metadata(archive_fname)
+    full_count = instance.metadata_archive_counts['full']
+    self.assertIsNotNone(instance.last_metadata_archive_hash)
+
+    # The same archive again is neither expanded nor validated, and the
+    # targets validated for this ECU are kept.
+    shutil.rmtree(unverified_dir)
+    instance.process_metadata(archive_fname)
+    self.assertFalse(os.path.exists(unverified_dir))
+    self.assertEqual(1, instance.metadata_archive_counts['unchanged'])
+    self.assertEqual(full_count, instance.metadata_archive_counts['full'])
+    self.assertEqual(
+        expected_updated_fileinfo,
+        instance.validated_targets_for_this_ecu[0])
+
+    # A different archive is processed in full.
+    instance.last_metadata_archive_hash = hashlib.sha256(b'other').hexdigest()
+    instance.process_metadata(archive_fname)
+    self.assertTrue(os.path.exists(unverified_dir))
+    self.assertEqual(full_count + 1, instance.metadata_archive_counts['full'])
+
+    # So is every archive, if skipping is turned off.
+    try:
+      secondary.SKIP_UNCHANGED_METADATA_ARCHIVES = False
+      instance.process_metadata(archive_fname)
+      self.assertEqual(full_count + 2, instance.metadata_archive_counts['full'])
+      self.assertEqual(1, instance.metadata_archive_counts['unchanged'])
+
+    finally:
+      secondary.SKIP_UNCHANGED_METADATA_ARCHIVES = True
+
+    self.assertEqual(
+        expected_updated_fileinfo,
+        instance.validated_targets_for_this_ecu[0])
+
+
+
+
+
   def test_50_validate_image(self):
 
     image_fname = 'TCU1.1.txt'
@@ -752,6 +806,79 @@ class TestSecondary(unittest.TestCase):
 
 
 
+
+  def test_55_get_image_receiver(self):
+
+    image_fname = 'TCU1.1.txt'
+    instance = secondary_instances[0]
+    unverified_targets_dir = os.path.join(
+        TEMP_CLIENT_DIRS[0], 'unverified_targets')
+    image_filepath = os.path.join(unverified_targets_dir, image_fname)
+    partial_filepath = image_filepath + '.part'
+
+    with open(os.path.join(demo.DEMO_DIR, 'images', image_fname), 'rb') as fobj:
+      image = fobj.read()
+
+    os.remove(image_filepath)
+
+    # Receive the image in two parts, as if the transfer were interrupted after
+    # the first and resumed later.
+    receiver = instance.get_image_receiver(image_fname)
+    self.assertEqual(partial_filepath, receiver.partial_filepath)
+    self.assertEqual(0, receiver.length_received)
+    receiver.write(image[:10])
+    receiver.close()
+
+    receiver = instance.get_image_receiver(image_fname)
+    self.assertEqual(10, receiver.length_received)
+    receiver.write(image[10:])
+    self.assertFalse(os.path.exists(image_filepath))
+
+    self.assertEqual(image_filepath, receiver.commit())
+    self.assertFalse(os.path.exists(partial_filepath))
+    with open(image_filepath, 'rb') as fobj:
+      self.assertEqual(image, fobj.read())
+
+    # An image longer than the validated length is rejected as soon as the
+    # chunk that makes it too long arrives.
+    receiver = instance.get_image_receiver(image_fname)
+    receiver.write(image)
+    with self.assertRaises(tuf.DownloadLengthMismatchError):
+      receiver.write(b'x')
+    self.assertFalse(os.path.exists(partial_filepath))
+
+    # An image with the wrong hash or a short image is not moved into place.
+    os.remove(image_filepath)
+
+    receiver = instance.get_image_receiver(image_fname)
+    receiver.write(b'X' + image[1:])
+    with self.assertRaises(tuf.BadHashError):
+      receiver.commit()
+    self.assertFalse(os.path.exists(partial_filepath))
+    self.assertFalse(os.path.exists(image_filepath))
+
+    receiver = instance.get_image_receiver(image_fname)
+    receiver.write(image[:-1])
+    with self.assertRaises(tuf.DownloadLengthMismatchError):
+      receiver.commit()
+    self.assertFalse(os.path.exists(image_filepath))
+
+    # A partial file longer than the image cannot be resumed from.
+    with open(partial_filepath, 'wb') as fobj:
+      fobj.write(image + b'x')
+    receiver = instance.get_image_receiver(image_fname)
+    self.assertEqual(0, receiver.length_received)
+    receiver.abort()
+    self.assertFalse(os.path.exists(partial_filepath))
+
+    # Secondaries with no validated target info for the image.
+    with self.assertRaises(uptane.Error):
+      secondary_instances[1].get_image_receiver(image_fname)
+
+
+
+
+
 # Run unit tests.
 if __name__ == '__main__':
   unittest.main()
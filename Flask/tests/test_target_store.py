@@ -0,0 +1,214 @@
+"""
+<Program Name>
+  test_target_store.py
+
+<Purpose>
+  Unit testing for uptane/services/target_store.py
+
+<Copyright>
+  See LICENSE for licensing information.
+"""
+from __future__ import unicode_literals
+
+import uptane # Import before TUF modules; may change tuf.conf values.
+
+import unittest
+import os.path
+import shutil
+import hashlib
+
+import tuf
+import tuf.formats
+
+import uptane.services.target_store as target_store
+
+TEST_DATA_DIR = os.path.join(uptane.WORKING_DIR, 'tests', 'test_data')
+TEMP_TEST_DIR = os.path.join(TEST_DATA_DIR, 'temp_test_target_store')
+TEMP_STORE_DIR = os.path.join(TEMP_TEST_DIR, 'store')
+TEMP_SOURCE_DIR = os.path.join(TEMP_TEST_DIR, 'source')
+TEMP_REPOS_DIR = os.path.join(TEMP_TEST_DIR, 'repos')
+
+
+
+def write_file(filepath, contents):
+  with open(filepath, 'wb') as fobj:
+    fobj.write(contents)
+
+
+
+
+
+def read_file(filepath):
+  with open(filepath, 'rb') as fobj:
+    return fobj.read()
+
+
+
+
+
+class TestTargetStore(unittest.TestCase):
+  """
+  "unittest"-style test class for the content-addressed target store.
+  """
+
+  @classmethod
+  def setUpClass(cls):
+
+    if os.path.exists(TEMP_TEST_DIR):
+      shutil.rmtree(TEMP_TEST_DIR)
+    os.makedirs(TEMP_SOURCE_DIR)
+    os.makedirs(TEMP_REPOS_DIR)
+
+    cls.firmware_fname = os.path.join(TEMP_SOURCE_DIR, 'firmware.img')
+    cls.firmware_contents = b'Contents of firmware.img' * 1000
+    write_file(cls.firmware_fname, cls.firmware_contents)
+
+    cls.other_fname = os.path.join(TEMP_SOURCE_DIR, 'other.img')
+    cls.other_contents = b'Contents of other.img'
+    write_file(cls.other_fname, cls.other_contents)
+
+    # A file with the same contents as firmware.img, under another name.
+    cls.duplicate_fname = os.path.join(TEMP_SOURCE_DIR, 'duplicate.img')
+    write_file(cls.duplicate_fname, cls.firmware_contents)
+
+    cls.store = target_store.TargetStore(TEMP_STORE_DIR)
+
+
+
+
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(TEMP_TEST_DIR)
+
+
+
+
+
+  def test_01_init(self):
+
+    self.assertTrue(os.path.isdir(TEMP_STORE_DIR))
+    self.assertIn(target_store.STORE_HASH_ALGORITHM, self.store.hash_algorithms)
+
+    # The store's hash algorithm is always computed, even if not requested.
+    store = target_store.TargetStore(TEMP_STORE_DIR, hash_algorithms=['sha512'])
+    self.assertEqual(['sha512', 'sha256'], store.hash_algorithms)
+
+    with self.assertRaises(tuf.FormatError):
+      target_store.TargetStore(42)
+
+    with self.assertRaises(tuf.FormatError):
+      target_store.TargetStore(TEMP_STORE_DIR, hash_algorithms='sha256')
+
+
+
+
+
+  def test_02_add_file(self):
+
+    digest = self.store.add_file(self.firmware_fname)
+
+    self.assertEqual(hashlib.sha256(self.firmware_contents).hexdigest(), digest)
+    self.assertEqual([digest], os.listdir(TEMP_STORE_DIR))
+    self.assertEqual(self.firmware_contents,
+        read_file(os.path.join(TEMP_STORE_DIR, digest)))
+
+    fileinfo = self.store.get_fileinfo(digest)
+    tuf.formats.FILEINFO_SCHEMA.check_match(fileinfo)
+    self.assertEqual(len(self.firmware_contents), fileinfo['length'])
+    self.assertEqual(digest, fileinfo['hashes']['sha256'])
+    self.assertEqual(
+        sorted(self.store.hash_algorithms), sorted(fileinfo['hashes']))
+
+    # The same contents under another name are stored only once.
+    self.assertEqual(digest, self.store.add_file(self.duplicate_fname))
+    self.assertEqual([digest], os.listdir(TEMP_STORE_DIR))
+
+    other_digest = self.store.add_file(self.other_fname)
+    self.assertNotEqual(digest, other_digest)
+    self.assertEqual(
+        sorted([digest, other_digest]), sorted(os.listdir(TEMP_STORE_DIR)))
+
+    # Another store object sharing the directory computes the fileinfo of
+    # files that it did not add itself.
+    store = target_store.TargetStore(TEMP_STORE_DIR)
+    self.assertEqual(fileinfo, store.get_fileinfo(digest))
+
+    with self.assertRaises(uptane.Error):
+      self.store.get_fileinfo(hashlib.sha256(b'not stored').hexdigest())
+
+    with self.assertRaises(tuf.FormatError):
+      self.store.get_fileinfo('not a digest')
+
+
+
+
+
+  def test_03_link(self):
+
+    digest = self.store.add_file(self.firmware_fname)
+    other_digest = self.store.add_file(self.other_fname)
+
+    repo1_target = os.path.join(TEMP_REPOS_DIR, 'repo1', 'targets', 'fw.img')
+    repo2_target = os.path.join(
+        TEMP_REPOS_DIR, 'repo2', 'targets', 'brakes', 'fw.img')
+
+    # Missing directories are created, and both repositories link to the same
+    # stored file.
+    self.store.link(digest, repo1_target)
+    self.assertEqual(digest, self.store.add_and_link(
+        self.firmware_fname, repo2_target))
+
+    blob_filepath = os.path.join(TEMP_STORE_DIR, digest)
+    self.assertTrue(os.path.samefile(blob_filepath, repo1_target))
+    self.assertTrue(os.path.samefile(blob_filepath, repo2_target))
+    self.assertEqual(self.firmware_contents, read_file(repo2_target))
+
+    # Linking another file to a path replaces the file there, rather than
+    # writing through the link into the stored file.
+    self.store.link(other_digest, repo1_target)
+    self.assertEqual(self.other_contents, read_file(repo1_target))
+    self.assertEqual(self.firmware_contents, read_file(blob_filepath))
+    self.assertEqual(self.firmware_contents, read_file(repo2_target))
+
+    # No temporary files are left in the repository directory.
+    self.assertEqual(
+        ['fw.img'], os.listdir(os.path.join(TEMP_REPOS_DIR, 'repo1', 'targets')))
+
+    with self.assertRaises(uptane.Error):
+      self.store.link(hashlib.sha256(b'not stored').hexdigest(), repo1_target)
+
+
+
+
+
+  def test_04_remove_unreferenced(self):
+
+    digest = self.store.add_file(self.firmware_fname)
+    other_digest = self.store.add_file(self.other_fname)
+    repo_dir = os.path.join(TEMP_REPOS_DIR, 'repo3', 'targets')
+
+    self.store.link(digest, os.path.join(repo_dir, 'fw.img'))
+    self.store.link(other_digest, os.path.join(repo_dir, 'other.img'))
+
+    # Both files are referenced, by this repository if no other.
+    self.assertEqual(0, self.store.remove_unreferenced())
+
+    shutil.rmtree(TEMP_REPOS_DIR)
+    self.assertEqual(2, self.store.remove_unreferenced())
+    self.assertEqual([], os.listdir(TEMP_STORE_DIR))
+
+    with self.assertRaises(uptane.Error):
+      self.store.get_fileinfo(digest)
+
+    # Files can be added again once removed.
+    self.assertEqual(digest, self.store.add_file(self.firmware_fname))
+    self.assertEqual([digest], os.listdir(TEMP_STORE_DIR))
+
+
+
+
+
+# Run unit test.
+if __name__ == '__main__':
+  unittest.main()
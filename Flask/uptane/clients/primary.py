@@ -22,11 +22,18 @@ from tuf import download
 import uptane # Import before TUF modules; may change tuf.conf values.
 
 import os # For paths and makedirs
+import io # for in-memory metadata bundles
 import shutil # For copyfile
 import random # for nonces
 import zipfile
+import fnmatch # for delegated targets roles' paths
 import hashlib # if we're using DER encoding
 import iso8601
+import concurrent.futures # for concurrent target downloads
+
+from six.moves.urllib.error import HTTPError, URLError
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.request import Request, urlopen, url2pathname
 
 import tuf.formats
 import tuf.conf
@@ -59,6 +66,17 @@ log.addHandler(uptane.file_handler)
 log.addHandler(uptane.console_handler)
 log.setLevel(uptane.logging.DEBUG)
 
+# If True, before refreshing a repository's metadata, the Primary checks
+# whether the repository's timestamp metadata has changed since it last
+# refreshed that repository, using the validator (ETag or Last-Modified date)
+# the repository sent for it, and skips the refresh if it has not. An update
+# cycle in which no repository has changed then does nothing further. See
+# Primary.refresh_toplevel_metadata().
+CONDITIONAL_METADATA_REFRESH = True
+
+# How long, in seconds, to wait for a repository to respond to a request for
+# the validator of its timestamp metadata before refreshing it regardless.
+METADATA_VALIDATOR_TIMEOUT = 5
 
 
 class Primary(object): # Consider inheriting from Secondary and refactoring.
@@ -129,6 +147,13 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
       This is a list of all ECU Serials belonging to Secondaries of this
       Primary.
 
+    self.secondary_public_keys:
+      A dictionary mapping the ECU Serials of those Secondaries whose public
+      keys this Primary has been given (see register_new_secondary) to those
+      keys. ECU Manifests from these Secondaries are checked against their
+      keys before being accepted; ECU Manifests from other Secondaries are
+      not checked (see self.ecu_manifests).
+
     self.assigned_targets:
       A dict mapping ECU Serial to the target file info that the Director has
       instructed that ECU to install.
@@ -165,6 +190,43 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
       each update cycle, once it is safe to use. This is atomically moved into
       place (renamed) after it has been fully written, to avoid race conditions.
 
+    self.metadata_bundles:
+      A dict mapping the ECU Serial of each of this Primary's Secondaries to a
+      compressed zip archive (bytes) of just the metadata that a Full
+      Verification Secondary needs to validate the targets assigned to it,
+      rebuilt with the distributable metadata files after each update cycle.
+      See save_distributable_metadata_files().
+
+    self.metadata_validators:
+      A dict mapping the name of each repository whose metadata this Primary
+      has refreshed to the mirror and validator of its timestamp metadata at
+      the time, as returned by get_metadata_validator(). Used to skip
+      refreshing repositories that have not changed (see
+      CONDITIONAL_METADATA_REFRESH).
+
+    self.metadata_refresh_counts:
+      A dict mapping the name of each repository to a dict counting the times
+      its metadata was 'refreshed', and the times it was found 'unchanged' and
+      not refreshed.
+
+    self.download_workers:
+      The number of threads across which the downloads of the targets
+      assigned to this Primary's Secondaries are spread in each update cycle.
+      If None or 1, targets are downloaded one at a time. The threads share
+      self.updater, which has not been shown to be safe to download through
+      from several threads at once, so this is best left at None or 1 outside
+      of testing.
+
+    self.update_cycle_counts:
+      A dict counting the update cycles (calls to primary_update_cycle()) that
+      were 'full', and those that were no-ops because no repository had
+      changed since the last full cycle ('unchanged').
+
+    self.distributable_metadata_counts:
+      A dict counting the calls to save_distributable_metadata_files() that
+      'saved' the distributable metadata files, and those that left them as
+      they were because no metadata had changed ('unchanged').
+
 
   Methods organized by purpose: ("self" arguments excluded)
 
@@ -189,6 +251,7 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
       get_image_fname_for_ecu(ecu_serial)
       get_full_metadata_archive_fname()
       get_partial_metadata_fname()
+      get_metadata_bundle_for_ecu(ecu_serial)
       register_new_secondary(ecu_serial)
 
     Private methods:
@@ -231,7 +294,8 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
     primary_key,
     time,
     timeserver_public_key,
-    my_secondaries=None):
+    my_secondaries=None,
+    download_workers=None):
 
     """
     <Purpose>
@@ -253,6 +317,8 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
 
       my_secondaries        See class docstring above. (optional)
 
+      download_workers      See class docstring above. (optional)
+
       time
         An initial time to set the Primary's "clock" to, conforming to
         tuf.formats.ISO8601_DATETIME_SCHEMA.
@@ -279,6 +345,8 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
     uptane.formats.ECU_SERIAL_SCHEMA.check_match(ecu_serial)
     tuf.formats.ANYKEY_SCHEMA.check_match(timeserver_public_key)
     tuf.formats.ANYKEY_SCHEMA.check_match(primary_key)
+    if download_workers is not None:
+      tuf.formats.LENGTH_SCHEMA.check_match(download_workers)
     # TODO: Should also check that primary_key is a private key, not a
     # public key.
 
@@ -294,7 +362,9 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
     self.my_secondaries = my_secondaries
     if self.my_secondaries is None:
       self.my_secondaries = [] # (because must not use mutable as default value)
+    self.secondary_public_keys = {}
     self.director_repo_name = director_repo_name
+    self.download_workers = download_workers
 
     self.temp_full_metadata_archive_fname = os.path.join(
         full_client_dir, 'metadata', 'temp_full_metadata_archive.zip')
@@ -319,6 +389,28 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
     # support the case in which multiple manifests have come from that ECU.
     self.ecu_manifests = {}
 
+    self.metadata_bundles = {}
+    self.metadata_validators = {}
+    self.metadata_refresh_counts = {}
+    self.update_cycle_counts = {'full': 0, 'unchanged': 0}
+
+    # The ECU Serials of this Primary's Secondaries at the end of the last
+    # update cycle that was completed and obtained all targets, or None if the
+    # last update cycle was not. An update cycle can only be skipped if this
+    # is not None and the Secondaries are the same.
+    self._secondaries_at_last_full_cycle = None
+
+    self.distributable_metadata_counts = {'saved': 0, 'unchanged': 0}
+
+    # The (path in the archive, contents) of each metadata file in the
+    # distributable metadata last saved, or None if it has not been saved.
+    self._distributable_metadata = None
+
+    # Maps the filename of each metadata file last read by
+    # save_distributable_metadata_files() to its (size, modification time,
+    # contents), so that files that have not changed are not read again.
+    self._metadata_file_cache = {}
+
 
     # Create a TUF-TAP-4-compliant updater object. This will read pinning.json
     # and create single-repository updaters within it to handle connections to
@@ -350,18 +442,116 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
           whatever currently trusted Root metadata we ended up with was expired.
       - tuf.NoWorkingMirrorError:
           if we could not obtain and verify all necessary metadata
+
+    If CONDITIONAL_METADATA_REFRESH is True, a repository is not refreshed if
+    its timestamp metadata has not changed since the last time it was
+    refreshed (see _refresh_repository()).
+
+    The Director repository is refreshed first, and then any and all other
+    repositories (presumably Image Repositories), unless
+    uptane.common.PARALLEL_METADATA_REFRESH is True, in which case they are
+    refreshed in parallel. Either way, this returns only once all of them
+    have been refreshed, and if refreshing the Director fails, that error is
+    the one raised. See uptane.common.refresh_repositories().
+
+    Returns True if any repository was refreshed, and False if none had
+    changed.
     """
+    return any(uptane.common.refresh_repositories(
+        self.updater, self.director_repo_name, self._refresh_repository))
 
-    # Refresh the Director first, per the Uptane Standard.
-    self.updater.refresh(repo_name=self.director_repo_name)
 
-    # Now that we've dealt with the Director repository, deal with any and all
-    # other repositories, presumably Image Repositories.
-    for repository_name in self.updater.repositories:
-      if repository_name == self.director_repo_name:
-        continue
 
-      self.updater.refresh(repo_name=repository_name)
+
+
+  def _refresh_repository(self, repository_name):
+    """
+    Refreshes the top-level metadata of the given repository, as
+    refresh_toplevel_metadata() describes, unless CONDITIONAL_METADATA_REFRESH
+    is True and all of the following hold, in which case nothing is
+    downloaded or verified:
+      - The validator of the repository's timestamp metadata is the same as
+        when the repository was last refreshed, so the repository has not
+        published new metadata since.
+      - None of the repository's currently trusted top-level metadata has
+        expired, according to the time this Primary last obtained from the
+        Timeserver. (If any has, the refresh is performed, and either obtains
+        new metadata or raises tuf.ExpiredMetadataError.)
+
+    Returns True if the repository was refreshed, and False if not.
+    """
+    counts = self.metadata_refresh_counts.setdefault(
+        repository_name, {'refreshed': 0, 'unchanged': 0})
+
+    validator = None
+
+    if CONDITIONAL_METADATA_REFRESH:
+      validator = self._get_timestamp_validator(repository_name)
+
+      if validator is not None and \
+          validator == self.metadata_validators.get(repository_name) and \
+          self._trusted_metadata_is_unexpired(repository_name):
+        log.debug('Timestamp metadata from repository ' +
+            repr(repository_name) + ' is unchanged. Not refreshing.')
+        counts['unchanged'] += 1
+        return False
+
+    self.updater.refresh(repo_name=repository_name)
+
+    # Save the validator only once the refresh has succeeded, so that a failed
+    # refresh is retried.
+    self.metadata_validators[repository_name] = validator
+    counts['refreshed'] += 1
+    return True
+
+
+
+
+
+  def _get_timestamp_validator(self, repository_name):
+    """
+    Returns (mirror, validator) for the timestamp metadata of the given
+    repository at the first of its mirrors that provides a validator for it,
+    or None if none does.
+    """
+    previous = self.metadata_validators.get(repository_name)
+
+    for mirror in self.updater.repositories[repository_name].mirrors:
+      url = mirror.rstrip('/') + '/metadata/timestamp.' + \
+          tuf.conf.METADATA_FORMAT
+
+      previous_validator = None
+      if previous is not None and previous[0] == mirror:
+        previous_validator = previous[1]
+
+      validator = get_metadata_validator(url, previous_validator)
+
+      if validator is not None:
+        return (mirror, validator)
+
+    return None
+
+
+
+
+
+  def _trusted_metadata_is_unexpired(self, repository_name):
+    """
+    Returns True if all of the given repository's currently trusted top-level
+    metadata is unexpired, checked as the TUF updater checks it when
+    refreshing.
+    """
+    repository = self.updater.repositories[repository_name]
+
+    try:
+      for rolename in ['root', 'timestamp', 'snapshot', 'targets']:
+        repository._ensure_not_expired(
+            repository.metadata['current'][rolename], rolename)
+
+    except (KeyError, tuf.ExpiredMetadataError):
+      return False
+
+    return True
 
 
 
@@ -502,6 +692,11 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
     reference implementation, but in this case, it is the most convenient way
     to maintain the existing interfaces with TUF and with demonstration code.)
 
+    If no repository has changed since the last update cycle that validated
+    all of the Director's instructions and obtained all of the targets, and
+    this Primary's Secondaries are the same, the rest of the cycle is skipped,
+    as its results would be the same (see CONDITIONAL_METADATA_REFRESH).
+
 
     <Exceptions>
       uptane.Error
@@ -512,8 +707,31 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
           file of type tuf.conf.METADATA_FORMAT.
     """
     download_result = "success"
+
+    # Whether all of the Director's instructions have been validated and all
+    # of the targets obtained, in which case there is no need to try again
+    # until something changes.
+    all_targets_obtained = True
+
+    # If no repository has changed since the last update cycle in which all
+    # targets were obtained, and this Primary has the same Secondaries, that
+    # cycle's results stand and there is nothing more to do. This is cleared
+    # until the end of this cycle in case it fails part way through.
+    secondaries_at_last_full_cycle = self._secondaries_at_last_full_cycle
+    self._secondaries_at_last_full_cycle = None
+
     log.debug('Refreshing top level metadata from all repositories.')
-    self.refresh_toplevel_metadata()
+    metadata_refreshed = self.refresh_toplevel_metadata()
+
+    if not metadata_refreshed and \
+        secondaries_at_last_full_cycle == self.my_secondaries:
+      log.debug('No repository has changed since the last update cycle. '
+          'Skipping the rest of this update cycle.')
+      self._secondaries_at_last_full_cycle = secondaries_at_last_full_cycle
+      self.update_cycle_counts['unchanged'] += 1
+      return download_result
+
+    self.update_cycle_counts['full'] += 1
 
     # Get the list of targets the director expects us to download and update to.
     # Note that at this line, this target info is not yet validated with the
@@ -555,6 +773,7 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
         verified_targets.append(self.get_validated_target_info(target_filepath))
 
       except tuf.UnknownTargetError:
+        all_targets_obtained = False
         log.warning(RED + 'Director has instructed us to download a target (' +
             target_filepath + ') that is not validated by the combination of '
             'Image + Director Repositories. That update IS BEING SKIPPED. It '
@@ -595,6 +814,16 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
         repr(verified_target_filepaths))
 
 
+    # Make sure the resulting filenames are actually in the client directory.
+    # (In other words, enforce a jail.)
+    # TODO: Do a proper review of this, and determine if it's necessary and
+    # how to do it properly.
+    full_targets_directory = os.path.abspath(os.path.join(
+        self.full_client_dir, 'targets'))
+
+    # The targets to download, as (target, filepath, full_fname) tuples.
+    targets_to_download = []
+
     # For each target for which we have verified metadata:
     for target in verified_targets:
 
@@ -619,34 +848,38 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
       # Save the target info as an update assigned to that ECU.
       self.assigned_targets[assigned_ecu_serial] = target
 
-
-      # Make sure the resulting filename is actually in the client directory.
-      # (In other words, enforce a jail.)
-      # TODO: Do a proper review of this, and determine if it's necessary and
-      # how to do it properly.
-      full_targets_directory = os.path.abspath(os.path.join(
-          self.full_client_dir, 'targets'))
       filepath = target['filepath']
       if filepath[0] == '/':
         filepath = filepath[1:]
       full_fname = os.path.join(full_targets_directory, filepath)
       enforce_jail(filepath, full_targets_directory)
 
-      # Download each target.
-      # Now that we have fileinfo for all targets listed by both the Director and
-      # the Image Repository -- which should include file2.txt in this test --
-      # we can download the target files and only keep each if it matches the
-      # verified fileinfo. This call will try every mirror on every repository
-      # within the appropriate delegation in pinned.json until one of them works.
-      # In this case, both the Director and Image Repo are hosting the
-      # file, just for my convenience in setup. If you remove the file from the
-      # Director before calling this, it will still work (assuming Image Repo
-      # still has it). (The second argument here is just where to put the
-      # files.)
-      try:
-        self.updater.download_target(target, full_targets_directory)
-
-      except tuf.NoWorkingMirrorError as e:
+      targets_to_download.append((target, filepath, full_fname))
+
+
+    # Download each target.
+    # Now that we have fileinfo for all targets listed by both the Director and
+    # the Image Repository -- which should include file2.txt in this test --
+    # we can download the target files and only keep each if it matches the
+    # verified fileinfo. Each download will try every mirror on every
+    # repository within the appropriate delegation in pinned.json until one of
+    # them works.
+    # In this case, both the Director and Image Repo are hosting the
+    # file, just for my convenience in setup. If you remove the file from the
+    # Director before calling this, it will still work (assuming Image Repo
+    # still has it).
+    # The targets are downloaded concurrently if download_workers is greater
+    # than 1 (see _download_targets()), and the results are then handled in
+    # order.
+    download_errors = self._download_targets(
+        [target for target, filepath, full_fname in targets_to_download],
+        full_targets_directory)
+
+    for (target, filepath, full_fname), e in zip(
+        targets_to_download, download_errors):
+
+      if e is not None:
+        all_targets_obtained = False
         error_report = ''
         for mirror in e.mirror_errors:
           error_report += \
@@ -722,12 +955,55 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
     # into place atomically after being constructed or copied. Secondaries
     # may be requesting these files live.
     self.save_distributable_metadata_files()
+
+    if all_targets_obtained:
+      self._secondaries_at_last_full_cycle = list(self.my_secondaries)
+
     return download_result
 
 
 
 
 
+  def _download_targets(self, targets, destination_directory):
+    """
+    Downloads each of the given targets (conforming to
+    tuf.formats.TARGETFILE_SCHEMA) into destination_directory, as
+    self.updater.download_target() does, spreading the downloads across
+    download_workers threads if download_workers is greater than 1.
+
+    Returns a list with, for each target in order, None if it was downloaded
+    and verified, or the tuf.NoWorkingMirrorError raised if it was not. Any
+    other exception is raised as soon as it occurs: downloads not yet started
+    are cancelled, and those in progress are waited for.
+    """
+    def download(target):
+      try:
+        self.updater.download_target(target, destination_directory)
+      except tuf.NoWorkingMirrorError as e:
+        return e
+      return None
+
+    if self.download_workers is None or self.download_workers <= 1 or \
+        len(targets) <= 1:
+      return [download(target) for target in targets]
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(self.download_workers, len(targets))) as executor:
+      futures = [executor.submit(download, target) for target in targets]
+
+      for future in concurrent.futures.as_completed(futures):
+        if future.exception() is not None:
+          for other_future in futures:
+            other_future.cancel()
+          future.result()
+
+    return [future.result() for future in futures]
+
+
+
+
+
   def get_image_fname_for_ecu(self, ecu_serial):
     """
     Given an ECU serial, returns:
@@ -790,6 +1066,33 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
 
 
 
+  def get_metadata_bundle_for_ecu(self, ecu_serial):
+    """
+    Returns a compressed zip archive (bytes) of the metadata that the given
+    Full Verification Secondary needs to validate the targets assigned to it,
+    laid out as in the full metadata archive (see
+    get_full_metadata_archive_fname()), or None if no bundle has been built
+    for that Secondary yet (e.g. it was registered after the last update
+    cycle).
+
+    Bundles are kept in memory and rebuilt only by
+    save_distributable_metadata_files(), so this does no work per request.
+
+    <Exceptions>
+      tuf.FormatError
+        if the given ecu_serial is not of the correct format
+
+      uptane.UnknownECU
+        if the given ecu_serial is not registered with this Primary
+    """
+    self._check_ecu_serial(ecu_serial)
+
+    return self.metadata_bundles.get(ecu_serial)
+
+
+
+
+
   def update_exists_for_ecu(self, ecu_serial):
     """
     Returns True if the Director has sent us instructions for the Secondary ECU
@@ -922,14 +1225,23 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
 
 
 
-  def register_new_secondary(self, ecu_serial):
+  def register_new_secondary(self, ecu_serial, public_key=None):
     """
     Currently called by Secondaries, but one would expect that this would happen
     through some other mechanism when a new Secondary ECU is installed in the
     vehicle.
+
+    If public_key is provided, it is kept in self.secondary_public_keys, and
+    the signatures on ECU Manifests from this Secondary are checked against it
+    (see register_ecu_manifest). This may be done for a Secondary that is
+    already registered.
     """
     uptane.formats.ECU_SERIAL_SCHEMA.check_match(ecu_serial)
 
+    if public_key is not None:
+      tuf.formats.ANYKEY_SCHEMA.check_match(public_key)
+      self.secondary_public_keys[ecu_serial] = public_key
+
     if ecu_serial in self.my_secondaries:
       log.info('ECU Serial ' + repr(ecu_serial) + ' already registered with '
           'this Primary.')
@@ -973,9 +1285,13 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
       Called by Secondaries (in the demo, this is via an XMLRPC interface, or
       through another interface and passed through the XMLRPC interface).
 
-      The Primary need not track ECU keys, so calling this doesn't result in a
-      verification of the ECU's signature on the ECU manifest. This information
-      is bundled together in a single vehicle report to the Director service.
+      The Primary need not track ECU keys, so calling this doesn't generally
+      result in a verification of the ECU's signature on the ECU manifest. This
+      information is bundled together in a single vehicle report to the
+      Director service. If the Secondary's public key has been provided (see
+      register_new_secondary), however, the signatures on the ECU Manifest
+      are checked against it, all in one batch, and the ECU Manifest is
+      rejected unless at least one of them is valid.
 
     <Arguments>
       vin
@@ -1031,6 +1347,10 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
       uptane.UnknownVehicle
           if the VIN argument is not the same as this primary's VIN
 
+      tuf.BadSignatureError
+          if the Secondary's public key is known and no signature on the ECU
+          Manifest is a valid signature by that key
+
       tuf.FormatError
           if any of the arguments are not in the expected formats.
 
@@ -1073,6 +1393,10 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
           'signed in the manifest itself (' +
           repr(signed_ecu_manifest['signed']['ecu_serial']) + ').')
 
+    if ecu_serial in self.secondary_public_keys:
+      self._check_ecu_manifest_signatures(
+          ecu_serial, signed_ecu_manifest, force_pydict)
+
     # If we haven't errored out above, then the format is correct, so save
     # the manifest to the Primary's dictionary of manifests.
     if ecu_serial in self.ecu_manifests:
@@ -1099,6 +1423,36 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
 
 
 
+  def _check_ecu_manifest_signatures(
+      self, ecu_serial, signed_ecu_manifest, force_pydict):
+    """
+    Checks every signature on the given ECU Manifest against the known public
+    key of the Secondary with the given ECU Serial, in a single batch, and
+    raises tuf.BadSignatureError unless at least one of them is valid.
+    Called by register_ecu_manifest.
+    """
+    public_key = self.secondary_public_keys[ecu_serial]
+
+    if force_pydict:
+      metadata_format = 'json'
+    else:
+      metadata_format = tuf.conf.METADATA_FORMAT
+
+    verification_requests = [
+        (public_key, signature, signed_ecu_manifest['signed'],
+        DATATYPE_ECU_MANIFEST)
+        for signature in signed_ecu_manifest['signatures']]
+
+    if not any(uptane.common.verify_signatures_over_metadata(
+        verification_requests, metadata_format=metadata_format)):
+      raise tuf.BadSignatureError('Received an ECU Manifest from ECU ' +
+          repr(ecu_serial) + ' that is not validly signed by the known key '
+          'for that ECU; discarding it.')
+
+
+
+
+
   def get_nonces_to_send_and_rotate(self):
     """
     This should be called once when it is time to make a request for a signed
@@ -1220,50 +1574,99 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
     implementers' higher level Primary code. (Example in demo/demo_primary.py)
 
     The files here are each moved into place atomically to help avoid race
-    conditions.
+    conditions. Metadata files are read only if their size or modification
+    time has changed since they were last read, and if no metadata file has
+    changed in content since the files were last saved, the files already in
+    place are kept.
+
+    Per-Secondary metadata bundles are then rebuilt in memory (see
+    self.metadata_bundles and _build_metadata_bundles()).
     """
 
     metadata_base_dir = os.path.join(self.full_client_dir, 'metadata')
 
     # Full Verification Metadata Preparation
 
-    # Save a zipped version of all of the metadata.
+    # Collect all of the metadata, as (path in the archive, contents) pairs.
     # Note that some stale metadata may be retained, but should never affect
     # security. Worth confirming.
     # What we want here, basically, is:
     #  <full_client_dir>/metadata/*/current/*.json or *.der
+    members = []
+    member_mtimes = []
+    metadata_file_cache = {}
+
+    # For each repository directory within the client metadata directory
+    for repo_dir in sorted(os.listdir(metadata_base_dir)):
+      # Construct path to "current" metadata directory for that repository in
+      # the client metadata directory, relative to Uptane working directory.
+      abs_repo_dir = os.path.join(metadata_base_dir, repo_dir, 'current')
+      if not os.path.isdir(abs_repo_dir):
+        continue
+
+      # Add each role metadata file to the archive.
+      for role_fname in sorted(os.listdir(abs_repo_dir)):
+        # Reconstruct file path relative to Uptane working directory.
+        role_abs_fname = os.path.join(abs_repo_dir, role_fname)
+
+        # Make sure it's the right type of file. Should be a file, not a
+        # directory. Symlinks are OK. Should end in an extension matching
+        # tuf.conf.METADATA_FORMAT (presumably .json or .der, depending on
+        # that setting).
+        if not os.path.isfile(role_abs_fname) or not role_abs_fname.endswith(
+            '.' + tuf.conf.METADATA_FORMAT):
+          # Consider special error type.
+          raise uptane.Error('Unexpected file type in a metadata '
+              'directory: ' + repr(role_abs_fname) + ' Expecting only ' +
+              tuf.conf.METADATA_FORMAT + 'files.')
+
+        # Read the file only if its size or modification time has changed
+        # since it was last read.
+        stat = os.stat(role_abs_fname)
+        cached = self._metadata_file_cache.get(role_abs_fname)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime):
+          contents = cached[2]
+        else:
+          with open(role_abs_fname, 'rb') as fobj:
+            contents = fobj.read()
+        metadata_file_cache[role_abs_fname] = (
+            stat.st_size, stat.st_mtime, contents)
+
+        # Adjust the path in the archive so that when expanded, it resembles
+        # repository structure rather than a client directory structure.
+        members.append(
+            (os.path.join(repo_dir, 'metadata', role_fname), contents))
+        member_mtimes.append(stat.st_mtime)
+
+    self._metadata_file_cache = metadata_file_cache
+
+    # If no metadata file has changed in content since the distributable files
+    # were last saved (e.g. files were rewritten by a refresh that found
+    # nothing new), the files already in place are kept as they are.
+    if members == self._distributable_metadata and \
+        os.path.exists(self.distributable_full_metadata_archive_fname) and \
+        os.path.exists(self.distributable_partial_metadata_fname):
+      log.debug('Distributable metadata is unchanged. Not saving it again.')
+      self.distributable_metadata_counts['unchanged'] += 1
+
+      # Bundles depend on the Secondaries, too.
+      if set(self.metadata_bundles) != set(self.my_secondaries):
+        self.metadata_bundles = self._build_metadata_bundles()
+      return
+
+    # Forget what was last saved, so that if saving fails part way through,
+    # the files are saved again next time.
+    self._distributable_metadata = None
+
+    # Save a zipped version of all of the metadata, as archive.write() would
+    # from the files, but from the contents already read.
     with zipfile.ZipFile(self.temp_full_metadata_archive_fname, 'w') \
         as archive:
-      # For each repository directory within the client metadata directory
-      for repo_dir in os.listdir(metadata_base_dir):
-        # Construct path to "current" metadata directory for that repository in
-        # the client metadata directory, relative to Uptane working directory.
-        abs_repo_dir = os.path.join(metadata_base_dir, repo_dir, 'current')
-        if not os.path.isdir(abs_repo_dir):
-          continue
-
-        # Add each role metadata file to the archive.
-        for role_fname in os.listdir(abs_repo_dir):
-          # Reconstruct file path relative to Uptane working directory.
-          role_abs_fname = os.path.join(abs_repo_dir, role_fname)
-
-          # Make sure it's the right type of file. Should be a file, not a
-          # directory. Symlinks are OK. Should end in an extension matching
-          # tuf.conf.METADATA_FORMAT (presumably .json or .der, depending on
-          # that setting).
-          if not os.path.isfile(role_abs_fname) or not role_abs_fname.endswith(
-              '.' + tuf.conf.METADATA_FORMAT):
-            # Consider special error type.
-            raise uptane.Error('Unexpected file type in a metadata '
-                'directory: ' + repr(role_abs_fname) + ' Expecting only ' +
-                tuf.conf.METADATA_FORMAT + 'files.')
-
-          # Write the file to the archive, adjusting the path in the archive so
-          # that when expanded, it resembles repository structure rather than
-          # a client directory structure.
-          archive.write(
-              role_abs_fname,
-              os.path.join(repo_dir, 'metadata', role_fname))
+      for (member, contents), mtime in zip(members, member_mtimes):
+        member_info = zipfile.ZipInfo(
+            member, date_time=time.localtime(mtime)[:6])
+        member_info.external_attr = 0o644 << 16
+        archive.writestr(member_info, contents)
 
 
     # Partial Verification Metadata Preparation
@@ -1291,6 +1694,144 @@ class Primary(object): # Consider inheriting from Secondary and refactoring.
         self.temp_full_metadata_archive_fname,
         self.distributable_full_metadata_archive_fname)
 
+    self._distributable_metadata = members
+    self.distributable_metadata_counts['saved'] += 1
+
+    # Replace the bundles all at once, so that a Secondary's request arriving
+    # meanwhile receives either its old bundle or its new one.
+    self.metadata_bundles = self._build_metadata_bundles()
+
+
+
+
+
+  def _build_metadata_bundles(self):
+    """
+    Returns a dict mapping the ECU Serial of each of this Primary's Secondaries
+    to a compressed zip archive (bytes) of the metadata validated by this
+    Primary that the Secondary needs in order to fully validate the targets
+    the Director has assigned to it: the top-level metadata of every
+    repository, and only the delegated targets metadata that may list those
+    targets.
+
+    The metadata is that last saved by save_distributable_metadata_files(), so
+    no files are read. Secondaries that need the same metadata share one
+    archive, which is compressed only once. Archives are built
+    deterministically (with fixed member timestamps), so an archive of
+    unchanged metadata is byte-for-byte the same as the last one.
+    """
+    # The target file paths assigned to each Secondary in the Director's
+    # current targets metadata.
+    filepaths_by_ecu = dict(
+        (ecu_serial, []) for ecu_serial in self.my_secondaries)
+    director_targets = self.updater.repositories[self.director_repo_name] \
+        .metadata['current'].get('targets', {}).get('targets', {})
+    for filepath, fileinfo in director_targets.items():
+      ecu_serial = fileinfo.get('custom', {}).get('ecu_serial')
+      if ecu_serial in filepaths_by_ecu:
+        filepaths_by_ecu[ecu_serial].append(filepath)
+
+    contents_by_member = dict(self._distributable_metadata or [])
+    bundles_by_members = {}
+    metadata_bundles = {}
+
+    for ecu_serial, filepaths in filepaths_by_ecu.items():
+      members = []
+
+      for repository_name in sorted(self.updater.repositories):
+        repository = self.updater.repositories[repository_name]
+        rolenames = ['root', 'snapshot', 'targets', 'timestamp'] + \
+            _get_delegated_rolenames(repository.metadata['current'], filepaths)
+
+        for rolename in rolenames:
+          member = os.path.join(repository_name, 'metadata',
+              rolename + '.' + tuf.conf.METADATA_FORMAT)
+          if member in contents_by_member:
+            members.append(member)
+
+      members = tuple(members)
+      if members not in bundles_by_members:
+        bundles_by_members[members] = _zip_metadata(
+            [(member, contents_by_member[member]) for member in members])
+
+      metadata_bundles[ecu_serial] = bundles_by_members[members]
+
+    return metadata_bundles
+
+
+
+
+
+def _get_delegated_rolenames(current_metadata, target_filepaths):
+  """
+  Returns the names of the delegated targets roles, among those whose metadata
+  is in current_metadata (a single repository's metadata['current']), that
+  are trusted with any of the given target file paths, in the order in which
+  they are delegated. Since a role is included whether or not a role
+  delegated before it turns out to list the target, this is a superset of the
+  roles the TUF updater visits when looking for the target.
+  """
+  rolenames = []
+  rolenames_to_visit = ['targets']
+
+  while rolenames_to_visit:
+    metadata = current_metadata.get(rolenames_to_visit.pop(0))
+    if metadata is None or not metadata.get('delegations'):
+      continue
+
+    for child_role in metadata['delegations'].get('roles', []):
+      child_rolename = child_role['name']
+      if child_rolename in rolenames or child_rolename not in current_metadata:
+        continue
+
+      for target_filepath in target_filepaths:
+        if _delegation_includes_target(child_role, target_filepath):
+          rolenames.append(child_rolename)
+          rolenames_to_visit.append(child_rolename)
+          break
+
+  return rolenames
+
+
+
+
+
+def _delegation_includes_target(child_role, target_filepath):
+  """
+  Returns True if the given delegation (an entry in a targets role's
+  delegations) trusts the delegated role with the given target file path,
+  judged as the TUF updater judges it.
+  """
+  if child_role.get('path_hash_prefixes') is not None:
+    target_filepath_hash = hashlib.sha256(
+        target_filepath.encode('utf-8')).hexdigest()
+    return any(target_filepath_hash.startswith(prefix)
+        for prefix in child_role['path_hash_prefixes'])
+
+  return any(fnmatch.fnmatch(target_filepath, path)
+      for path in child_role.get('paths', []))
+
+
+
+
+
+def _zip_metadata(members):
+  """
+  Returns a compressed zip archive (bytes) of the given (archive path,
+  contents) pairs. Member timestamps are fixed, so that the same members
+  always produce the same archive.
+  """
+  archive_bytes = io.BytesIO()
+
+  with zipfile.ZipFile(archive_bytes, 'w') as archive:
+    for member, contents in members:
+      member_info = zipfile.ZipInfo(member, date_time=(1980, 1, 1, 0, 0, 0))
+      member_info.compress_type = zipfile.ZIP_DEFLATED
+      member_info.external_attr = 0o644 << 16
+      archive.writestr(member_info, contents)
+
+  return archive_bytes.getvalue()
+
 
 
 
@@ -1308,3 +1849,89 @@ def enforce_jail(fname, expected_containing_dir):
 
   else:
     return abs_fname
+
+
+
+
+
+def get_metadata_validator(url, previous_validator=None):
+  """
+  <Purpose>
+    Returns a validator for the metadata file at the given URL: a string that
+    changes whenever the file does, obtained without downloading the file if
+    possible. Comparing it to the validator obtained before shows whether the
+    file has changed since.
+
+    For HTTP(S) URLs, the validator is the ETag or, failing that, the
+    Last-Modified date sent by the server in response to a HEAD request. If
+    previous_validator is given, the request is made conditional on it, and
+    a 304 Not Modified response returns previous_validator.
+
+    For file URLs (used in testing), the validator is the hash of the file's
+    contents, since a metadata file may be replaced by another of the same size
+    and modification time.
+
+  <Arguments>
+    url
+      The URL of the metadata file, e.g.
+      'http://localhost:30301/metadata/timestamp.der'
+
+    previous_validator
+      A validator previously returned by this function for the same URL, or
+      None.
+
+  <Exceptions>
+    None. Failure to obtain a validator is reported by returning None.
+
+  <Side Effects>
+    Makes a HEAD request to the server, or reads the file.
+
+  <Returns>
+    The validator, or None if none could be obtained (e.g. if the server sends
+    neither an ETag nor a Last-Modified date, or cannot be reached), in which
+    case the file should be treated as changed.
+  """
+  parsed_url = urlparse(url)
+
+  if parsed_url.scheme == 'file':
+    try:
+      with open(url2pathname(parsed_url.path), 'rb') as fileobj:
+        return 'sha256:' + hashlib.sha256(fileobj.read()).hexdigest()
+    except (IOError, OSError):
+      return None
+
+  elif parsed_url.scheme not in ['http', 'https']:
+    return None
+
+  request = Request(url)
+  request.get_method = lambda: 'HEAD'
+
+  if previous_validator is not None:
+    kind, value = previous_validator.split(':', 1)
+    if kind == 'etag':
+      request.add_header('If-None-Match', value)
+    else:
+      request.add_header('If-Modified-Since', value)
+
+  try:
+    response = urlopen(request, timeout=METADATA_VALIDATOR_TIMEOUT)
+
+  except HTTPError as e:
+    if e.code == 304 and previous_validator is not None:
+      return previous_validator
+    return None
+
+  except (URLError, IOError, OSError):
+    return None
+
+  try:
+    headers = response.info()
+    if headers.get('ETag'):
+      return 'etag:' + headers.get('ETag')
+    elif headers.get('Last-Modified'):
+      return 'last-modified:' + headers.get('Last-Modified')
+    else:
+      return None
+
+  finally:
+    response.close()
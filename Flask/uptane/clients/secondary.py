@@ -52,6 +52,12 @@ log.addHandler(uptane.file_handler)
 log.addHandler(uptane.console_handler)
 log.setLevel(uptane.logging.DEBUG)
 
+# If True, a Secondary that is given a metadata archive identical to the last
+# one it fully validated does not expand and validate it again, so long as the
+# metadata it then validated has not since expired. See
+# Secondary.process_metadata().
+SKIP_UNCHANGED_METADATA_ARCHIVES = True
+
 
 
 class Secondary(object):
@@ -143,6 +149,16 @@ class Secondary(object):
       # TODO: Since this is now expected to always be one target, this should
       # just be a single value rather than a list....
 
+    self.last_metadata_archive_hash:
+      The SHA-256 hex digest of the last metadata archive that this Secondary
+      expanded and fully validated, or None if there is none (or the last
+      archive processed failed validation). Used to skip processing an
+      identical archive again (see SKIP_UNCHANGED_METADATA_ARCHIVES).
+
+    self.metadata_archive_counts:
+      A dict counting the metadata archives (calls to process_metadata()) that
+      were expanded and fully validated ('full'), and those that were skipped
+      because they were identical to the last one validated ('unchanged').
 
   Methods, as called: ("self" arguments excluded):
 
@@ -159,10 +175,12 @@ class Secondary(object):
     Metadata handling and verification of metadata and data
       update_time(timeserver_attestation)
       process_metadata(metadata_archive_fname)
+      _trusted_metadata_is_unexpired()
       _expand_metadata_archive(metadata_archive_fname)
       fully_validate_metadata()
       get_validated_target_info(target_filepath)
       validate_image(image_fname)
+      get_image_receiver(image_fname, partial_filepath)
 
 
 
@@ -278,6 +296,9 @@ class Secondary(object):
     self.nonce_next = self._create_nonce()
     self.validated_targets_for_this_ecu = []
 
+    self.last_metadata_archive_hash = None
+    self.metadata_archive_counts = {'full': 0, 'unchanged': 0}
+
 
 
 
@@ -487,18 +508,15 @@ class Secondary(object):
           whatever currently trusted Root metadata we ended up with was expired.
       - tuf.NoWorkingMirrorError:
           if we could not obtain and verify all necessary metadata
-    """
-
-    # Refresh the Director first, per the Uptane Standard.
-    self.updater.refresh(repo_name=self.director_repo_name)
 
-    # Now that we've dealt with the Director repository, deal with any and all
-    # other repositories, presumably Image Repositories.
-    for repository_name in self.updater.repositories:
-      if repository_name == self.director_repo_name:
-        continue
-
-      self.updater.refresh(repo_name=repository_name)
+    The Director repository is refreshed first, and then any and all other
+    repositories (presumably Image Repositories), unless
+    uptane.common.PARALLEL_METADATA_REFRESH is True, in which case they are
+    refreshed in parallel. Either way, this returns only once all of them
+    have been refreshed, and if refreshing the Director fails, that error is
+    the one raised. See uptane.common.refresh_repositories().
+    """
+    uptane.common.refresh_repositories(self.updater, self.director_repo_name)
 
 
 
@@ -607,14 +625,62 @@ class Secondary(object):
     Select the Director targets.json file
     Pick out the target file(s) with our ECU serial listed
     Fully validate the metadata for the target file(s)
+
+    If SKIP_UNCHANGED_METADATA_ARCHIVES is True and the archive is identical
+    to the last one fully validated, and all of the metadata then validated is
+    still unexpired, the archive is neither expanded nor validated again, and
+    self.validated_targets_for_this_ecu is left as it is.
     """
     tuf.formats.RELPATH_SCHEMA.check_match(metadata_archive_fname)
 
+    archive_hash = None
+
+    if SKIP_UNCHANGED_METADATA_ARCHIVES and \
+        os.path.exists(metadata_archive_fname):
+      with open(metadata_archive_fname, 'rb') as fobj:
+        length, hashes = uptane.common.compute_file_hashes(fobj, ['sha256'])
+      archive_hash = hashes['sha256']
+
+      if archive_hash == self.last_metadata_archive_hash and \
+          self._trusted_metadata_is_unexpired():
+        log.debug('Metadata archive is unchanged since it was last validated.'
+            ' Not validating it again.')
+        self.metadata_archive_counts['unchanged'] += 1
+        return
+
+    # Forget the last archive validated, so that if this one fails
+    # validation, the same archive is not skipped later.
+    self.last_metadata_archive_hash = None
+
     self._expand_metadata_archive(metadata_archive_fname)
 
     # This entails using the local metadata files as a repository.
     self.fully_validate_metadata()
 
+    self.last_metadata_archive_hash = archive_hash
+    self.metadata_archive_counts['full'] += 1
+
+
+
+
+
+  def _trusted_metadata_is_unexpired(self):
+    """
+    Returns True if all of the currently trusted top-level metadata of every
+    repository is unexpired, checked as the TUF updater checks it when
+    refreshing.
+    """
+    try:
+      for repository in self.updater.repositories.values():
+        for rolename in ['root', 'timestamp', 'snapshot', 'targets']:
+          repository._ensure_not_expired(
+              repository.metadata['current'][rolename], rolename)
+
+    except (KeyError, tuf.ExpiredMetadataError):
+      return False
+
+    return True
+
 
 
 
@@ -680,7 +746,10 @@ class Secondary(object):
 
       tuf.BadHashError
         if the file does not have the expected hash based on validated target
-        info
+        info. All hashes in the target info are checked, including SM3.
+
+      tuf.UnsupportedAlgorithmError
+        if the target info lists a hash algorithm that is not supported.
 
       tuf.FormatError
         if the given image_fname is not a path.
@@ -696,6 +765,91 @@ class Secondary(object):
     full_image_fname = os.path.join(
         self.full_client_dir, 'unverified_targets', image_fname)
 
+    # Check file length and hashes (including any SM3 hash) against trusted
+    # target info, reading the file only once.
+    trusted_fileinfo = self._get_validated_fileinfo(image_fname)
+
+    with open(full_image_fname, 'rb') as fobj:
+      observed_length, observed_hashes = uptane.common.compute_file_hashes(
+          fobj, list(trusted_fileinfo['hashes']))
+
+    _check_fileinfo(trusted_fileinfo, observed_length, observed_hashes)
+
+
+    # If no error has been raised at this point, the image file is fully
+    # validated and we can return.
+    log.debug('Delivered target file has been fully validated: ' +
+        repr(full_image_fname))
+
+
+
+
+
+  def get_image_receiver(self, image_fname, partial_filepath=None):
+    """
+    <Purpose>
+      Returns an ImageReceiver with which to receive the image with the given
+      filename in chunks as they arrive (e.g. from the Primary), validating
+      it as validate_image() would, but without reading it again once
+      written.
+
+      Once all chunks have been written to it, its commit() method moves the
+      image into place, in the 'unverified_targets' subdirectory of the client
+      directory (where validate_image() would expect to find it), but only if
+      it is valid.
+
+    <Arguments>
+
+      image_fname
+        As for validate_image().
+
+      partial_filepath (optional)
+        The path at which the image is kept until it has been fully received
+        and validated. If a file already exists there (from an interrupted
+        transfer of the same image), receiving resumes at its end.
+        By default, image_fname with '.part' appended, in the
+        'unverified_targets' directory.
+
+    <Exceptions>
+      uptane.Error
+        if the given filename does not match a filepath in the list of
+        validated targets for this ECU (as for validate_image())
+
+      tuf.FormatError
+        if the given image_fname is not a path.
+
+      See also ImageReceiver.
+
+    <Returns>
+      An ImageReceiver.
+
+    <Side-Effects>
+      Creates the 'unverified_targets' directory if it does not exist, and
+      opens (or creates) the partial file.
+    """
+    tuf.formats.PATH_SCHEMA.check_match(image_fname)
+
+    trusted_fileinfo = self._get_validated_fileinfo(image_fname)
+
+    unverified_targets_dir = os.path.join(
+        self.full_client_dir, 'unverified_targets')
+    if not os.path.exists(unverified_targets_dir):
+      os.makedirs(unverified_targets_dir)
+
+    full_image_fname = os.path.join(unverified_targets_dir, image_fname)
+
+    return ImageReceiver(trusted_fileinfo, full_image_fname, partial_filepath)
+
+
+
+
+
+  def _get_validated_fileinfo(self, image_fname):
+    """
+    Returns the fileinfo in the validated target info for this ECU whose
+    filepath (without any leading '/') is image_fname, or raises uptane.Error
+    if there is none.
+    """
     # Get target info by looking up fname (filepath).
 
     relevant_targetinfo = None
@@ -717,23 +871,188 @@ class Secondary(object):
           'for this is extremely small between two individually-atomic '
           'renames), or there has been a programming error....')
 
+    return relevant_targetinfo['fileinfo']
 
-    # Check file length against trusted target info.
-    with open(full_image_fname, 'rb') as fobj:
-      tuf.client.updater.hard_check_file_length(
-          fobj,
-          relevant_targetinfo['fileinfo']['length'])
 
-    # Check file hashes against trusted target info.
-    with open(full_image_fname, 'rb') as fobj:
-      tuf.client.updater.check_hashes(
-          fobj, # FIX
-          relevant_targetinfo['fileinfo']['hashes'],
-          reset_fpointer=True) # Important for multiple hashes
 
 
-    # If no error has been raised at this point, the image file is fully
-    # validated and we can return.
+
+class ImageReceiver(object):
+  """
+  <Purpose>
+    Receives an image in chunks, writing each to a partial file and updating
+    its length and hashes as it arrives, so that the image is validated
+    against trusted target info without being read again. Once the whole
+    image has been received, commit() checks it and, only if it is valid,
+    renames the partial file into place atomically.
+
+    Obtain one from Secondary.get_image_receiver().
+
+  <Fields>
+
+    trusted_fileinfo
+      The validated fileinfo (length and hashes) the image must match.
+
+    destination_filepath
+      The path to which the image is renamed by commit().
+
+    partial_filepath
+      The path at which the image is written until then.
+
+    length_received
+      The number of bytes of the image received so far, including any in the
+      partial file when this object was created. This is the offset at which
+      the next chunk should start.
+
+  Use:
+    receiver = secondary.get_image_receiver(image_fname)
+    while receiver.length_received < <length>:
+      receiver.write(<next chunk, starting at receiver.length_received>)
+    receiver.commit()
+  """
+
+  def __init__(
+      self, trusted_fileinfo, destination_filepath, partial_filepath=None):
+
+    tuf.formats.FILEINFO_SCHEMA.check_match(trusted_fileinfo)
+    tuf.formats.PATH_SCHEMA.check_match(destination_filepath)
+
+    if partial_filepath is None:
+      partial_filepath = destination_filepath + '.part'
+    tuf.formats.PATH_SCHEMA.check_match(partial_filepath)
+
+    self.trusted_fileinfo = trusted_fileinfo
+    self.destination_filepath = destination_filepath
+    self.partial_filepath = partial_filepath
+
+    self._hash_objects = uptane.common.new_hash_objects(
+        list(trusted_fileinfo['hashes']))
+    self.length_received = 0
+
+    # If a transfer of this image was interrupted, account for what was
+    # received then, unless there is more of it than the image can have.
+    if os.path.exists(partial_filepath):
+      if os.path.getsize(partial_filepath) > trusted_fileinfo['length']:
+        os.remove(partial_filepath)
+      else:
+        with open(partial_filepath, 'rb') as fobj:
+          self._update(
+              iter(lambda: fobj.read(uptane.common.FILE_HASH_CHUNK_SIZE), b''))
+
+    self._fileobj = open(partial_filepath, 'ab')
+
+
+
+
+
+  def write(self, data):
+    """
+    <Purpose>
+      Writes the next chunk of the image.
+
+    <Exceptions>
+      tuf.DownloadLengthMismatchError
+        if the image would then be longer than the trusted length, in which
+        case the chunk is not written and the partial file is removed.
+    """
+    if self.length_received + len(data) > self.trusted_fileinfo['length']:
+      self.abort()
+      raise tuf.DownloadLengthMismatchError(
+          self.trusted_fileinfo['length'], self.length_received + len(data))
+
+    self._fileobj.write(data)
+    self._update([data])
+
+
+
+
+
+  def commit(self):
+    """
+    <Purpose>
+      Checks the image received against the trusted length and hashes (as
+      Secondary.validate_image() does) and, if it matches, renames it to
+      destination_filepath, replacing any file there.
+
+    <Exceptions>
+      tuf.DownloadLengthMismatchError
+        if the image does not have the trusted length.
+
+      tuf.BadHashError
+        if the image does not have a trusted hash.
+
+      In either case, the partial file is removed.
+
+    <Returns>
+      destination_filepath
+    """
+    self._fileobj.close()
+
+    observed_hashes = dict((algorithm, hash_object.hexdigest())
+        for algorithm, hash_object in self._hash_objects.items())
+
+    try:
+      _check_fileinfo(
+          self.trusted_fileinfo, self.length_received, observed_hashes)
+    except (tuf.DownloadLengthMismatchError, tuf.BadHashError):
+      self.abort()
+      raise
+
+    os.rename(self.partial_filepath, self.destination_filepath)
+
     log.debug('Delivered target file has been fully validated: ' +
-        repr(full_image_fname))
+        repr(self.destination_filepath))
+
+    return self.destination_filepath
+
+
+
+
+
+  def close(self):
+    """
+    Stops receiving, keeping the partial file so that receiving can resume
+    later with a new ImageReceiver.
+    """
+    self._fileobj.close()
+
+
+
+
+
+  def abort(self):
+    """Stops receiving and removes the partial file."""
+    self._fileobj.close()
+    if os.path.exists(self.partial_filepath):
+      os.remove(self.partial_filepath)
+
+
+
+
+
+  def _update(self, chunks):
+    hash_updates = [
+        hash_object.update for hash_object in self._hash_objects.values()]
+    for chunk in chunks:
+      self.length_received += len(chunk)
+      for update in hash_updates:
+        update(chunk)
+
+
+
+
+
+def _check_fileinfo(trusted_fileinfo, observed_length, observed_hashes):
+  """
+  Raises tuf.DownloadLengthMismatchError or tuf.BadHashError if the observed
+  length or any of the observed hashes (a dictionary with an entry for each
+  hash in trusted_fileinfo) does not match the trusted fileinfo.
+  """
+  if observed_length != trusted_fileinfo['length']:
+    raise tuf.DownloadLengthMismatchError(
+        trusted_fileinfo['length'], observed_length)
+
+  for algorithm, trusted_hash in trusted_fileinfo['hashes'].items():
+    if observed_hashes[algorithm] != trusted_hash:
+      raise tuf.BadHashError(trusted_hash, observed_hashes[algorithm])
 
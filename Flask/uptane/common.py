@@ -7,12 +7,17 @@ from __future__ import unicode_literals
 
 import uptane # Import before TUF modules; may change tuf.conf values.
 import tuf
+import tuf.conf
 import tuf.formats
 import json
 import os
 import shutil
 import copy
 import hashlib
+import threading
+import collections
+import sys
+import six
 
 # TODO: This import is not ideal at this level. Common should probably not
 # import anything from other Uptane modules. Consider putting the
@@ -26,6 +31,33 @@ import uptane.formats
 # TODO: Ensure RSA support in ASN.1/DER conversion.
 SUPPORTED_KEY_TYPES = ['ed25519', 'rsa']
 
+# Positive results from verify_signature_over_metadata are remembered here, so
+# that checking the same signature by the same key over the same data again
+# (e.g. an unchanged ECU Manifest resent by a Primary every update cycle) costs
+# a hash lookup rather than a full signature verification. Entries are keyed
+# by (keyid, public key value, signature method, signature value, SHA-256 of
+# the canonical bytes that were signed), and the least recently used entry is
+# discarded when there are more than VERIFIED_SIGNATURE_CACHE_SIZE of them.
+# Failed verifications are never cached.
+# Set VERIFIED_SIGNATURE_CACHE_SIZE to 0 to disable the cache.
+VERIFIED_SIGNATURE_CACHE_SIZE = 4096
+_verified_signatures = collections.OrderedDict()
+_verified_signatures_lock = threading.Lock()
+
+# Counts of cache hits and misses in verify_signature_over_metadata.
+signature_cache_stats = {'hits': 0, 'misses': 0}
+
+# Size of the chunks in which compute_file_hashes() reads files.
+FILE_HASH_CHUNK_SIZE = 1024 * 1024
+
+# Whether refresh_repositories() refreshes the repositories' metadata in
+# parallel, by default, rather than one at a time. The Primary and Secondary
+# clients refresh every repository through one multi-repository TUF updater,
+# whose role and key databases are module-level state shared by all of its
+# repositories, and which has not been shown to be safe to refresh from
+# several threads at once, so this is off by default.
+PARALLEL_METADATA_REFRESH = False
+
 def sign_signable(
   signable, keys_to_sign_with, datatype,
   metadata_format=tuf.conf.METADATA_FORMAT):
@@ -284,7 +316,7 @@ def sign_over_metadata(
 
 def verify_signature_over_metadata(
     key_dict, signature, data, datatype,
-    metadata_format=tuf.conf.METADATA_FORMAT):
+    metadata_format=tuf.conf.METADATA_FORMAT, encoded_data=None):
   """
   <Purpose>
     Determine whether the private key belonging to 'key_dict' produced
@@ -364,6 +396,15 @@ def verify_signature_over_metadata(
       If 'der', the data will be converted into ASN.1, encoded as DER,
       and hashed. The signature is then checked against that hash.
 
+    encoded_data: (optional)
+      The bytes that the signature is expected to be over, if the caller
+      already has them, in which case data is not encoded again. In 'der'
+      mode, this is the SHA-256 digest of the DER encoding of data, e.g. as
+      returned by
+      uptane.encoding.asn1_codec.convert_signed_der_to_dersigned_json_keeping_signed_der
+      for metadata just received as DER. The caller is responsible for
+      encoded_data corresponding to data.
+
   <Exceptions>
     tuf.FormatError, raised if either 'key_dict' or 'signature' are improperly
     formatted.
@@ -378,8 +419,13 @@ def verify_signature_over_metadata(
 
   <Side Effects>
     The cryptography library specified in 'tuf.conf' is called to do the actual
-    verification. When in 'der' mode, argument data is converted into ASN.1/DER
-    in order to verify it. (Argument object is unchanged.)
+    verification. When in 'der' mode, unless encoded_data is provided,
+    argument data is converted into ASN.1/DER in order to verify it. (Argument
+    object is unchanged.)
+
+    Valid signatures are added to the verified signature cache (see
+    VERIFIED_SIGNATURE_CACHE_SIZE), and a signature found in that cache is not
+    verified again. signature_cache_stats is updated accordingly.
 
   <Returns>
     Boolean.  True if the signature is valid, False otherwise.
@@ -388,10 +434,132 @@ def verify_signature_over_metadata(
   tuf.formats.ANYKEY_SCHEMA.check_match(key_dict)
   tuf.formats.SIGNATURE_SCHEMA.check_match(signature)
   # TODO: Check format of data, based on metadata_format.
+
+  if encoded_data is None:
+    data = _encode_for_signature_check(data, datatype, metadata_format)
+  else:
+    data = encoded_data
+
+  found, cache_key = _check_verified_signature_cache(key_dict, signature, data)
+  if found:
+    return True
+
+  valid = tuf.keys.verify_signature(key_dict, signature, data)
+
+  if valid:
+    _add_to_verified_signature_cache(cache_key)
+
+  return valid
+
+
+
+
+
+def verify_signatures_over_metadata(
+    verification_requests, metadata_format=tuf.conf.METADATA_FORMAT,
+    executor=None):
+  """
+  <Purpose>
+    Batch version of verify_signature_over_metadata: checks many signatures
+    in one call, returning one boolean for each.
+
+    Each distinct piece of data is canonicalized (or converted to ASN.1/DER and
+    hashed) only once, even if several signatures over it are checked, and
+    each distinct key is format-checked only once. Signatures already in the
+    verified signature cache are not checked again. The remaining signature
+    checks are performed in the calling thread, or, if an executor is
+    provided, submitted to that executor to be performed in parallel.
+
+  <Arguments>
+    verification_requests:
+      A list of (key_dict, signature, data, datatype) tuples, each element of
+      which is as described for the arguments of the same names in
+      verify_signature_over_metadata.
+
+    metadata_format: (optional; default based on tuf.conf.METADATA_FORMAT)
+      As in verify_signature_over_metadata; applies to every request.
+
+    executor: (optional)
+      A concurrent.futures.Executor (e.g. a ProcessPoolExecutor) to which the
+      signature checks not answered by the cache are submitted. If None, they
+      are performed one at a time in the calling thread.
+
+  <Exceptions>
+    As for verify_signature_over_metadata. If any request is improperly
+    formatted, an exception is raised and no results are returned.
+
+  <Side Effects>
+    As for verify_signature_over_metadata.
+
+  <Returns>
+    A list of booleans, one per request, in the same order as
+    verification_requests. True if the corresponding signature is valid,
+    False otherwise.
+  """
+
+  checked_keyids = set()
+
+  # Map (id(data), datatype) to the bytes the signature is over, so that data
+  # shared by several requests is only encoded once. (The data objects remain
+  # referenced by verification_requests, so their ids are not reused here.)
+  encoded_data_by_id = {}
+
+  results = []
+  to_verify = [] # (index in results, key_dict, signature, bytes, cache key)
+
+  for key_dict, signature, data, datatype in verification_requests:
+
+    if key_dict['keyid'] not in checked_keyids:
+      tuf.formats.ANYKEY_SCHEMA.check_match(key_dict)
+      checked_keyids.add(key_dict['keyid'])
+    tuf.formats.SIGNATURE_SCHEMA.check_match(signature)
+
+    if (id(data), datatype) not in encoded_data_by_id:
+      encoded_data_by_id[(id(data), datatype)] = _encode_for_signature_check(
+          data, datatype, metadata_format)
+    encoded_data = encoded_data_by_id[(id(data), datatype)]
+
+    found, cache_key = _check_verified_signature_cache(
+        key_dict, signature, encoded_data)
+    results.append(found)
+
+    if not found:
+      to_verify.append(
+          (len(results) - 1, key_dict, signature, encoded_data, cache_key))
+
+
+  if executor is None:
+    verified = [tuf.keys.verify_signature(key_dict, signature, encoded_data)
+        for _, key_dict, signature, encoded_data, _ in to_verify]
+
+  else:
+    verified = [future.result() for future in [
+        executor.submit(
+        tuf.keys.verify_signature, key_dict, signature, encoded_data)
+        for _, key_dict, signature, encoded_data, _ in to_verify]]
+
+
+  for (index, _, _, _, cache_key), valid in zip(to_verify, verified):
+    results[index] = valid
+    if valid:
+      _add_to_verified_signature_cache(cache_key)
+
+  return results
+
+
+
+
+
+def _encode_for_signature_check(data, datatype, metadata_format):
+  """
+  Returns the bytes that a signature over the given data is expected to be
+  over: the canonical JSON encoding of the data in 'json' mode, or the
+  SHA-256 digest of its ASN.1/DER encoding in 'der' mode.
+  """
   # TODO: Consider checking metadata_format redundantly. It's checked below.
 
   if metadata_format == 'json':
-    data = tuf.formats.encode_canonical(data).encode('utf-8')
+    return tuf.formats.encode_canonical(data).encode('utf-8')
 
   elif metadata_format == 'der':
 
@@ -399,17 +567,191 @@ def verify_signature_over_metadata(
     # so we don't have to do this silly wrapping in an empty signable.
     data = asn1_codec.convert_signed_metadata_to_der(
         {'signed': data, 'signatures': []}, datatype, only_signed=True)
-    data = hashlib.sha256(data).digest()
+    return hashlib.sha256(data).digest()
 
   else: # pragma: no cover
     raise uptane.Error('Unsupported metadata format: ' + repr(metadata_format) +
         '; the supported formats are: "der" and "json".')
 
 
-  return tuf.keys.verify_signature(key_dict, signature, data)
 
 
 
+def _check_verified_signature_cache(key_dict, signature, data):
+  """
+  Looks up the given signature by the given key over the given bytes in the
+  verified signature cache, counting the hit or miss.
+
+  Returns a tuple (found, cache_key). cache_key is to be passed to
+  _add_to_verified_signature_cache if the signature is then verified, and is
+  None if the cache is disabled.
+  """
+  if VERIFIED_SIGNATURE_CACHE_SIZE <= 0:
+    return False, None
+
+  cache_key = (key_dict['keyid'], key_dict['keyval']['public'],
+      signature['method'], signature['sig'], hashlib.sha256(data).digest())
+
+  with _verified_signatures_lock:
+    if cache_key in _verified_signatures:
+      # Move the entry to the most recently used end.
+      _verified_signatures[cache_key] = _verified_signatures.pop(cache_key)
+      signature_cache_stats['hits'] += 1
+      return True, cache_key
+
+    signature_cache_stats['misses'] += 1
+    return False, cache_key
+
+
+
+
+
+def _add_to_verified_signature_cache(cache_key):
+  """
+  Records a verified signature in the verified signature cache, discarding
+  the least recently used entries if the cache is full.
+  """
+  if cache_key is None or VERIFIED_SIGNATURE_CACHE_SIZE <= 0:
+    return
+
+  with _verified_signatures_lock:
+    _verified_signatures[cache_key] = True
+    while len(_verified_signatures) > VERIFIED_SIGNATURE_CACHE_SIZE:
+      _verified_signatures.popitem(last=False)
+
+
+
+
+
+def clear_verified_signature_cache():
+  """
+  Empties the cache of verified signatures used by
+  verify_signature_over_metadata and resets its hit and miss counters.
+  """
+  with _verified_signatures_lock:
+    _verified_signatures.clear()
+    signature_cache_stats['hits'] = 0
+    signature_cache_stats['misses'] = 0
+
+
+
+
+
+def compute_file_hashes(fileobj, hash_algorithms):
+  """
+  <Purpose>
+    Reads the given file object, from its current position to its end, and
+    computes its length and each of the given hashes. The file is read only
+    once, in chunks of FILE_HASH_CHUNK_SIZE bytes, with all hashes updated
+    together, so memory use does not depend on the size of the file.
+
+  <Arguments>
+    fileobj
+      A file object open for reading in binary mode.
+
+    hash_algorithms
+      A list of the names of hash algorithms: 'sm3' or any supported by
+      hashlib (e.g. 'sha256', 'sha512').
+
+  <Exceptions>
+    tuf.UnsupportedAlgorithmError
+      if one of the given hash algorithms is not supported.
+
+  <Side Effects>
+    The file object is read to its end.
+
+  <Returns>
+    A tuple (length, hashes), where length is the number of bytes read and
+    hashes is a dictionary mapping each hash algorithm to the hex digest
+    computed with it, e.g. {'sha256': '...', 'sm3': '...'}.
+  """
+  hash_objects = new_hash_objects(hash_algorithms)
+
+  hash_updates = [hash_object.update for hash_object in hash_objects.values()]
+  length = 0
+
+  for chunk in iter(lambda: fileobj.read(FILE_HASH_CHUNK_SIZE), b''):
+    length += len(chunk)
+    for update in hash_updates:
+      update(chunk)
+
+  return length, dict((algorithm, hash_object.hexdigest())
+      for algorithm, hash_object in hash_objects.items())
+
+
+
+
+
+
+def new_hash_objects(hash_algorithms):
+  """
+  Returns a dictionary mapping each of the given hash algorithms ('sm3' or any
+  supported by hashlib) to a new hash object for it, for use in computing
+  hashes incrementally, as compute_file_hashes() does.
+
+  Raises tuf.UnsupportedAlgorithmError if one of the given hash algorithms is
+  not supported.
+  """
+  hash_objects = {}
+  for algorithm in hash_algorithms:
+    if algorithm == 'sm3':
+      hash_objects[algorithm] = asn1_codec.new_sm3()
+    else:
+      try:
+        hash_objects[algorithm] = hashlib.new(algorithm)
+      except ValueError:
+        raise tuf.UnsupportedAlgorithmError(algorithm)
+
+  return hash_objects
+
+
+
+
+
+
+def get_repository_hash_algorithms():
+  """
+  <Purpose>
+    Returns the hash algorithms that repositories (the Image Repository and
+    the Director) should list for target files in metadata of the format now
+    in effect (tuf.conf.METADATA_FORMAT): those in
+    tuf.conf.REPOSITORY_HASH_ALGORITHMS, plus SM3 with JSON metadata where
+    hashlib supports SM3 (i.e. the OpenSSL library it uses does), through
+    which TUF computes the hashes. TUF's ASN.1 definitions for metadata
+    provide no SM3 hash function, so SM3 is never listed with DER metadata.
+
+    The metadata format is set after uptane is imported (e.g. by
+    tests/runtests.py and the demo), so this should be called when targets
+    are added or metadata is written, not once at import.
+
+  <Returns>
+    A list of hash algorithm names, e.g. ['sha256', 'sha512', 'sm3'].
+  """
+  hash_algorithms = [algorithm for algorithm in
+      tuf.conf.REPOSITORY_HASH_ALGORITHMS if algorithm != 'sm3']
+
+  if tuf.conf.METADATA_FORMAT == 'json' and \
+      'sm3' in hashlib.algorithms_available:
+    hash_algorithms.append('sm3')
+
+  return hash_algorithms
+
+
+
+
+
+def use_repository_hash_algorithms():
+  """
+  Sets tuf.conf.REPOSITORY_HASH_ALGORITHMS to get_repository_hash_algorithms(),
+  for the metadata format now in effect, so that TUF lists those hashes for
+  target files the next time it writes a repository's targets metadata.
+  Returns the hash algorithms.
+  """
+  hash_algorithms = get_repository_hash_algorithms()
+  tuf.conf.REPOSITORY_HASH_ALGORITHMS = hash_algorithms
+  return hash_algorithms
+
+
 
 
 
@@ -459,6 +801,94 @@ def public_key_from_canonical(key_canonical):
 
 
 
+def refresh_repositories(
+    updater, director_repo_name, refresh_repository=None, in_parallel=None):
+  """
+  <Purpose>
+    Refreshes the top-level metadata of the Director repository and of every
+    other repository (presumably Image Repositories) known to the given
+    updater, for the refresh_toplevel_metadata() methods of the Primary and
+    Secondary clients.
+
+    The repositories are independent of each other until target info is
+    validated against all of them, so if in_parallel is True, each is
+    refreshed in its own thread, and this returns once all have finished.
+    This way an update cycle waits for the slowest repository rather than
+    for all of them in turn. Otherwise, the Director repository is refreshed
+    first, and then each of the others.
+
+  <Arguments>
+    updater
+      A tuf.client.updater.Updater object for multiple repositories, as
+      configured by a map/pinning file (pinned.json).
+
+    director_repo_name
+      The name of the Director repository in the map/pinning file.
+
+    refresh_repository (optional)
+      A function that refreshes the repository whose name it is called with.
+      By default, updater.refresh(repo_name=<the name>).
+
+    in_parallel (optional)
+      Whether to refresh the repositories in parallel. By default,
+      PARALLEL_METADATA_REFRESH.
+
+  <Exceptions>
+    Whatever refresh_repository raises (e.g. tuf.NoWorkingMirrorError). If
+    refreshing several repositories fails, the exception raised for the
+    Director repository is re-raised if it failed, and otherwise the one
+    raised for the first other repository that failed.
+
+  <Side Effects>
+    Those of refresh_repository.
+
+  <Returns>
+    A list of the values returned by refresh_repository, for the Director
+    repository first and then for each of the others.
+  """
+  tuf.formats.REPOSITORY_NAME_SCHEMA.check_match(director_repo_name)
+
+  if refresh_repository is None:
+    refresh_repository = \
+        lambda repository_name: updater.refresh(repo_name=repository_name)
+
+  if in_parallel is None:
+    in_parallel = PARALLEL_METADATA_REFRESH
+
+  repository_names = [director_repo_name] + [repository_name
+      for repository_name in updater.repositories
+      if repository_name != director_repo_name]
+
+  if not in_parallel or len(repository_names) == 1:
+    return [refresh_repository(repository_name)
+        for repository_name in repository_names]
+
+  results = [None] * len(repository_names)
+  errors = [None] * len(repository_names)
+
+  def refresh(index):
+    try:
+      results[index] = refresh_repository(repository_names[index])
+    except Exception:
+      errors[index] = sys.exc_info()
+
+  threads = [threading.Thread(target=refresh, args=(index,))
+      for index in range(len(repository_names))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  for error in errors:
+    if error is not None:
+      six.reraise(*error)
+
+  return results
+
+
+
+
+
 # Not sure where to put this yet.
 def create_directory_structure_for_client(
     client_dir,
@@ -24,6 +24,8 @@ import tuf.formats
 import uptane.formats
 import logging
 import hashlib
+import binascii
+import struct
 
 logger = logging.getLogger('uptane.asn1_codec')
 
@@ -43,6 +45,10 @@ try:
   import uptane.encoding.vehicle_manifest_asn1_coder as vehicle_manifest_asn1_coder
   import uptane.encoding.asn1_definitions as asn1_spec
 
+  # Converts directly between Python dictionaries and DER; see
+  # USE_COMPILED_CODEC below.
+  import uptane.encoding.compiled_asn1_codec as compiled_asn1_codec
+
   # This maps metadata type to the module that lays out the
   # ASN.1 format for that type.
   SUPPORTED_ASN1_METADATA_MODULES = {
@@ -50,6 +56,13 @@ try:
       DATATYPE_ECU_MANIFEST: ecu_manifest_asn1_coder,
       DATATYPE_VEHICLE_MANIFEST: vehicle_manifest_asn1_coder}
 
+  # This maps metadata type to the codec compiled from the ASN.1 format for
+  # that type.
+  COMPILED_CODECS = {
+      DATATYPE_TIME_ATTESTATION: compiled_asn1_codec.TIME_ATTESTATION_CODEC,
+      DATATYPE_ECU_MANIFEST: compiled_asn1_codec.ECU_MANIFEST_CODEC,
+      DATATYPE_VEHICLE_MANIFEST: compiled_asn1_codec.VEHICLE_MANIFEST_CODEC}
+
 
 # This warning is provided in order to be helpful; behavior is not prescribed
 # when a dependency is missing, so this clause is not tested (which would
@@ -62,187 +75,246 @@ except ImportError: # pragma: no cover
 else:
   PYASN1_EXISTS = True
 
+# If True, metadata is converted to and from DER by the codecs in
+# uptane.encoding.compiled_asn1_codec, which work directly with Python
+# dictionaries and DER. If False, it is converted by building pyasn1 objects,
+# using the modules in SUPPORTED_ASN1_METADATA_MODULES. Both produce the same
+# DER; the compiled codecs are much faster.
+USE_COMPILED_CODEC = True
+
+
+# SM3 (GB/T 32905-2016) constants: the initial value, and the constant T_j for
+# each round j, rotated left by j bits (as used in round j).
+_SM3_IV = (0x7380166F, 0x4914B2B9, 0x172442D7, 0xDA8A0600,
+    0xA96F30BC, 0x163138AA, 0xE38DEE4D, 0xB0FB0E4E)
+
+_SM3_T = tuple(
+    ((t << (j % 32)) | (t >> (32 - j % 32))) & 0xFFFFFFFF
+    for j, t in enumerate([0x79CC4519] * 16 + [0x7A879D8A] * 48))
+
+_SM3_UNPACK_BLOCK = struct.Struct('>16I').unpack_from
+
+# Size of the chunks in which SM3.hashFile() reads files.
+SM3_FILE_CHUNK_SIZE = 1024 * 1024
+
+# Many builds of OpenSSL, and therefore hashlib, provide SM3. Where available,
+# it is much faster than the pure Python SM3 class below. See new_sm3().
+SM3_IN_HASHLIB = 'sm3' in hashlib.algorithms_available
+
+
+
+
+
+def _sm3_compress(state, data, offset):
+  """
+  Applies the SM3 compression function to the 64-byte block of data starting
+  at data[offset], given the current state (a tuple of 8 32-bit words), and
+  returns the new state.
+  """
+  M = 0xFFFFFFFF
+
+  # Message expansion.
+  w = list(_SM3_UNPACK_BLOCK(data, offset))
+  for j in range(16, 68):
+    x = w[j - 16] ^ w[j - 9] ^ (((w[j - 3] << 15) | (w[j - 3] >> 17)) & M)
+    y = w[j - 13]
+    w.append(x ^ (((x << 15) | (x >> 17)) & M) ^ (((x << 23) | (x >> 9)) & M)
+        ^ (((y << 7) | (y >> 25)) & M) ^ w[j - 6])
+
+  w_prime = [w[j] ^ w[j + 4] for j in range(64)]
+
+  a, b, c, d, e, f, g, h = state
+
+  for t, wj, wj_prime in zip(_SM3_T[:16], w[:16], w_prime[:16]):
+    a12 = ((a << 12) | (a >> 20)) & M
+    ss1 = (a12 + e + t) & M
+    ss1 = ((ss1 << 7) | (ss1 >> 25)) & M
+    tt1 = ((a ^ b ^ c) + d + (ss1 ^ a12) + wj_prime) & M
+    tt2 = ((e ^ f ^ g) + h + ss1 + wj) & M
+    d = c
+    c = ((b << 9) | (b >> 23)) & M
+    b = a
+    a = tt1
+    h = g
+    g = ((f << 19) | (f >> 13)) & M
+    f = e
+    e = (tt2 ^ (((tt2 << 9) | (tt2 >> 23)) & M) ^
+        (((tt2 << 17) | (tt2 >> 15)) & M))
+
+  for t, wj, wj_prime in zip(_SM3_T[16:], w[16:64], w_prime[16:]):
+    a12 = ((a << 12) | (a >> 20)) & M
+    ss1 = (a12 + e + t) & M
+    ss1 = ((ss1 << 7) | (ss1 >> 25)) & M
+    tt1 = (((a & b) | (a & c) | (b & c)) + d + (ss1 ^ a12) + wj_prime) & M
+    tt2 = (((e & f) | (~e & g)) + h + ss1 + wj) & M
+    d = c
+    c = ((b << 9) | (b >> 23)) & M
+    b = a
+    a = tt1
+    h = g
+    g = ((f << 19) | (f >> 13)) & M
+    f = e
+    e = (tt2 ^ (((tt2 << 9) | (tt2 >> 23)) & M) ^
+        (((tt2 << 17) | (tt2 >> 15)) & M))
+
+  return (state[0] ^ a, state[1] ^ b, state[2] ^ c, state[3] ^ d,
+      state[4] ^ e, state[5] ^ f, state[6] ^ g, state[7] ^ h)
+
+
+
+
+
+class SM3(object):
+  """
+  <Purpose>
+    A pure Python implementation of the SM3 cryptographic hash function
+    (GB/T 32905-2016), with the same interface as the hash objects in
+    hashlib: update() may be called any number of times, with data of any
+    size, and digest(), hexdigest(), and copy() may be called at any point.
+
+    Data is processed in 64-byte blocks as it is provided, so memory use does
+    not depend on the amount of data hashed.
+
+    new_sm3() should generally be used instead, as it returns hashlib's
+    (faster) SM3 hash objects where available.
+
+  <Arguments>
+    data (optional)
+      Initial data to hash, as with update().
+  """
+  name = 'sm3'
+  digest_size = 32
+  block_size = 64
+
+  def __init__(self, data=b''):
+    self._state = _SM3_IV
+    self._buffer = b''  # data not yet processed: always < 64 bytes
+    self._length = 0  # number of bytes hashed
+
+    if data:
+      self.update(data)
+
+
+
+
+
+  def update(self, data):
+    """
+    Hashes the given data (bytes or another bytes-like object), in addition to
+    any already hashed.
+    """
+    data = memoryview(data).cast('B')
+    self._length += len(data)
+    state = self._state
+    offset = 0
+
+    if self._buffer:
+      offset = self.block_size - len(self._buffer)
+      if len(data) < offset:
+        self._buffer += data.tobytes()
+        return
+      state = _sm3_compress(state, self._buffer + data[:offset].tobytes(), 0)
+
+    end = len(data) - (len(data) - offset) % self.block_size
+    for block_offset in range(offset, end, self.block_size):
+      state = _sm3_compress(state, data, block_offset)
+
+    self._state = state
+    self._buffer = data[end:].tobytes()
+
+
+
+
+
+  def digest(self):
+    """
+    Returns the digest of the data hashed so far, as 32 bytes. More data may
+    still be added afterwards.
+    """
+    # Pad the data with a 1 bit, the fewest 0 bits that will leave a multiple
+    # of 512 bits after the 64-bit big-endian length (in bits) of the data is
+    # appended, and that length.
+    final_blocks = (self._buffer + b'\x80' +
+        b'\x00' * ((55 - self._length) % self.block_size) +
+        struct.pack('>Q', (self._length * 8) & 0xFFFFFFFFFFFFFFFF))
+
+    state = self._state
+    for offset in range(0, len(final_blocks), self.block_size):
+      state = _sm3_compress(state, final_blocks, offset)
+
+    return struct.pack('>8I', *state)
+
+
+
+
+
+  def hexdigest(self):
+    """
+    Returns the digest of the data hashed so far, as 64 lowercase hex
+    characters.
+    """
+    return binascii.hexlify(self.digest()).decode('ascii')
+
+
+
+
+
+  def copy(self):
+    """
+    Returns a copy of this hash object, which can be updated independently.
+    """
+    duplicate = SM3()
+    duplicate._state = self._state
+    duplicate._buffer = self._buffer
+    duplicate._length = self._length
+    return duplicate
+
+
+
+
+
+  def sm3_update(self, msg):
+    """Same as update(). Retained for compatibility."""
+    self.update(msg)
+
+
+
+
+
+  def sm3_final(self):
+    """Returns the hex digest in uppercase. Retained for compatibility."""
+    return self.hexdigest().upper()
+
+
+
+
+
+  def hashFile(self, filename):
+    """
+    Hashes the contents of the given file, reading it in chunks of
+    SM3_FILE_CHUNK_SIZE bytes, and returns sm3_final().
+    """
+    with open(filename, 'rb') as fp:
+      for chunk in iter(lambda: fp.read(SM3_FILE_CHUNK_SIZE), b''):
+        self.update(chunk)
+    return self.sm3_final()
+
+
+
+
+
+def new_sm3(data=b''):
+  """
+  Returns a new SM3 hash object, with the interface of hashlib's hash objects,
+  that has hashed the given data. This is hashlib's SM3 implementation if it
+  has one (see SM3_IN_HASHLIB), or an instance of SM3 otherwise.
+  """
+  if SM3_IN_HASHLIB:
+    return hashlib.new('sm3', data)
+  return SM3(data)
+
+
 
-def rotation_left(x, num):
-    # 循环左移
-    num %= 32
-    left = (x << num) % (2 ** 32)
-    right = (x >> (32 - num)) % (2 ** 32)
-    result = left ^ right
-    return result
-
-
-def Int2Bin(x, k):
-    x = str(bin(x)[2:])
-    result = "0" * (k - len(x)) + x
-    return result
-
-
-
-
-class SM3:
-
-    def __init__(self):
-        # 常量初始化
-        self.IV = [0x7380166F, 0x4914B2B9, 0x172442D7, 0xDA8A0600, 0xA96F30BC, 0x163138AA, 0xE38DEE4D, 0xB0FB0E4E]
-        self.T = [0x79cc4519, 0x7a879d8a]
-        self.maxu32 = 2 ** 32
-        self.w1 = [0] * 68
-        self.w2 = [0] * 64
-
-    def ff(self, x, y, z, j):
-        # 布尔函数FF
-        result = 0
-        if j < 16:
-            result = x ^ y ^ z
-        elif j >= 16:
-            result = (x & y) | (x & z) | (y & z)
-        return result
-
-    def gg(self, x, y, z, j):
-        # 布尔函数GG
-        result = 0
-        if j < 16:
-            result = x ^ y ^ z
-        elif j >= 16:
-            result = (x & y) | (~x & z)
-        return result
-
-    def p(self, x, mode):
-        result = 0
-        # 置换函数P
-        # 输入参数X的长度为32bit(=1个字)
-        # 输入参数mode共两种取值：0和1
-        if mode == 0:
-            result = x ^ rotation_left(x, 9) ^ rotation_left(x, 17)
-        elif mode == 1:
-            result = x ^ rotation_left(x, 15) ^ rotation_left(x, 23)
-        return result
-
-    def sm3_fill(self, msg):
-        # 填充消息，使其长度为512bit的整数倍
-        # 输入参数msg为bytearray类型
-        # 中间参数msg_new_bin为二进制string类型
-        # 输出参数msg_new_bytes为bytearray类型
-        length = len(msg)  # msg的长度（单位：byte）
-        l = length * 8  # msg的长度（单位：bit）
-
-        num = length // 64
-        remain_byte = length % 64
-        msg_remain_bin = ""
-        msg_new_bytes = bytearray((num + 1) * 64)  ##填充后的消息长度，单位：byte
-
-        # 将原数据存储至msg_new_bytes中
-        for i in range(length):
-            msg_new_bytes[i] = msg[i]
-
-        # remain部分以二进制字符串形式存储
-        remain_bit = remain_byte * 8  # 单位：bit
-        for i in range(remain_byte):
-            msg_remain_bin += "{:08b}".format(msg[num * 64 + i])
-
-        k = (448 - l - 1) % 512
-        while k < 0:
-            # k为满足 l + k + 1 = 448 % 512 的最小非负整数
-            k += 512
-
-        msg_remain_bin += "1" + "0" * k + Int2Bin(l, 64)
-
-        for i in range(0, 64 - remain_byte):
-            str = msg_remain_bin[i * 8 + remain_bit: (i + 1) * 8 + remain_bit]
-            temp = length + i
-            msg_new_bytes[temp] = int(str, 2)  # 将2进制字符串按byte为组转换为整数
-        return msg_new_bytes
-
-    def sm3_msg_extend(self, msg):
-        # 扩展函数: 将512bit的数据msg扩展为132个字（w1共68个字，w2共64个字）
-        # 输入参数msg为bytearray类型,长度为512bit=64byte
-        for i in range(0, 16):
-            self.w1[i] = int.from_bytes(msg[i * 4:(i + 1) * 4], byteorder="big")
-
-        for i in range(16, 68):
-            self.w1[i] = self.p(self.w1[i - 16] ^ self.w1[i - 9] ^ rotation_left(self.w1[i - 3], 15),
-                                1) ^ rotation_left(self.w1[i - 13], 7) ^ self.w1[i - 6]
-
-        for i in range(64):
-            self.w2[i] = self.w1[i] ^ self.w1[i + 4]
-
-        # 测试扩展数据w1和w2
-        # print("w1:")
-        # for i in range(0, len(self.w1), 8):
-        #     print(hex(self.w1[i]))
-        # print("w2:")
-        # for i in range(0, len(self.w2), 8):
-        #     print(hex(self.w2[i]))
-
-    def sm3_compress(self, msg):
-        # 压缩函数
-        # 输入参数v为初始化参数，类型为bytes/bytearray，大小为256bit
-        # 输入参数msg为512bit的待压缩数据
-
-        self.sm3_msg_extend(msg)
-        ss1 = 0
-
-        A = self.IV[0]
-        B = self.IV[1]
-        C = self.IV[2]
-        D = self.IV[3]
-        E = self.IV[4]
-        F = self.IV[5]
-        G = self.IV[6]
-        H = self.IV[7]
-
-        for j in range(64):
-            if j < 16:
-                ss1 = rotation_left((rotation_left(A, 12) + E + rotation_left(self.T[0], j)) % self.maxu32, 7)
-            elif j >= 16:
-                ss1 = rotation_left((rotation_left(A, 12) + E + rotation_left(self.T[1], j)) % self.maxu32, 7)
-            ss2 = ss1 ^ rotation_left(A, 12)
-            tt1 = (self.ff(A, B, C, j) + D + ss2 + self.w2[j]) % self.maxu32
-            tt2 = (self.gg(E, F, G, j) + H + ss1 + self.w1[j]) % self.maxu32
-            D = C
-            C = rotation_left(B, 9)
-            B = A
-            A = tt1
-            H = G
-            G = rotation_left(F, 19)
-            F = E
-            E = self.p(tt2, 0)
-
-            # 测试IV的压缩中间值
-            # print("j= %d：" % j, hex(A)[2:], hex(B)[2:], hex(C)[2:], hex(D)[2:], hex(E)[2:], hex(F)[2:], hex(G)[2:], hex(H)[2:])
-
-        self.IV[0] ^= A
-        self.IV[1] ^= B
-        self.IV[2] ^= C
-        self.IV[3] ^= D
-        self.IV[4] ^= E
-        self.IV[5] ^= F
-        self.IV[6] ^= G
-        self.IV[7] ^= H
-
-    def sm3_update(self, msg):
-        # 迭代函数
-        # 输入参数msg为bytearray类型
-        # msg_new为bytearray类型
-        msg_new = self.sm3_fill(msg)  # msg_new经过填充后一定是512的整数倍
-        n = len(msg_new) // 64  # n是整数，n>=1
-
-        for i in range(0, n):
-            self.sm3_compress(msg_new[i * 64:(i + 1) * 64])
-
-    def sm3_final(self):
-        digest_str = ""
-        for i in range(len(self.IV)):
-            digest_str += hex(self.IV[i])[2:]
-
-        return digest_str.upper()
-
-    def hashFile(self, filename):
-        with open(filename, 'rb') as fp:
-            contents = fp.read()
-            self.sm3_update(bytearray(contents))
-        return self.sm3_final()
 
 
 def ensure_valid_metadata_type_for_asn1(metadata_type):
@@ -320,6 +392,9 @@ def convert_signed_der_to_dersigned_json(der_data, datatype):
   # translation. (Throw an exception if not.)
   ensure_valid_metadata_type_for_asn1(datatype)
 
+  if USE_COMPILED_CODEC:
+    return COMPILED_CODECS[datatype].decode_signable(der_data)
+
 
   # "_signed" here refers to the portion of the metadata that will be signed.
   # The metadata is divided into "signed" and "signature" portions. The
@@ -404,6 +479,41 @@ def convert_signed_der_to_dersigned_json(der_data, datatype):
 
 
 
+def convert_signed_der_to_dersigned_json_keeping_signed_der(
+    der_data, datatype):
+  """
+  As convert_signed_der_to_dersigned_json, but also returns the 'signed'
+  portion of der_data exactly as it was received, along with its SHA-256
+  digest (which is what signatures over DER metadata are made over).
+
+  Passing that digest to uptane.common.verify_signature_over_metadata as
+  argument encoded_data avoids converting the 'signed' portion of the
+  returned dictionary back to DER in order to check a signature over it.
+
+  <Arguments>
+    der_data, datatype:
+      As for convert_signed_der_to_dersigned_json.
+
+  <Returns>
+    A tuple (pydict, der_signed, der_signed_digest), where pydict is as
+    returned by convert_signed_der_to_dersigned_json, der_signed is the DER
+    encoding of the 'signed' portion of der_data, and der_signed_digest is
+    the raw SHA-256 digest of der_signed.
+
+  <Exceptions>
+    As for convert_signed_der_to_dersigned_json.
+  """
+  pydict = convert_signed_der_to_dersigned_json(der_data, datatype)
+
+  # der_data has just been decoded in full, so it is known to be well-formed.
+  der_signed = COMPILED_CODECS[datatype].extract_signed_der(der_data)
+
+  return pydict, der_signed, hashlib.sha256(der_signed).digest()
+
+
+
+
+
 def convert_signed_metadata_to_der(signed_metadata, datatype,
     private_key=None, resign=False, only_signed=False):
   """
@@ -516,17 +626,25 @@ def convert_signed_metadata_to_der(signed_metadata, datatype,
   # a module exists that translates it to and from an ASN.1 format.
   ensure_valid_metadata_type_for_asn1(datatype)
 
-  # Handle for the corresponding module.
-  relevant_asn_module = SUPPORTED_ASN1_METADATA_MODULES[datatype]
+  if USE_COMPILED_CODEC:
+    compiled_codec = COMPILED_CODECS[datatype]
+    der_signed = compiled_codec.encode_signed(json_signed)
 
-  asn_signed = relevant_asn_module.get_asn_signed(json_signed)
+    if only_signed:
+      return der_signed
 
-  if only_signed:
-    # If the caller doesn't want any signatures included in the returned
-    # DER object, then we need go no further and may encode what we already
-    # have, which is the 'signed' component, the core metadata itself.
-    der_signed = p_der_encoder.encode(asn_signed)
-    return der_signed
+  else:
+    # Handle for the corresponding module.
+    relevant_asn_module = SUPPORTED_ASN1_METADATA_MODULES[datatype]
+
+    asn_signed = relevant_asn_module.get_asn_signed(json_signed)
+
+    if only_signed:
+      # If the caller doesn't want any signatures included in the returned
+      # DER object, then we need go no further and may encode what we already
+      # have, which is the 'signed' component, the core metadata itself.
+      der_signed = p_der_encoder.encode(asn_signed)
+      return der_signed
 
   # Otherwise, we're to produce the full signable object (signed + signatures).
   # Either we will be retaining existing signatures or re-signing.
@@ -534,18 +652,20 @@ def convert_signed_metadata_to_der(signed_metadata, datatype,
 
   if resign:
 
-    # Encode the ASN.1 as DER first using pyasn1.
+    # Encode the ASN.1 as DER first using pyasn1 (unless the compiled codec
+    # has already done so).
     # TODO: Determine if there are any other error types to add to the except
     # clause below to cover whatever errors we expect pyasn1 to raise when
     # trying to encode data. That error class covers ValueConstraintError and
     # SubstrateUnderrunError, but I'm not sure if pyasn1 wouldn't raise other
     # errors....
-    try:
-      der_signed = p_der_encoder.encode(asn_signed)
-    except pyasn1.error.PyAsn1Error as e:
-      raise uptane.FailedToEncodeASN1DER('Unable to encode the provided '
-          'der_data as datatype ' + repr(datatype) + '. The pyasn1-raised '
-          'error follows: ' + repr(e))
+    if not USE_COMPILED_CODEC:
+      try:
+        der_signed = p_der_encoder.encode(asn_signed)
+      except pyasn1.error.PyAsn1Error as e:
+        raise uptane.FailedToEncodeASN1DER('Unable to encode the provided '
+            'der_data as datatype ' + repr(datatype) + '. The pyasn1-raised '
+            'error follows: ' + repr(e))
 
 
     # This hashing is redundant and temporary. Eventually, the hash will
@@ -555,8 +675,6 @@ def convert_signed_metadata_to_der(signed_metadata, datatype,
     # and also so that the canonicalization that is currently called by
     # create_signature() doesn't choke on the DER I want to sign.
     hash_of_der = hashlib.sha256(der_signed).digest()
-    test = SM3()
-    hash_of_der1 = test.sm3_final()
 
     # Now sign the metadata. (This signs a cryptographic hash of the metadata.)
     # The returned value is a basic Python dict writable into JSON.
@@ -569,6 +687,9 @@ def convert_signed_metadata_to_der(signed_metadata, datatype,
   else:
     pydict_signatures = signed_metadata['signatures']
 
+  if USE_COMPILED_CODEC:
+    return compiled_codec.encode_signable(der_signed, pydict_signatures)
+
   asn_signatures_list = convert_signatures_to_asn(pydict_signatures)
 
 
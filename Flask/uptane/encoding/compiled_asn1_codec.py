@@ -0,0 +1,631 @@
+"""
+<Name>
+  uptane/encoding/compiled_asn1_codec.py
+
+<Purpose>
+  Converts Uptane metadata (Time Attestations, ECU Manifests, and Vehicle
+  Manifests) directly between Uptane's standard Python dictionary metadata
+  format and DER, without constructing pyasn1 objects.
+
+  When this module is imported, the ASN.1 types in asn1_definitions.py are
+  compiled into plain Python functions that encode and decode DER (see
+  _compile()). Those functions operate on simple values: dictionaries for
+  SEQUENCEs (keyed by component name, with absent OPTIONAL components left
+  out), lists for SEQUENCE OFs, ints for INTEGERs, names (strings) for
+  ENUMERATEDs, bytes for OCTET STRINGs, and strings for VisibleStrings. The
+  rest of this module translates between Uptane's dictionaries and those
+  values, just as ecu_manifest_asn1_coder.py and its siblings do with pyasn1
+  objects.
+
+  The DER produced is identical to the DER that pyasn1 produces from the same
+  definitions, and value constraints are enforced as pyasn1 enforces them.
+  Whether this module or pyasn1 is used is controlled by
+  uptane.encoding.asn1_codec.USE_COMPILED_CODEC.
+
+<Classes>
+  SignableCodec
+
+<Globals>
+  TIME_ATTESTATION_CODEC, ECU_MANIFEST_CODEC, VEHICLE_MANIFEST_CODEC
+    SignableCodec instances for each type of metadata.
+
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import uptane
+import binascii
+import calendar
+import collections
+from datetime import datetime
+
+from pyasn1.type import univ, char, constraint
+
+import uptane.encoding.asn1_definitions as asn1_spec
+
+
+# A compiled ASN.1 type. tag is the single identifier octet of the type, as an
+# int. encode(value) returns the DER encoding of value. decode(der, position,
+# end) decodes the element starting at der[position] (which must end by
+# der[end]) and returns (value, position after the element).
+_Codec = collections.namedtuple('_Codec', ['tag', 'encode', 'decode'])
+
+_SHORT_LENGTHS = [bytes(bytearray([length])) for length in range(0x80)]
+
+
+
+
+
+def _encode_tlv(tag_octet, content):
+  """
+  Returns the DER encoding of an element given its identifier octet (bytes)
+  and encoded content.
+  """
+  length = len(content)
+
+  if length < 0x80:
+    return tag_octet + _SHORT_LENGTHS[length] + content
+
+  length_octets = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+  return (tag_octet + bytes(bytearray([0x80 | len(length_octets)])) +
+      length_octets + content)
+
+
+
+
+
+def _read_header(der, position, end, tag, type_name):
+  """
+  Reads the identifier and length octets of the element starting at
+  der[position], which are expected to indicate an element of the given type,
+  and returns the start and end positions of that element's content.
+  """
+  if position + 2 > end or der[position] != tag:
+    raise uptane.FailedToDecodeASN1DER('Expected ' + type_name + ' at offset '
+        + str(position) + '.')
+
+  length = der[position + 1]
+  position += 2
+
+  if length & 0x80:
+    number_of_length_octets = length & 0x7f
+    if not number_of_length_octets or \
+        position + number_of_length_octets > end:
+      raise uptane.FailedToDecodeASN1DER('Invalid length for ' + type_name +
+          ' at offset ' + str(position - 2) + '.')
+    length = int.from_bytes(
+        der[position:position + number_of_length_octets], 'big')
+    position += number_of_length_octets
+
+  if position + length > end:
+    raise uptane.FailedToDecodeASN1DER('Truncated ' + type_name + ' at offset '
+        + str(position) + '.')
+
+  return position, position + length
+
+
+
+
+
+def _compile_bounds(subtype_spec, size):
+  """
+  Returns (lower, upper) bounds, inclusive, placed on a value (or, if size is
+  True, on its length) by the given pyasn1 constraints, or (None, None) if
+  there are none.
+  """
+  lower = upper = None
+  constraints = [subtype_spec]
+
+  while constraints:
+    c = constraints.pop()
+
+    if isinstance(c, constraint.ConstraintsIntersection):
+      constraints.extend(c)
+
+    elif isinstance(c, constraint.ValueRangeConstraint) and \
+        isinstance(c, constraint.ValueSizeConstraint) == size:
+      lower = c.start if lower is None else max(lower, c.start)
+      upper = c.stop if upper is None else min(upper, c.stop)
+
+    else:
+      raise uptane.Error('Unable to compile ASN.1 constraint ' + repr(c))
+
+  return lower, upper
+
+
+
+
+
+def _compile(asn_type):
+  """
+  Compiles the given pyasn1 type (an instance of a type from
+  asn1_definitions.py) into a _Codec.
+
+  Only the features of ASN.1 that asn1_definitions.py uses are supported:
+  untagged SEQUENCE, SEQUENCE OF, INTEGER, ENUMERATED, OCTET STRING, and
+  VisibleString types with value range and size constraints. Size constraints
+  on SEQUENCE OF types are not enforced, as pyasn1 does not enforce them.
+  """
+  type_name = type(asn_type).__name__
+
+  if len(asn_type.tagSet.superTags) != 1:
+    raise uptane.Error('Unable to compile tagged ASN.1 type ' + type_name)
+
+  tag = asn_type.tagSet.superTags[0]
+  if tag.tagId >= 31:
+    raise uptane.Error('Unable to compile ASN.1 type ' + type_name + ' with '
+        'high tag number ' + str(tag.tagId))
+
+  tag = tag.tagClass | tag.tagFormat | tag.tagId
+
+  if isinstance(asn_type, univ.Sequence):
+    return _compile_sequence(asn_type, tag, type_name)
+
+  elif isinstance(asn_type, univ.SequenceOf):
+    return _compile_sequence_of(asn_type, tag, type_name)
+
+  elif isinstance(asn_type, univ.Integer): # including ENUMERATED
+    return _compile_integer(asn_type, tag, type_name)
+
+  # Note that character strings are also OctetStrings in pyasn1.
+  elif isinstance(asn_type, (univ.OctetString, char.VisibleString)):
+    return _compile_string(asn_type, tag, type_name)
+
+  else:
+    raise uptane.Error('Unable to compile ASN.1 type ' + type_name)
+
+
+
+
+
+def _compile_sequence(asn_type, tag, type_name):
+
+  tag_octet = bytes(bytearray([tag]))
+  components = [(named_type.name, named_type.isOptional,
+      _compile(named_type.asn1Object))
+      for named_type in asn_type.componentType.namedTypes]
+
+  def encode(value):
+    encoded_components = []
+    for name, is_optional, codec in components:
+      component = value.get(name)
+      if component is None:
+        if is_optional:
+          continue
+        raise uptane.FailedToEncodeASN1DER('Missing component ' +
+            repr(name) + ' of ' + type_name)
+      encoded_components.append(codec.encode(component))
+    return _encode_tlv(tag_octet, b''.join(encoded_components))
+
+  def decode(der, position, end):
+    position, end = _read_header(der, position, end, tag, type_name)
+    value = {}
+    for name, is_optional, codec in components:
+      if position == end or der[position] != codec.tag:
+        if is_optional:
+          continue
+        raise uptane.FailedToDecodeASN1DER('Missing component ' +
+            repr(name) + ' of ' + type_name)
+      value[name], position = codec.decode(der, position, end)
+    if position != end:
+      raise uptane.FailedToDecodeASN1DER('Excess data in ' + type_name +
+          ' at offset ' + str(position) + '.')
+    return value, end
+
+  return _Codec(tag, encode, decode)
+
+
+
+
+
+def _compile_sequence_of(asn_type, tag, type_name):
+
+  tag_octet = bytes(bytearray([tag]))
+  codec = _compile(asn_type.componentType)
+
+  def encode(value):
+    return _encode_tlv(
+        tag_octet, b''.join([codec.encode(component) for component in value]))
+
+  def decode(der, position, end):
+    position, end = _read_header(der, position, end, tag, type_name)
+    value = []
+    while position < end:
+      component, position = codec.decode(der, position, end)
+      value.append(component)
+    return value, end
+
+  return _Codec(tag, encode, decode)
+
+
+
+
+
+def _compile_integer(asn_type, tag, type_name):
+
+  tag_octet = bytes(bytearray([tag]))
+  lower, upper = _compile_bounds(asn_type.subtypeSpec, size=False)
+  is_enumerated = isinstance(asn_type, univ.Enumerated)
+  numbers_by_name = dict(asn_type.namedValues.items())
+  names_by_number = dict((n, name) for name, n in numbers_by_name.items())
+
+  def encode(value):
+    if is_enumerated:
+      if value not in numbers_by_name:
+        raise uptane.FailedToEncodeASN1DER('Unknown value ' + repr(value) +
+            ' for ' + type_name)
+      value = numbers_by_name[value]
+
+    if lower is not None and not lower <= value <= upper:
+      raise uptane.FailedToEncodeASN1DER('Value ' + repr(value) + ' of ' +
+          type_name + ' is outside the permitted range.')
+
+    magnitude = value if value >= 0 else ~value
+    return _encode_tlv(tag_octet, value.to_bytes(
+        magnitude.bit_length() // 8 + 1, 'big', signed=True))
+
+  def decode(der, position, end):
+    position, end = _read_header(der, position, end, tag, type_name)
+    if position == end:
+      raise uptane.FailedToDecodeASN1DER('Empty ' + type_name)
+    value = int.from_bytes(der[position:end], 'big', signed=True)
+
+    if lower is not None and not lower <= value <= upper:
+      raise uptane.FailedToDecodeASN1DER('Value ' + repr(value) + ' of ' +
+          type_name + ' is outside the permitted range.')
+
+    if is_enumerated:
+      if value not in names_by_number:
+        raise uptane.FailedToDecodeASN1DER('Unknown value ' + repr(value) +
+            ' for ' + type_name)
+      value = names_by_number[value]
+
+    return value, end
+
+  return _Codec(tag, encode, decode)
+
+
+
+
+
+def _compile_string(asn_type, tag, type_name):
+
+  tag_octet = bytes(bytearray([tag]))
+  lower, upper = _compile_bounds(asn_type.subtypeSpec, size=True)
+  # Character strings are converted to and from bytes; octet strings are
+  # bytes already.
+  encoding = None
+  if isinstance(asn_type, char.AbstractCharacterString):
+    encoding = asn_type.encoding
+
+  def encode(value):
+    if lower is not None and not lower <= len(value) <= upper:
+      raise uptane.FailedToEncodeASN1DER('Length of ' + type_name +
+          ' is outside the permitted range: ' + repr(value))
+    if encoding is not None:
+      try:
+        value = value.encode(encoding)
+      except UnicodeError as e:
+        raise uptane.FailedToEncodeASN1DER('Unable to encode ' + type_name +
+            ': ' + repr(e))
+    return _encode_tlv(tag_octet, value)
+
+  def decode(der, position, end):
+    position, end = _read_header(der, position, end, tag, type_name)
+    value = bytes(der[position:end])
+    if encoding is not None:
+      try:
+        value = value.decode(encoding)
+      except UnicodeError as e:
+        raise uptane.FailedToDecodeASN1DER('Unable to decode ' + type_name +
+            ': ' + repr(e))
+    if lower is not None and not lower <= len(value) <= upper:
+      raise uptane.FailedToDecodeASN1DER('Length of ' + type_name +
+          ' is outside the permitted range: ' + repr(value))
+    return value, end
+
+  return _Codec(tag, encode, decode)
+
+
+
+
+
+class SignableCodec(object):
+  """
+  Converts one type of signable Uptane metadata (e.g. ECU Manifests) between
+  Uptane's Python dictionary format and DER.
+
+  The ASN.1 type given must be a SEQUENCE of 'signed', 'numberOfSignatures',
+  and 'signatures' components, in that order.
+  signed_to_asn and signed_to_json translate the 'signed' portion of the
+  metadata between Uptane's format and the simple values described in the
+  module docstring.
+  """
+
+  def __init__(self, signable_type, signed_to_asn, signed_to_json):
+
+    component_types = signable_type.componentType
+    if [named_type.name for named_type in component_types.namedTypes] != [
+        'signed', 'numberOfSignatures', 'signatures']:
+      raise uptane.Error('Unexpected components in signable ASN.1 type ' +
+          type(signable_type).__name__)
+
+    self._signable = _compile(signable_type)
+    self._signed = _compile(component_types.getTypeByPosition(0))
+    self._number_of_signatures = _compile(component_types.getTypeByPosition(1))
+    self._signatures = _compile(component_types.getTypeByPosition(2))
+    self._signable_tag_octet = bytes(bytearray([self._signable.tag]))
+    self._signable_type_name = type(signable_type).__name__
+    self._signed_to_asn = signed_to_asn
+    self._signed_to_json = signed_to_json
+
+
+
+
+
+  def encode_signed(self, json_signed):
+    """
+    Returns the DER encoding of the given 'signed' portion of metadata.
+    """
+    return self._signed.encode(self._signed_to_asn(json_signed))
+
+
+
+
+
+  def encode_signable(self, der_signed, pydict_signatures):
+    """
+    Returns the DER encoding of full signable metadata, given the DER encoding
+    of its 'signed' portion (from encode_signed()) and its signatures
+    (conforming to tuf.formats.SIGNATURES_SCHEMA).
+    """
+    return _encode_tlv(self._signable_tag_octet, der_signed +
+        self._number_of_signatures.encode(len(pydict_signatures)) +
+        self._signatures.encode(_signatures_to_asn(pydict_signatures)))
+
+
+
+
+
+  def decode_signable(self, der_data):
+    """
+    Returns a dictionary {'signed': ..., 'signatures': ...} containing the
+    metadata encoded in der_data. See
+    uptane.encoding.asn1_codec.convert_signed_der_to_dersigned_json().
+    """
+    value, position = self._signable.decode(der_data, 0, len(der_data))
+
+    if position != len(der_data):
+      raise uptane.FailedToDecodeASN1DER('Excess data after offset ' +
+          str(position) + '.')
+
+    return {
+        'signatures': _signable_signatures_to_json(value),
+        'signed': self._signed_to_json(value['signed'])}
+
+
+
+
+
+  def extract_signed_der(self, der_data):
+    """
+    Returns the DER encoding of the 'signed' portion of the given signable
+    metadata, exactly as it appears in der_data (i.e. the data that the
+    signatures are over), without decoding it.
+    Only the identifier and length octets are checked, so der_data should
+    also be passed to decode_signable() to check the rest.
+    """
+    position, end = _read_header(der_data, 0, len(der_data),
+        self._signable.tag, self._signable_type_name)
+    signed_start = position
+    position, end = _read_header(der_data, position, end, self._signed.tag,
+        'signed portion of ' + self._signable_type_name)
+    return der_data[signed_start:end]
+
+
+
+
+
+def _check_count(count, items, name):
+  """
+  Checks one of the count fields in the ASN.1 definitions (e.g.
+  numberOfHashes) against the list it counts.
+  """
+  if count != len(items):
+    raise uptane.FailedToDecodeASN1DER('The DER data states that there are ' +
+        str(count) + ' ' + name + ', but it contains ' + str(len(items)) + '.')
+
+
+
+
+
+def _hex_to_bytes(hex_string):
+  # Like pyasn1's OctetString(hexValue=...), pad odd-length hex strings with
+  # a trailing 0.
+  if len(hex_string) % 2:
+    hex_string += '0'
+  return binascii.unhexlify(hex_string)
+
+
+
+
+
+def _bytes_to_hex(octets):
+  return binascii.hexlify(octets).decode('ascii')
+
+
+
+
+
+def _iso8601_to_unix(timestring):
+  return calendar.timegm(
+      datetime.strptime(timestring, '%Y-%m-%dT%H:%M:%SZ').timetuple())
+
+
+
+
+
+def _unix_to_iso8601(timestamp):
+  return datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
+
+
+
+
+
+def _signatures_to_asn(pydict_signatures):
+  return [{
+      'keyid': _hex_to_bytes(pydict_sig['keyid']),
+      'method': pydict_sig['method'],
+      'value': _hex_to_bytes(pydict_sig['sig'])}
+      for pydict_sig in pydict_signatures]
+
+
+
+
+
+def _signable_signatures_to_json(asn_signable):
+  asn_signatures = asn_signable['signatures']
+  _check_count(asn_signable['numberOfSignatures'], asn_signatures,
+      'signatures')
+  return [{
+      'keyid': _bytes_to_hex(asn_sig['keyid']),
+      'method': asn_sig['method'],
+      'sig': _bytes_to_hex(asn_sig['value'])}
+      for asn_sig in asn_signatures]
+
+
+
+
+
+def _time_attestation_signed_to_asn(json_signed):
+  nonces = json_signed['nonces']
+  return {
+      'numberOfTokens': len(nonces),
+      'tokens': nonces,
+      'timestamp': _iso8601_to_unix(json_signed['time'])}
+
+
+
+
+
+def _time_attestation_signed_to_json(asn_signed):
+  tokens = asn_signed['tokens']
+  _check_count(asn_signed['numberOfTokens'], tokens, 'tokens')
+  return {
+      'time': _unix_to_iso8601(asn_signed['timestamp']),
+      'nonces': tokens}
+
+
+
+
+
+def _ecu_manifest_signed_to_asn(json_signed):
+
+  filemeta = json_signed['installed_image']['fileinfo']
+
+  # As in ecu_manifest_asn1_coder, the order of the hashes must be
+  # deterministic, as it affects the DER and therefore signature verification.
+  hashes = [{'function': hash_function,
+      'digest': _hex_to_bytes(filemeta['hashes'][hash_function])}
+      for hash_function in sorted(filemeta['hashes'])]
+
+  asn_signed = {
+      'ecuIdentifier': json_signed['ecu_serial'],
+      'previousTime': _iso8601_to_unix(
+          json_signed['previous_timeserver_time']),
+      'currentTime': _iso8601_to_unix(json_signed['timeserver_time']),
+      'installedImage': {
+          'filename': json_signed['installed_image']['filepath'],
+          'length': filemeta['length'],
+          'numberOfHashes': len(hashes),
+          'hashes': hashes}}
+
+  # Optional bit.
+  if json_signed.get('attacks_detected'):
+    asn_signed['securityAttack'] = json_signed['attacks_detected']
+
+  return asn_signed
+
+
+
+
+
+def _ecu_manifest_signed_to_json(asn_signed):
+
+  target = asn_signed['installedImage']
+  hashes = target['hashes']
+  _check_count(target['numberOfHashes'], hashes, 'hashes')
+
+  return {
+      'ecu_serial': asn_signed['ecuIdentifier'],
+      'installed_image': {
+          'filepath': target['filename'],
+          'fileinfo': {
+              'length': target['length'],
+              'hashes': dict((h['function'], _bytes_to_hex(h['digest']))
+                  for h in hashes)}},
+      'previous_timeserver_time': _unix_to_iso8601(asn_signed['previousTime']),
+      'timeserver_time': _unix_to_iso8601(asn_signed['currentTime']),
+      'attacks_detected': asn_signed.get('securityAttack', '')}
+
+
+
+
+
+def _vehicle_manifest_signed_to_asn(json_signed):
+
+  # As in vehicle_manifest_asn1_coder, the ECU Manifests are listed in order of
+  # ECU Serial, so that the DER is deterministic.
+  ecu_manifests = []
+  for ecu_serial in sorted(json_signed['ecu_version_manifests']):
+    for manifest in json_signed['ecu_version_manifests'][ecu_serial]:
+      ecu_manifests.append({
+          'signed': _ecu_manifest_signed_to_asn(manifest['signed']),
+          'numberOfSignatures': len(manifest['signatures']),
+          'signatures': _signatures_to_asn(manifest['signatures'])})
+
+  # As in vehicle_manifest_asn1_coder, the optional securityAttack component is
+  # not used.
+  return {
+      'vehicleIdentifier': json_signed['vin'],
+      'primaryIdentifier': json_signed['primary_ecu_serial'],
+      'numberOfECUVersionManifests': len(ecu_manifests),
+      'ecuVersionManifests': ecu_manifests}
+
+
+
+
+
+def _vehicle_manifest_signed_to_json(asn_signed):
+
+  asn_manifests = asn_signed['ecuVersionManifests']
+  _check_count(asn_signed['numberOfECUVersionManifests'], asn_manifests,
+      'ECU Manifests')
+
+  json_manifests = {}
+  for asn_manifest in asn_manifests:
+    json_manifest_signed = _ecu_manifest_signed_to_json(asn_manifest['signed'])
+    json_manifests.setdefault(json_manifest_signed['ecu_serial'], []).append({
+        'signatures': _signable_signatures_to_json(asn_manifest),
+        'signed': json_manifest_signed})
+
+  return {
+      'vin': asn_signed['vehicleIdentifier'],
+      'primary_ecu_serial': asn_signed['primaryIdentifier'],
+      'ecu_version_manifests': json_manifests}
+
+
+
+
+
+TIME_ATTESTATION_CODEC = SignableCodec(
+    asn1_spec.TokensAndTimestampSignable(),
+    _time_attestation_signed_to_asn, _time_attestation_signed_to_json)
+
+ECU_MANIFEST_CODEC = SignableCodec(
+    asn1_spec.ECUVersionManifest(),
+    _ecu_manifest_signed_to_asn, _ecu_manifest_signed_to_json)
+
+VEHICLE_MANIFEST_CODEC = SignableCodec(
+    asn1_spec.VehicleVersionManifest(),
+    _vehicle_manifest_signed_to_asn, _vehicle_manifest_signed_to_json)
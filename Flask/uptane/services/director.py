@@ -34,15 +34,29 @@ import uptane # Import before TUF modules; may change tuf.conf values.
 import uptane.formats
 import uptane.common
 import uptane.services.inventorydb as inventory
+import uptane.services.target_store
 import uptane.encoding.asn1_codec as asn1_codec
 import tuf
+import tuf.conf
 import tuf.formats
+import tuf.keydb
+import tuf.roledb
 import tuf.repository_tool as rt
 #import uptane.ber_encoder as ber_encoder
 from uptane import GREEN, RED, YELLOW, ENDCOLORS
 
 import os
-import hashlib
+import copy
+import time
+import collections
+import contextlib
+import concurrent.futures
+import threading
+
+try:
+  from collections.abc import MutableMapping
+except ImportError: # Python 2
+  from collections import MutableMapping
 
 from uptane.encoding.asn1_codec import DATATYPE_TIME_ATTESTATION
 from uptane.encoding.asn1_codec import DATATYPE_ECU_MANIFEST
@@ -53,6 +67,17 @@ log.addHandler(uptane.file_handler)
 log.addHandler(uptane.console_handler)
 log.setLevel(uptane.logging.DEBUG)
 
+# The largest number of vehicle repositories that a Director keeps in memory.
+# Beyond this, the least recently used repositories are unloaded, to be
+# reloaded from disk when next used. Repositories with unwritten changes are
+# first written to their metadata.staged directories (see
+# VehicleRepositories.written_on_unload()). If None, repositories are never
+# unloaded.
+MAX_RESIDENT_VEHICLE_REPOSITORIES = 1000
+
+# The top-level roles of each vehicle repository.
+_TOP_LEVEL_ROLES = ['root', 'timestamp', 'snapshot', 'targets']
+
 
 
 class Director:
@@ -74,12 +99,26 @@ class Director:
       Private signing key for the targets role in the Director's repositories
 
     vehicle_repositories
-      A dictionary of tuf.repository_tool.Repository objects, indexed by VIN.
-      Each holds the Director metadata geared toward that particular vehicle.
+      A VehicleRepositories object: a dictionary-like mapping from VIN to
+      tuf.repository_tool.Repository object, each of which holds the Director
+      metadata geared toward that particular vehicle. Repositories are
+      created or loaded from disk when first used, and may be unloaded again
+      (see MAX_RESIDENT_VEHICLE_REPOSITORIES).
 
     director_repos_dir
       The root directory in which the repositories for each vehicle reside.
 
+    verification_workers
+      The number of worker processes across which the signature checks on the
+      ECU Manifests in a Vehicle Manifest are spread. If None or 1, ECU
+      Manifests are verified one at a time in the calling thread.
+
+    target_store
+      The uptane.services.target_store.TargetStore to which images assigned by
+      assign_image() are added, and from which they are linked into the
+      vehicle repositories. If None is given, one is created in
+      director_repos_dir when first needed.
+
   """
 
 
@@ -92,7 +131,9 @@ class Director:
     key_snapshot_pri,
     key_snapshot_pub,
     key_targets_pri,
-    key_targets_pub):
+    key_targets_pub,
+    verification_workers=None,
+    target_store=None):
 
     """
     """
@@ -104,6 +145,9 @@ class Director:
         key_snapshot_pri, key_snapshot_pub, key_targets_pri, key_targets_pub]:
       tuf.formats.ANYKEY_SCHEMA.check_match(key)
 
+    if verification_workers is not None:
+      tuf.formats.LENGTH_SCHEMA.check_match(verification_workers)
+
     self.director_repos_dir = director_repos_dir
 
     self.key_dirroot_pri = key_root_pri
@@ -115,7 +159,17 @@ class Director:
     self.key_dirtarg_pri = key_targets_pri
     self.key_dirtarg_pub = key_targets_pub
 
-    self.vehicle_repositories = dict()
+    self.vehicle_repositories = VehicleRepositories(self)
+
+    # The signed root metadata shared by the vehicle repositories; see
+    # _get_shared_root().
+    self._shared_root = None
+
+    self.verification_workers = verification_workers
+    self.target_store = target_store
+    # Created on first use; see _get_verification_pool().
+    self._verification_pool = None
+    self._verification_pool_lock = threading.Lock()
 
 
 
@@ -167,6 +221,31 @@ class Director:
       ecuid: uptane.formats.ECU_SERIAL_SCHEMA
       manifest: uptane.formats.SIGNABLE_ECU_VERSION_MANIFEST_SCHEMA
     """
+    ecu_public_key = self._check_ecu_manifest_origin(
+        ecu_serial, signed_ecu_manifest)
+
+    valid = uptane.common.verify_signature_over_metadata(
+        ecu_public_key,
+        signed_ecu_manifest['signatures'][0], # TODO: Fix single-signature assumption
+        signed_ecu_manifest['signed'],
+        DATATYPE_ECU_MANIFEST)
+
+    if not valid:
+      self._raise_bad_ecu_manifest_signature()
+
+
+
+
+
+  def _check_ecu_manifest_origin(self, ecu_serial, signed_ecu_manifest):
+    """
+    Performs every check in validate_ecu_manifest except for the (costly)
+    signature check itself, returning the public key that the ECU Manifest
+    should be signed with.
+
+    Raises uptane.Spoofing or uptane.UnknownECU just as validate_ecu_manifest
+    does.
+    """
     uptane.formats.ECU_SERIAL_SCHEMA.check_match(ecu_serial)
     uptane.formats.SIGNABLE_ECU_VERSION_MANIFEST_SCHEMA.check_match(
         signed_ecu_manifest)
@@ -179,7 +258,10 @@ class Director:
           'signed in the manifest itself (' +
           repr(signed_ecu_manifest['signed']['ecu_serial']) + ').')
 
-    if ecu_serial not in inventory.ecu_public_keys:
+    try:
+      return inventory.get_ecu_public_key(ecu_serial)
+
+    except uptane.UnknownECU:
       log.info(
           'Validation failed on an ECU Manifest: ECU ' + repr(ecu_serial) +
           ' is not registered.')
@@ -188,23 +270,18 @@ class Director:
           'new, Register the new ECU with its key in order to be able to '
           'submit its manifests.')
 
-    ecu_public_key = inventory.ecu_public_keys[ecu_serial]
 
 
-    valid = uptane.common.verify_signature_over_metadata(
-        ecu_public_key,
-        signed_ecu_manifest['signatures'][0], # TODO: Fix single-signature assumption
-        signed_ecu_manifest['signed'],
-        DATATYPE_ECU_MANIFEST)
 
-    if not valid:
-      log.info(
-          'Validation failed on an ECU Manifest: signature is not valid. '
-          'It must be correctly signed by the expected key for that ECU.')
-      raise tuf.BadSignatureError('Sender supplied an invalid signature. '
-          'ECU Manifest is unacceptable. If you see this persistently, it is '
-          'possible that the Primary is compromised or that there is a man in '
-          'the middle attack or misconfiguration.')
+
+  def _raise_bad_ecu_manifest_signature(self):
+    log.info(
+        'Validation failed on an ECU Manifest: signature is not valid. '
+        'It must be correctly signed by the expected key for that ECU.')
+    raise tuf.BadSignatureError('Sender supplied an invalid signature. '
+        'ECU Manifest is unacceptable. If you see this persistently, it is '
+        'possible that the Primary is compromised or that there is a man in '
+        'the middle attack or misconfiguration.')
 
 
 
@@ -265,23 +342,32 @@ class Director:
     uptane.formats.VIN_SCHEMA.check_match(vin)
     uptane.formats.ECU_SERIAL_SCHEMA.check_match(primary_ecu_serial)
 
+    # The digest of the 'signed' portion of the DER manifest as received, which
+    # is what the Primary's signature is over. (None in JSON mode.)
+    der_signed_digest = None
+
     if tuf.conf.METADATA_FORMAT == 'der':
-      # Check format and convert back to expected vehicle manifest format.
+      # Check format and convert back to expected vehicle manifest format,
+      # keeping the digest of the signed DER so that it need not be
+      # re-encoded to check the Primary's signature.
       uptane.formats.DER_DATA_SCHEMA.check_match(signed_vehicle_manifest)
-      signed_vehicle_manifest = asn1_codec.convert_signed_der_to_dersigned_json(
+      signed_vehicle_manifest, _, der_signed_digest = \
+          asn1_codec.convert_signed_der_to_dersigned_json_keeping_signed_der(
           signed_vehicle_manifest, DATATYPE_VEHICLE_MANIFEST)
 
     uptane.formats.SIGNABLE_VEHICLE_VERSION_MANIFEST_SCHEMA.check_match(
         signed_vehicle_manifest)
 
-    if vin not in inventory.ecus_by_vin:
+    try:
+      inventory.check_vin_registered(vin)
+    except uptane.UnknownVehicle:
       raise uptane.UnknownVehicle('Received a vehicle manifest purportedly '
           'from a vehicle with a VIN that is not known to this Director.')
 
     # Process Primary's signature on full manifest here.
     # If it doesn't match expectations, error out here.
     self.validate_primary_certification_in_vehicle_manifest(
-        vin, primary_ecu_serial, signed_vehicle_manifest)
+        vin, primary_ecu_serial, signed_vehicle_manifest, der_signed_digest)
 
     # If the Primary's signature is valid, save the whole vehicle manifest to
     # the inventorydb.
@@ -299,39 +385,147 @@ class Director:
     all_ecu_manifests = \
         signed_vehicle_manifest['signed']['ecu_version_manifests']
 
+    self._register_ecu_manifests(vin, all_ecu_manifests)
+
+
+
+
+
+  def _register_ecu_manifests(self, vin, all_ecu_manifests):
+    """
+    Equivalent to calling register_ecu_manifest on each ECU Manifest in
+    all_ecu_manifests (a dictionary mapping ECU Serial to a list of ECU
+    Manifests from that ECU), discarding with a warning any ECU Manifest that
+    fails validation.
+
+    The cheap checks (format, spoofing, unknown ECU) are performed first, and
+    then the signatures on all remaining ECU Manifests are checked in a single
+    batch, spread across the worker processes of the verification pool if
+    verification_workers is greater than 1. ECU Manifests are then stored or
+    discarded in the order in which they appear in the Vehicle Manifest.
+    """
+    # List of (ecu_serial, manifest, exception or None) tuples, in order.
+    checked = []
+    verification_requests = []
+
     for ecu_serial in all_ecu_manifests:
-      ecu_manifests = all_ecu_manifests[ecu_serial]
-      for manifest in ecu_manifests:
+      for manifest in all_ecu_manifests[ecu_serial]:
         try:
-          # This calls validate_ecu_manifest, which can raise the errors
-          # caught below.
-          self.register_ecu_manifest(vin, ecu_serial, manifest)
-        except uptane.Spoofing as e:
-          log.warning(
-              RED + 'Discarding a spoofed or malformed ECU Manifest. Error '
-              ' from validating that ECU manifest follows:\n' + ENDCOLORS +
-              repr(e))
-        except uptane.UnknownECU as e:
-          log.warning(
-              RED + 'Discarding an ECU Manifest from unknown ECU. Error from '
-              'validation attempt follows:\n' + ENDCOLORS + repr(e))
-        except tuf.BadSignatureError as e:
-          log.warning(
-              RED + 'Rejecting an ECU Manifest whose signature is invalid, '
-              'from within an otherwise valid Vehicle Manifest. Error from '
-              'validation attempt follows:\n' + ENDCOLORS + repr(e))
+          ecu_public_key = self._check_ecu_manifest_origin(
+              ecu_serial, manifest)
+        except (uptane.Spoofing, uptane.UnknownECU) as e:
+          checked.append((ecu_serial, manifest, e))
+          continue
+
+        checked.append((ecu_serial, manifest, None))
+        verification_requests.append((
+            ecu_public_key,
+            manifest['signatures'][0], # TODO: Fix single-signature assumption
+            manifest['signed'],
+            DATATYPE_ECU_MANIFEST))
+
+    if self.verification_workers is None or self.verification_workers <= 1:
+      executor = None
+    else:
+      executor = self._get_verification_pool()
+
+    verified = iter(uptane.common.verify_signatures_over_metadata(
+        verification_requests, executor=executor))
+
+    valid_manifests = []
+
+    for ecu_serial, manifest, error in checked:
+      try:
+        if error is not None:
+          raise error
+        elif not next(verified):
+          self._raise_bad_ecu_manifest_signature()
+        valid_manifests.append((ecu_serial, manifest))
+
+      except (uptane.Spoofing, uptane.UnknownECU, tuf.BadSignatureError) as e:
+        self._log_discarded_ecu_manifest(e)
+
+    # Save all the valid ECU Manifests in one batch.
+    inventory.save_ecu_manifests(vin, valid_manifests)
+
+    for ecu_serial, manifest in valid_manifests:
+      self._report_stored_ecu_manifest(ecu_serial, manifest)
+
+
+
+
+
+  def _get_verification_pool(self):
+    """
+    Returns the pool of worker processes used to check ECU Manifest
+    signatures, creating it on first use.
+    """
+    with self._verification_pool_lock:
+      if self._verification_pool is None:
+        self._verification_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.verification_workers)
+    return self._verification_pool
+
+
+
+
+
+  def close(self):
+    """
+    Shuts down the pool of worker processes used to check ECU Manifest
+    signatures, if one was created, waiting for its workers to exit. The
+    Director remains usable; a new pool is created if one is needed again.
+    """
+    with self._verification_pool_lock:
+      pool = self._verification_pool
+      self._verification_pool = None
+
+    if pool is not None:
+      pool.shutdown(wait=True)
+
+
+
+
+
+  def _log_discarded_ecu_manifest(self, e):
+    """
+    Warns that an individual ECU Manifest from within an otherwise valid
+    Vehicle Manifest was discarded, given the exception raised while
+    validating it.
+    """
+    if isinstance(e, uptane.Spoofing):
+      log.warning(
+          RED + 'Discarding a spoofed or malformed ECU Manifest. Error '
+          ' from validating that ECU manifest follows:\n' + ENDCOLORS +
+          repr(e))
+    elif isinstance(e, uptane.UnknownECU):
+      log.warning(
+          RED + 'Discarding an ECU Manifest from unknown ECU. Error from '
+          'validation attempt follows:\n' + ENDCOLORS + repr(e))
+    else:
+      log.warning(
+          RED + 'Rejecting an ECU Manifest whose signature is invalid, '
+          'from within an otherwise valid Vehicle Manifest. Error from '
+          'validation attempt follows:\n' + ENDCOLORS + repr(e))
 
 
 
 
 
   def validate_primary_certification_in_vehicle_manifest(
-      self, vin, primary_ecu_serial, vehicle_manifest):
+      self, vin, primary_ecu_serial, vehicle_manifest, der_signed_digest=None):
     """
     Check the Primary's signature on the Vehicle Manifest and any other data
     the Primary is certifying, without diving into the individual ECU Manifests
     in the Vehicle Manifest.
 
+    If the metadata format is ASN.1/DER and der_signed_digest is provided, it
+    must be the SHA-256 digest of the 'signed' portion of the Vehicle Manifest
+    as received in DER (see
+    asn1_codec.convert_signed_der_to_dersigned_json_keeping_signed_der), and
+    the signature is checked over that digest rather than over a fresh DER
+    encoding of vehicle_manifest['signed'].
+
     Raises an exception if there is an issue with the Primary's signature.
     No return value.
     """
@@ -351,7 +545,10 @@ class Director:
 
     # TODO: Consider mechanism for fetching keys from inventorydb itself,
     # rather than always registering them after Director svc starts up.
-    if primary_ecu_serial not in inventory.ecu_public_keys:
+    try:
+      ecu_public_key = inventory.get_ecu_public_key(primary_ecu_serial)
+
+    except uptane.UnknownECU:
       log.debug(
           'Rejecting a vehicle manifest from a Primary ECU whose '
           'key is not registered.')
@@ -360,8 +557,6 @@ class Director:
           'the ECU is new, Register the new ECU with its key in order to be '
           'able to submit its manifests.')
 
-    ecu_public_key = inventory.ecu_public_keys[primary_ecu_serial]
-
     # Here, we check to see if the key that signed the Vehicle Manifest is the
     # same key as ecu_public_key (the one the director expects), so that we can
     # generate a more informative error, allowing user/debugger to distinguish
@@ -384,27 +579,21 @@ class Director:
           'in signature: ' + repr(keyid_used_in_signature))
 
 
-    if tuf.conf.METADATA_FORMAT == 'der':
-      # To check the signature, we have to make sure to encode the data as it
-      # was when the signature was made. If we're using ASN.1/DER as the
-      # data format/encoding, then we convert the 'signed' portion of the data
-      # back to ASN.1/DER to check it.
-      # Further, since for ASN.1/DER, a SHA256 hash is taken of the data and
-      # *that* is what is signed, we perform that hashing as well and retrieve
-      # the raw binary digest.
-      data_to_check = asn1_codec.convert_signed_metadata_to_der(
-          vehicle_manifest, DATATYPE_VEHICLE_MANIFEST, only_signed=True)
-      data_to_check = hashlib.sha256(data_to_check).digest()
-
-    else:
-      data_to_check = vehicle_manifest['signed']
-
+    # To check the signature, the data must be encoded as it was when the
+    # signature was made. For ASN.1/DER, that is the SHA256 digest of the DER
+    # encoding of the 'signed' portion: if we still have the digest of the
+    # signed DER as received, we check the signature over that; otherwise,
+    # verify_signature_over_metadata converts the 'signed' portion back to DER
+    # and hashes it.
+    if tuf.conf.METADATA_FORMAT != 'der':
+      der_signed_digest = None
 
     valid = uptane.common.verify_signature_over_metadata(
         ecu_public_key,
         vehicle_manifest['signatures'][0], # TODO: Fix assumptions.
         vehicle_manifest['signed'],
-        DATATYPE_VEHICLE_MANIFEST)
+        DATATYPE_VEHICLE_MANIFEST,
+        encoded_data=der_signed_digest)
 
     if not valid:
       log.debug(
@@ -427,9 +616,30 @@ class Director:
     # Also checks argument format.
     self.validate_ecu_manifest(ecu_serial, signed_ecu_manifest)
 
-    # Otherwise, we save it:
+    self._store_ecu_manifest(vin, ecu_serial, signed_ecu_manifest)
+
+
+
+
+
+  def _store_ecu_manifest(self, vin, ecu_serial, signed_ecu_manifest):
+    """
+    Saves an already-validated ECU Manifest in the inventory, warning if the
+    ECU reports any attacks.
+    """
     inventory.save_ecu_manifest(vin, ecu_serial, signed_ecu_manifest)
 
+    self._report_stored_ecu_manifest(ecu_serial, signed_ecu_manifest)
+
+
+
+
+
+  def _report_stored_ecu_manifest(self, ecu_serial, signed_ecu_manifest):
+    """
+    Logs the storage of a valid ECU Manifest, warning if the ECU reports any
+    attacks.
+    """
     log.debug('Stored a valid ECU manifest from ECU ' + repr(ecu_serial))
 
     # Alert if there's been a detected attack.
@@ -467,14 +677,14 @@ class Director:
   def create_director_repo_for_vehicle(self, vin):
     """
     Creates a separate repository object for a given vehicle identifier.
-    Each uses the same keys.
-    Ideally, each would use the same root.json file, but that will have to
-    wait until TUF Augmentation Proposal 5 (when the hash of root.json ceases
-    to be included in snapshot.json).
+    Each uses the same keys, and, once one of them has been written, they
+    share the same signed root metadata (see _get_shared_root()).
 
     The name of each repository is the VIN string.
 
-    If the repository already exists, it is overwritten.
+    The repository object is not actually created until it is first used (see
+    VehicleRepositories). If the repository already exists, it is
+    overwritten.
 
     Usage:
 
@@ -496,22 +706,30 @@ class Director:
 
     uptane.formats.VIN_SCHEMA.check_match(vin)
 
-    # Repository Tool expects to use the current directory.
-    # Figure out if this is impactful and needs to be changed.
-    os.chdir(self.director_repos_dir) # TODO: Is messing with cwd a bad idea?
-
     # Generates absolute path for a subdirectory with name equal to vin,
-    # in the current directory, making (relatively) sure that there isn't
-    # anything suspect like "../" in the VIN.
+    # in the Director's repositories directory, making (relatively) sure that
+    # there isn't anything suspect like "../" in the VIN.
     # Then I strip the common prefix back off the absolute path to get a
     # relative path and keep the guarantees.
     # TODO: Clumsy and hacky; fix.
     vin = uptane.common.scrub_filename(vin, self.director_repos_dir)
     vin = os.path.relpath(vin, self.director_repos_dir)
 
-    self.vehicle_repositories[vin] = this_repo = rt.create_new_repository(
-        vin, repository_name=vin)
+    self.vehicle_repositories.add_vehicle(vin, create_new=True)
+
+
+
+
 
+  def _create_vehicle_repository(self, vin):
+    """
+    Creates and returns a new repository object for the given (already
+    scrubbed) VIN, with the Director's keys, and with the shared signed root
+    metadata, if there is any yet.
+    Called by VehicleRepositories.
+    """
+    this_repo = rt.create_new_repository(
+        os.path.join(self.director_repos_dir, vin), repository_name=vin)
 
     this_repo.root.add_verification_key(self.key_dirroot_pub)
     this_repo.timestamp.add_verification_key(self.key_dirtime_pub)
@@ -522,6 +740,147 @@ class Director:
     this_repo.snapshot.load_signing_key(self.key_dirsnap_pri)
     this_repo.targets.load_signing_key(self.key_dirtarg_pri)
 
+    shared_root = self._get_shared_root()
+
+    if shared_root is not None:
+      # Use the root metadata already signed for the other vehicles instead of
+      # signing new root metadata for this one: put the file in place, and
+      # make TUF's record of the root role match it.
+      root_roleinfo, root_metadata = shared_root
+      staged_dir = os.path.join(this_repo._repository_directory,
+          'metadata.staged')
+      if not os.path.exists(staged_dir):
+        os.makedirs(staged_dir)
+      with open(os.path.join(staged_dir, 'root.' + tuf.conf.METADATA_FORMAT),
+          'wb') as fobj:
+        fobj.write(root_metadata)
+
+      tuf.roledb.update_roleinfo('root', copy.deepcopy(root_roleinfo),
+          mark_role_as_dirty=False, repository_name=vin)
+      tuf.roledb.unmark_dirty(['root'], vin)
+
+    return this_repo
+
+
+
+
+
+  def _load_vehicle_repository(self, vin):
+    """
+    Loads and returns the repository object for the given (already scrubbed)
+    VIN from the metadata previously written to disk, loading the Director's
+    signing keys for the roles that they are still trusted for.
+    Called by VehicleRepositories.
+    """
+    this_repo = rt.load_repository(
+        os.path.join(self.director_repos_dir, vin), repository_name=vin)
+
+    dirty_roles = set(tuf.roledb.get_dirty_roles(vin))
+
+    for role, key_pub, key_pri in [
+        (this_repo.root, self.key_dirroot_pub, self.key_dirroot_pri),
+        (this_repo.timestamp, self.key_dirtime_pub, self.key_dirtime_pri),
+        (this_repo.snapshot, self.key_dirsnap_pub, self.key_dirsnap_pri),
+        (this_repo.targets, self.key_dirtarg_pub, self.key_dirtarg_pri)]:
+      if key_pub['keyid'] in role.keys:
+        role.load_signing_key(key_pri)
+
+    # Loading signing keys does not change the metadata, so it should not
+    # cause the repository to be written again.
+    tuf.roledb.unmark_dirty(
+        [role for role in _TOP_LEVEL_ROLES if role not in dirty_roles], vin)
+
+    return this_repo
+
+
+
+
+
+  def _unload_vehicle_repository(self, vin, repo):
+    """
+    Discards TUF's in-memory records for the given repository object and
+    returns True, so that it can be reloaded from disk when next needed (see
+    _load_vehicle_repository). If it has unwritten changes, it is first
+    written to its metadata.staged directory, with its timestamp and snapshot
+    metadata re-signed, and its VIN is noted (see
+    VehicleRepositories.written_on_unload()). Returns False, leaving the
+    repository object in memory, if it was not created by this Director or
+    could not be written.
+    Called by VehicleRepositories, with its lock held.
+    """
+    # Repositories not created by this Director (e.g. loaded directly by the
+    # demo into the default TUF repository) are left alone.
+    if repo._repository_name != vin:
+      return False
+
+    if tuf.roledb.get_dirty_roles(vin) or \
+        not os.path.exists(os.path.join(repo._repository_directory,
+        'metadata.staged', 'root.' + tuf.conf.METADATA_FORMAT)):
+
+      # TUF computes the hashes of target files as it writes targets metadata.
+      uptane.common.use_repository_hash_algorithms()
+
+      repo.mark_dirty(['timestamp', 'snapshot'])
+
+      try:
+        repo.write()
+
+      except tuf.Error as e:
+        log.warning(RED + 'Unable to write the repository for VIN ' +
+            repr(vin) + ' in order to unload it; keeping it in memory. Error: '
+            + repr(e) + ENDCOLORS)
+        return False
+
+      self.vehicle_repositories._written_on_unload.add(vin)
+
+    tuf.roledb.remove_roledb(vin)
+    tuf.keydb.remove_keydb(vin)
+    return True
+
+
+
+
+
+  def _get_shared_root(self):
+    """
+    Returns the signed root metadata shared by the vehicle repositories, as
+    a tuple (TUF roleinfo for the root role, contents of the root metadata
+    file), or None if there is none yet.
+
+    The first time a vehicle repository with the Director's current keys has
+    been written, its root metadata is adopted as the shared root metadata,
+    and is used for each vehicle repository created afterwards, until the
+    Director's keys change.
+    """
+    current_keyids = tuple(key['keyid'] for key in [self.key_dirroot_pub,
+        self.key_dirtime_pub, self.key_dirsnap_pub, self.key_dirtarg_pub])
+
+    if self._shared_root is not None and \
+        self._shared_root[0] == current_keyids:
+      return self._shared_root[1:]
+
+    self._shared_root = None
+
+    for vin, repo in self.vehicle_repositories.resident_items():
+      root_filepath = os.path.join(repo._repository_directory,
+          'metadata.staged', 'root.' + tuf.conf.METADATA_FORMAT)
+
+      if repo._repository_name != vin or \
+          'root' in tuf.roledb.get_dirty_roles(vin) or \
+          not os.path.exists(root_filepath) or \
+          [repo.root.keys, repo.timestamp.keys, repo.snapshot.keys,
+          repo.targets.keys] != [[keyid] for keyid in current_keyids]:
+        continue
+
+      with open(root_filepath, 'rb') as fobj:
+        root_metadata = fobj.read()
+
+      self._shared_root = (current_keyids,
+          copy.deepcopy(tuf.roledb.get_roleinfo('root', vin)), root_metadata)
+      return self._shared_root[1:]
+
+    return None
+
 
 
 
@@ -535,6 +894,11 @@ class Director:
     and file length will be saved in target metadata in memory, which will then
     be signed with the appropriate Director keys and written to disk when the
     "write" method is called on the vehicle repository.
+
+    The hashes listed are those given by
+    uptane.common.get_repository_hash_algorithms() for the metadata format in
+    effect, which include SM3 with JSON metadata where supported. Secondaries
+    check all of them (see uptane.clients.secondary.Secondary.validate_image).
     """
     uptane.formats.VIN_SCHEMA.check_match(vin)
     uptane.formats.ECU_SERIAL_SCHEMA.check_match(ecu_serial)
@@ -550,5 +914,449 @@ class Director:
     #   raise uptane.UnknownECU('The ECU Serial provided, ' + repr(ecu_serial) +
     #       ' is not that of an ECU known to this Director.')
 
-    self.vehicle_repositories[vin].targets.add_target(
-        target_filepath, custom={'ecu_serial': ecu_serial})
+    uptane.common.use_repository_hash_algorithms()
+
+    with self.vehicle_repositories.pinned(vin) as repo:
+      repo.targets.add_target(
+          target_filepath, custom={'ecu_serial': ecu_serial})
+
+
+
+
+
+  def assign_image(self, image_filepath, filepath_in_repo, vins=None,
+      ecu_serials=None, progress_callback=None):
+    """
+    <Purpose>
+      Assigns one image to many vehicles at once (e.g. for an update
+      campaign), adding it as a target, for the selected ECU in each vehicle,
+      to all of the selected vehicles' repositories.
+
+      The image is added to target_store, where it is read and hashed once,
+      and is then linked into the targets directory of each vehicle repository
+      rather than copied. The repositories are not written: write them all
+      afterwards, in one pass, to publish the assignments (e.g. with
+      demo.demo_director.write_to_live()). Until they are written, changed
+      repositories are kept in memory (see VehicleRepositories).
+
+    <Arguments>
+      image_filepath
+        The path of the image file. It need not be in any repository.
+
+      filepath_in_repo
+        The path relative to the root of each repository's targets directory
+        at which the image will be kept and accessed by clients. (e.g.
+        'firmware.img' or 'brakes/firmware.tar.gz')
+
+      vins (optional)
+        A list of VINs. The image is assigned to the Primary ECU of each of
+        these vehicles, as registered in the inventory db.
+
+      ecu_serials (optional)
+        A list of ECU Serials. The image is assigned to each of these ECUs, in
+        the vehicle with which the inventory db associates it.
+
+      progress_callback (optional)
+        A function to call after each vehicle repository is updated, with the
+        number of repositories updated so far and the total number to update.
+
+      At least one of vins and ecu_serials must be given. Since a target in a
+      vehicle repository is assigned to a single ECU, only one ECU may be
+      selected in each vehicle.
+
+    <Exceptions>
+      uptane.Error
+        if no vehicles are selected, if more than one ECU is selected in a
+        vehicle, or if a selected vehicle has no registered Primary ECU
+
+      uptane.UnknownVehicle
+        if a selected vehicle is not known to the inventory db or has no
+        repository
+
+      uptane.UnknownECU
+        if a selected ECU is not known to be in any vehicle
+
+      All selections are checked before any repository is changed.
+
+    <Side Effects>
+      Adds the image to target_store, links it into the targets directories of
+      the selected vehicles' repositories, and adds it to their targets
+      metadata in memory. Repositories unloaded to stay within
+      MAX_RESIDENT_VEHICLE_REPOSITORIES are written to their metadata.staged
+      directories (see VehicleRepositories.written_on_unload()).
+
+    <Returns>
+      A dictionary summarizing the assignment:
+        'fileinfo': the length and hashes of the image, conforming to
+            tuf.formats.FILEINFO_SCHEMA
+        'assignments': a dictionary mapping the VIN of each vehicle to the
+            ECU Serial of the ECU in it to which the image was assigned
+        'hash_time': the time taken to store and hash the image, in seconds
+        'wall_time': the time the whole assignment took, in seconds
+        'vehicles_per_second': the number of vehicle repositories updated per
+            second
+    """
+    tuf.formats.PATH_SCHEMA.check_match(image_filepath)
+    tuf.formats.RELPATH_SCHEMA.check_match(filepath_in_repo)
+
+    if not vins and not ecu_serials:
+      raise uptane.Error('No vehicles were selected to assign the image to. '
+          'Provide a list of VINs, a list of ECU Serials, or both.')
+
+    start_time = time.time()
+
+    # Determine all of the assignments before changing any repository, so that
+    # an invalid selection leaves every repository as it was.
+    selections = []
+
+    for vin in vins or []:
+      ecu_serial = inventory.get_primary_ecu_serial(vin)
+      if ecu_serial is None:
+        raise uptane.Error('The vehicle with VIN ' + repr(vin) + ' has no '
+            'registered Primary ECU to assign the image to.')
+      selections.append((vin, ecu_serial))
+
+    if ecu_serials:
+      vins_by_ecu_serial = inventory.get_vins_for_ecus(ecu_serials)
+      selections.extend([(vins_by_ecu_serial[ecu_serial], ecu_serial)
+          for ecu_serial in ecu_serials])
+
+    assignments = collections.OrderedDict()
+
+    for vin, ecu_serial in selections:
+      if assignments.get(vin, ecu_serial) != ecu_serial:
+        raise uptane.Error('More than one ECU was selected in the vehicle '
+            'with VIN ' + repr(vin) + ': ' + repr(assignments[vin]) + ' and ' +
+            repr(ecu_serial) + '. An image can only be assigned to one ECU in '
+            'each vehicle at a time.')
+
+      if vin not in self.vehicle_repositories:
+        raise uptane.UnknownVehicle('The VIN provided, ' + repr(vin) + ' is '
+            'not that of a vehicle known to this Director.')
+
+      assignments[vin] = ecu_serial
+
+    store = self._get_target_store()
+
+    digest = store.add_file(image_filepath)
+    fileinfo = store.get_fileinfo(digest)
+    hash_time = time.time() - start_time
+
+    log.info('Assigning image ' + repr(filepath_in_repo) + ' (' +
+        str(fileinfo['length']) + ' bytes) to ' + str(len(assignments)) +
+        ' vehicles.')
+
+    uptane.common.use_repository_hash_algorithms()
+
+    for count, (vin, ecu_serial) in enumerate(assignments.items(), 1):
+      target_filepath = os.path.join(
+          self.director_repos_dir, vin, 'targets', filepath_in_repo)
+
+      store.link(digest, target_filepath)
+      with self.vehicle_repositories.pinned(vin) as repo:
+        repo.targets.add_target(
+            target_filepath, custom={'ecu_serial': ecu_serial})
+
+      if progress_callback is not None:
+        progress_callback(count, len(assignments))
+
+    wall_time = time.time() - start_time
+
+    report = {
+        'fileinfo': fileinfo,
+        'assignments': dict(assignments),
+        'hash_time': hash_time,
+        'wall_time': wall_time,
+        'vehicles_per_second': len(assignments) / max(wall_time, 1e-6)}
+
+    log.info(GREEN + 'Assigned image ' + repr(filepath_in_repo) + ' to ' +
+        str(len(assignments)) + ' vehicles in ' + '%.3f' % wall_time +
+        ' seconds.' + ENDCOLORS)
+
+    return report
+
+
+
+
+
+  def _get_target_store(self):
+    """
+    Returns target_store, first creating a target store in director_repos_dir
+    if none was given. (It is kept there so that the vehicle repositories'
+    targets directories, also in director_repos_dir, can hard link to it.)
+    """
+    if self.target_store is None:
+      self.target_store = uptane.services.target_store.TargetStore(
+          os.path.join(self.director_repos_dir, '.target_store'))
+
+    return self.target_store
+
+
+
+
+
+class VehicleRepositories(MutableMapping):
+  """
+  The vehicle repositories of a Director: a dictionary-like mapping from VIN
+  to tuf.repository_tool.Repository object.
+
+  Every VIN added is a key, but its repository object is only created (or, if
+  it was unloaded, reloaded from disk) when it is first looked up. After each
+  lookup, if more than MAX_RESIDENT_VEHICLE_REPOSITORIES repository objects
+  are in memory, the least recently used ones that are not pinned are
+  unloaded. Those with unwritten changes are first written to their
+  metadata.staged directories, and their VINs are listed by
+  written_on_unload() until forget_written_on_unload() is called for them
+  (e.g. once their metadata has been published). Note that iterating over
+  items() or values() looks up every repository.
+
+  A repository object that is looked up and then used over a period of time,
+  during which other threads may look up other repositories, should be pinned
+  for that time, so that it is not unloaded while in use, e.g.
+
+    with director.vehicle_repositories.pinned(vin) as repo:
+      ...
+
+  Repository objects may also be assigned directly, e.g. after reloading one
+  from a backup.
+  """
+
+  def __init__(self, director):
+
+    self._director = director
+
+    # Maps each VIN to True if its repository object is to be newly created
+    # when it is next looked up, and False if it is to be loaded from disk.
+    self._vins = {}
+
+    # Repository objects in memory, by VIN, from least to most recently used.
+    self._resident = collections.OrderedDict()
+
+    # The number of times each VIN's repository object is currently pinned
+    # (see pin()). Pinned repository objects are never unloaded.
+    self._pins = collections.defaultdict(int)
+
+    # VINs whose repositories were written when they were unloaded; see
+    # written_on_unload().
+    self._written_on_unload = set()
+
+    self._lock = threading.RLock()
+
+
+
+
+
+  def add_vehicle(self, vin, create_new=True):
+    """
+    Adds the given VIN, discarding any repository object already in memory
+    for it. If create_new is True, a new repository will be created for it
+    when it is first looked up; otherwise, its repository will be loaded from
+    the metadata previously written to disk.
+    """
+    with self._lock:
+      self._discard(vin)
+      self._written_on_unload.discard(vin)
+      self._vins[vin] = create_new
+
+
+
+
+
+  def _discard(self, vin):
+    """
+    Discards the repository object in memory for the given VIN, if any, along
+    with TUF's in-memory records for it, whether or not it has unwritten
+    changes.
+    """
+    repo = self._resident.pop(vin, None)
+    if repo is not None and repo._repository_name == vin:
+      tuf.roledb.remove_roledb(vin)
+      tuf.keydb.remove_keydb(vin)
+
+
+
+
+
+  def is_resident(self, vin):
+    """
+    Returns True if the repository object for the given VIN is in memory.
+    """
+    with self._lock:
+      return vin in self._resident
+
+
+
+
+
+  def written_on_unload(self):
+    """
+    Returns a list of the VINs whose repositories were written to their
+    metadata.staged directories when they were unloaded, because they had
+    unwritten changes, and which have not since been passed to
+    forget_written_on_unload().
+    """
+    with self._lock:
+      return sorted(self._written_on_unload)
+
+
+
+
+
+  def forget_written_on_unload(self, vins):
+    """
+    Removes the given VINs from those listed by written_on_unload(), e.g.
+    once the metadata written for them has been published.
+    """
+    with self._lock:
+      self._written_on_unload.difference_update(vins)
+
+
+
+
+
+  def resident_items(self):
+    """
+    Returns a list of (VIN, repository object) tuples for the repository
+    objects currently in memory, without loading any others.
+    """
+    with self._lock:
+      return list(self._resident.items())
+
+
+
+
+
+  def __getitem__(self, vin):
+
+    with self._lock:
+      if vin in self._resident:
+        repo = self._resident.pop(vin)
+
+      elif vin not in self._vins:
+        raise KeyError(vin)
+
+      elif self._vins[vin]:
+        repo = self._director._create_vehicle_repository(vin)
+        self._vins[vin] = False
+
+      else:
+        repo = self._director._load_vehicle_repository(vin)
+
+      self._resident[vin] = repo
+      self._evict()
+      return repo
+
+
+
+
+
+  def pin(self, vin):
+    """
+    Looks up the repository object for the given VIN, as for
+    vehicle_repositories[vin], and pins it so that it is not unloaded until
+    unpin(vin) is called as many times as pin(vin) has been. Returns the
+    repository object.
+    """
+    with self._lock:
+      repo = self[vin]
+      self._pins[vin] += 1
+      return repo
+
+
+
+
+
+  def unpin(self, vin):
+    """
+    Releases one pin on the repository object for the given VIN (see pin()).
+    """
+    with self._lock:
+      self._pins[vin] -= 1
+      if self._pins[vin] <= 0:
+        del self._pins[vin]
+
+
+
+
+
+  @contextlib.contextmanager
+  def pinned(self, vin):
+    """
+    Context manager that pins the repository object for the given VIN (see
+    pin()) and provides it for the duration of the with block.
+    """
+    repo = self.pin(vin)
+    try:
+      yield repo
+    finally:
+      self.unpin(vin)
+
+
+
+
+
+  def _evict(self):
+    """
+    Unloads least recently used repository objects until no more than
+    MAX_RESIDENT_VEHICLE_REPOSITORIES remain, or no more can be unloaded.
+    The most recently used repository object and pinned repository objects
+    are never unloaded.
+    """
+    if MAX_RESIDENT_VEHICLE_REPOSITORIES is None:
+      return
+
+    excess = len(self._resident) - MAX_RESIDENT_VEHICLE_REPOSITORIES
+
+    if excess <= 0:
+      return
+
+    for vin, repo in list(self._resident.items())[:-1]:
+      if excess <= 0:
+        break
+      if vin in self._pins:
+        continue
+      if self._director._unload_vehicle_repository(vin, repo):
+        del self._resident[vin]
+        excess -= 1
+
+
+
+
+
+  def __setitem__(self, vin, repo):
+    with self._lock:
+      self._resident.pop(vin, None)
+      self._resident[vin] = repo
+      self._vins[vin] = False
+
+
+
+
+
+  def __delitem__(self, vin):
+    with self._lock:
+      del self._vins[vin]
+      self._discard(vin)
+      self._written_on_unload.discard(vin)
+
+
+
+
+
+  def __contains__(self, vin):
+    return vin in self._vins
+
+
+
+
+
+  def __iter__(self):
+    with self._lock:
+      return iter(list(self._vins))
+
+
+
+
+
+  def __len__(self):
+    return len(self._vins)
@@ -7,12 +7,18 @@
   by the Director.
 
 
-  # TODO: <~> This is not properly thread-safe: there may be race conditions if
-  Primaries are being switched frequently. The windows are extremely small, but
-  assertions related to VIN registration in _check_registration_is_sane() are
-  likely to fail if such a race   condition is encountered. Similar race
-  conditions may exist. Cautious use of mutexes or a queue is probably
-  necessary.
+<Concurrency>
+  The public functions in this module may be called from many threads at
+  once (e.g. from a multithreaded Director service handling many vehicles).
+
+  Registration (register_vehicle, register_ecu) is rare, and is serialized
+  by a single lock, so that checks against existing registrations and the
+  registration itself are atomic. Registering a vehicle or its ECUs, saving
+  its manifests, and checking its registration also take a lock for that VIN,
+  so manifests for different vehicles are saved in parallel. (VINs share a
+  fixed number of locks, so the number of locks does not grow with the
+  fleet.) Other reads take no locks. With the in-memory backend, the manifest
+  lists returned are copies, which later saves do not modify.
 
 
 
@@ -41,8 +47,9 @@
       manifests from that ECU. Individual list elements comply with
       uptane.formats.SIGNABLE_ECU_VERSION_MANIFEST_SCHEMA.
 
-      This is duplicated data, as all ECU Manifests were extracted from Vehicle
-      Manifests which are also saved in full in global vehicle_manifests.
+      ECU Manifests are not copied: each list element is the same object as
+      the corresponding ECU Manifest within a Vehicle Manifest saved in global
+      vehicle_manifests.
 
       All known ECU Serials should be in this dictionary.
 
@@ -89,8 +96,55 @@
       e.g. {'ecuserial1': <key>, 'ecuserial2': <key>, ...}
 
 
+    vehicle_manifest_sightings
+    ecu_manifest_sightings
+
+      Dictionaries indexed like vehicle_manifests and ecu_manifests, with
+      values each being a list parallel to the corresponding list of
+      manifests. Each element records how many consecutive times that manifest
+      was received and when it was first and last received (see
+      COLLAPSE_DUPLICATE_MANIFESTS), e.g.
+        {'count': 3, 'first_seen': '2017-05-18T16:37:46Z',
+         'last_seen': '2017-05-18T16:39:12Z'}
+
+
+<Manifest Retention>
+  MAX_MANIFESTS_KEPT
+    If not None, only this many of the most recent manifests are kept for each
+    vehicle and each ECU; older manifests are discarded as new ones are saved.
+
+  COLLAPSE_DUPLICATE_MANIFESTS
+    If True, a manifest identical to the last one saved for the same vehicle
+    or ECU is not saved again; instead, the count and last-seen time of the
+    last one are updated. (Primaries resend unchanged manifests every update
+    cycle.)
+
+  With both set, a long-running Director's memory (or disk) use stays flat,
+  and get_last_vehicle_manifest and get_last_ecu_manifest remain O(1). Both
+  are set by default; set MAX_MANIFESTS_KEPT to None and
+  COLLAPSE_DUPLICATE_MANIFESTS to False to keep every manifest, as in previous
+  versions.
+
+
+<Storage Backends>
+  By default, the data above is stored in memory, in the five global
+  dictionaries, which are lost when the process exits. Another storage backend
+  (e.g. uptane.services.inventorydb_sqlite.SQLiteBackend, which persists the
+  data to disk) can be selected by calling set_backend(). The public functions
+  below behave in the same way regardless of the backend in use; the global
+  dictionaries are only populated when the in-memory backend is in use.
+
+  A storage backend is an object providing the methods of MemoryBackend, below.
+  Arguments are checked by the public functions in this module before they are
+  passed to the backend.
+
+
 <Public Functions>
 
+  Storage:
+    set_backend(backend)
+    get_backend()
+
   Registration:
     register_ecu(is_primary, vin, ecu_serial, public_key, overwrite=True)
     check_ecu_registered(ecu_serial)
@@ -99,15 +153,22 @@
   Get Public Key:
     get_ecu_public_key(ecu_serial)
 
+  Look Up Vehicles and ECUs:
+    get_primary_ecu_serial(vin)
+    get_vins_for_ecus(ecu_serials)
+
   Save Manifests:
     save_vehicle_manifest(vin, signed_vehicle_manifest)
     save_ecu_manifest(vin, ecu_serial, signed_ecu_manifest)
+    save_ecu_manifests(vin, ecu_serials_and_manifests)
 
   Get Manifests:
     get_vehicle_manifests(vin)
     get_last_vehicle_manifest(vin)
+    get_vehicle_manifest_history(vin)
     get_ecu_manifests(ecu_serial)
     get_last_ecu_manifest(ecu_serial)
+    get_ecu_manifest_history(ecu_serial)
     get_all_ecu_manifests_from_vehicle(vin)
 
 """
@@ -118,6 +179,14 @@ from io import open
 import uptane # Import before TUF modules; may change tuf.conf values.
 import uptane.formats
 import tuf
+import tuf.formats
+
+import time
+import threading
+
+# Manifest retention policy. See module docstring.
+MAX_MANIFESTS_KEPT = 100
+COLLAPSE_DUPLICATE_MANIFESTS = True
 
 # Global dictionaries
 vehicle_manifests = {}
@@ -125,6 +194,254 @@ ecu_manifests = {}
 primary_ecus_by_vin = {}
 ecus_by_vin = {}
 ecu_public_keys = {}
+vehicle_manifest_sightings = {}
+ecu_manifest_sightings = {}
+
+# Index from ECU Serial to the VINs of the vehicles the ECU is associated with
+# (as in ecus_by_vin), in the order in which the associations were made.
+# Maintained by MemoryBackend.register_ecu and MemoryBackend.register_vehicle.
+_vins_by_ecu = {}
+
+
+
+
+
+class MemoryBackend(object):
+  """
+  The default storage backend, which keeps all data in the global dictionaries
+  of this module (see module docstring).
+
+  Other storage backends must provide the same methods. Methods return None
+  (or an empty list) rather than raising exceptions when data is not found;
+  errors are raised by the public functions in this module.
+
+  The methods that save manifests are also given the time the manifests were
+  received and the retention policy to apply (MAX_MANIFESTS_KEPT and
+  COLLAPSE_DUPLICATE_MANIFESTS).
+  """
+
+  def is_vin_registered(self, vin):
+    return vin in vehicle_manifests
+
+
+
+  def is_ecu_registered(self, ecu_serial):
+    return ecu_serial in ecu_public_keys
+
+
+
+  def get_ecu_public_key(self, ecu_serial):
+    return ecu_public_keys.get(ecu_serial)
+
+
+
+  def get_primary_ecu_serial(self, vin):
+    return primary_ecus_by_vin.get(vin)
+
+
+
+  def get_ecus_in_vehicle(self, vin):
+    return list(ecus_by_vin[vin])
+
+
+
+  def get_vins_for_ecus(self, ecu_serials):
+    # Each ECU is mapped to the vehicle it was most recently associated with.
+    vins = {}
+    for ecu_serial in ecu_serials:
+      associated_vins = _vins_by_ecu.get(ecu_serial)
+      if associated_vins:
+        vins[ecu_serial] = associated_vins[-1]
+    return vins
+
+
+
+  def get_vehicle_manifests(self, vin):
+    return list(vehicle_manifests[vin])
+
+
+
+  def get_vehicle_manifest_history(self, vin):
+    return _history(vehicle_manifests[vin], vehicle_manifest_sightings[vin])
+
+
+
+  def get_last_vehicle_manifest(self, vin):
+    manifests = vehicle_manifests[vin]
+    return manifests[-1] if manifests else None
+
+
+
+  def get_ecu_manifests(self, ecu_serial):
+    return list(ecu_manifests[ecu_serial])
+
+
+
+  def get_ecu_manifest_history(self, ecu_serial):
+    return _history(
+        ecu_manifests[ecu_serial], ecu_manifest_sightings[ecu_serial])
+
+
+
+  def get_last_ecu_manifest(self, ecu_serial):
+    manifests = ecu_manifests[ecu_serial]
+    return manifests[-1] if manifests else None
+
+
+
+  def save_vehicle_manifest(
+      self, vin, signed_vehicle_manifest, seen_time, max_kept, collapse):
+    _append_manifest(vehicle_manifests[vin], vehicle_manifest_sightings[vin],
+        signed_vehicle_manifest, seen_time, max_kept, collapse)
+
+
+
+  def save_ecu_manifests(
+      self, vin, ecu_serials_and_manifests, seen_time, max_kept, collapse):
+    for ecu_serial, signed_ecu_manifest in ecu_serials_and_manifests:
+      _append_manifest(ecu_manifests[ecu_serial],
+          ecu_manifest_sightings[ecu_serial], signed_ecu_manifest, seen_time,
+          max_kept, collapse)
+
+
+
+  def register_ecu(self, is_primary, vin, ecu_serial, public_key):
+
+    assert (ecu_serial in ecu_public_keys) == (ecu_serial in ecu_manifests), \
+        'Programming error: ECU registration is not consistent.'
+
+    # Associate the ECU with the vehicle.
+    if ecu_serial not in ecus_by_vin[vin]:
+      ecus_by_vin[vin].append(ecu_serial)
+      _vins_by_ecu.setdefault(ecu_serial, []).append(vin)
+
+    if is_primary:
+      # Set the ECU as the vehicle's Primary ECU.
+      primary_ecus_by_vin[vin] = ecu_serial
+
+    # Save the ECU's public key.
+    ecu_public_keys[ecu_serial] = public_key
+
+    # Create an entry in the ecu_manifests dictionary for future manifests from
+    # the ECU.
+    ecu_manifests[ecu_serial] = []
+    ecu_manifest_sightings[ecu_serial] = []
+
+
+
+  def register_vehicle(self, vin, primary_ecu_serial):
+    # Remove the vehicle's previous ECU associations from the index.
+    for ecu_serial in ecus_by_vin.get(vin, []):
+      _vins_by_ecu[ecu_serial].remove(vin)
+      if not _vins_by_ecu[ecu_serial]:
+        del _vins_by_ecu[ecu_serial]
+
+    ecus_by_vin[vin] = []
+    vehicle_manifests[vin] = []
+    vehicle_manifest_sightings[vin] = []
+    primary_ecus_by_vin[vin] = primary_ecu_serial
+
+
+
+  def check_registration_is_sane(self, vin):
+    # A VIN may be in either none or all three of these dictionaries, and
+    # nowhere in between, or there is a bug.
+    assert (vin in vehicle_manifests) == (vin in ecus_by_vin) == (
+        vin in primary_ecus_by_vin), 'Programming error.'
+
+
+
+
+
+def _append_manifest(
+    manifests, sightings, manifest, seen_time, max_kept, collapse):
+  """
+  Appends a manifest to a list of manifests, and a record of its sighting to
+  the parallel list of sightings, applying the retention policy.
+  """
+  if collapse and manifests and manifests[-1] == manifest:
+    sightings[-1]['count'] += 1
+    sightings[-1]['last_seen'] = seen_time
+
+  else:
+    manifests.append(manifest)
+    sightings.append(
+        {'count': 1, 'first_seen': seen_time, 'last_seen': seen_time})
+
+  if max_kept is not None and len(manifests) > max_kept:
+    del manifests[:len(manifests) - max_kept]
+    del sightings[:len(sightings) - max_kept]
+
+
+
+
+
+def _history(manifests, sightings):
+  """
+  Combines a list of manifests and the parallel list of sightings into the
+  list returned by get_vehicle_manifest_history and get_ecu_manifest_history.
+  """
+  history = []
+  for manifest, sighting in zip(manifests, sightings):
+    entry = dict(sighting)
+    entry['manifest'] = manifest
+    history.append(entry)
+  return history
+
+
+
+
+
+def _now():
+  """Returns the current time, e.g. '2017-05-18T16:37:46Z'."""
+  return tuf.formats.unix_timestamp_to_datetime(
+      int(time.time())).isoformat() + 'Z'
+
+
+
+
+
+# The storage backend in use. See set_backend().
+_backend = MemoryBackend()
+
+# Locks. See the Concurrency section of the module docstring.
+_registration_lock = threading.RLock()
+_VIN_LOCK_STRIPES = 64
+_vin_locks = [threading.RLock() for i in range(_VIN_LOCK_STRIPES)]
+
+
+
+
+
+def _lock_for_vin(vin):
+  """Returns the lock guarding changes to data for the given VIN."""
+  return _vin_locks[hash(vin) % _VIN_LOCK_STRIPES]
+
+
+
+
+
+def set_backend(backend):
+  """
+  Selects the storage backend used by the functions in this module, e.g. an
+  instance of uptane.services.inventorydb_sqlite.SQLiteBackend. Pass a
+  MemoryBackend instance to return to the default, in-memory storage.
+
+  Data already stored using the previous backend is not copied to the new one.
+  """
+  global _backend
+  _backend = backend
+
+
+
+
+
+def get_backend():
+  """Returns the storage backend in use. See set_backend()."""
+  return _backend
+
+
+
 
 
 def get_ecu_public_key(ecu_serial):
@@ -142,11 +459,63 @@ def get_ecu_public_key(ecu_serial):
 
   uptane.formats.ECU_SERIAL_SCHEMA.check_match(ecu_serial)
 
-  if ecu_serial not in ecu_public_keys:
+  public_key = _backend.get_ecu_public_key(ecu_serial)
+
+  if public_key is None:
     raise uptane.UnknownECU('The given ECU Serial, ' + repr(ecu_serial) +
         ' is not known. It must be registered.')
 
-  return ecu_public_keys[ecu_serial]
+  return public_key
+
+
+
+
+
+def get_primary_ecu_serial(vin):
+  """
+  Returns the ECU Serial of the given vehicle's Primary ECU, or None if no
+  Primary ECU has been registered for it.
+
+  <Exceptions>
+    uptane.UnknownVehicle
+      if the given VIN is not known
+  """
+  check_vin_registered(vin)
+  return _backend.get_primary_ecu_serial(vin)
+
+
+
+
+
+def get_vins_for_ecus(ecu_serials):
+  """
+  Returns a dictionary mapping each of the given ECU Serials to the VIN of the
+  vehicle that the ECU is associated with, e.g.
+    {'ecuserial1': 'vin1', 'ecuserial9': 'vin1', 'ecuserial2': 'vin2'}
+
+  The ECUs are looked up in one batch. If an ECU has been associated with more
+  than one vehicle (see register_ecu), it is mapped to only one of them: with
+  the SQLite backend, the one it was most recently associated with.
+
+  <Exceptions>
+    uptane.FormatError
+      if any of the ECU Serials is not valid per
+      uptane.formats.ECU_SERIAL_SCHEMA
+
+    uptane.UnknownECU
+      if any of the ECU Serials is not registered with a vehicle
+  """
+  for ecu_serial in ecu_serials:
+    uptane.formats.ECU_SERIAL_SCHEMA.check_match(ecu_serial)
+
+  vins = _backend.get_vins_for_ecus(ecu_serials)
+
+  for ecu_serial in ecu_serials:
+    if vins.get(ecu_serial) is None:
+      raise uptane.UnknownECU('The given ECU Serial, ' + repr(ecu_serial) +
+          ', is not known to be associated with any vehicle.')
+
+  return vins
 
 
 
@@ -154,7 +523,7 @@ def get_ecu_public_key(ecu_serial):
 
 def get_vehicle_manifests(vin):
   check_vin_registered(vin)
-  return vehicle_manifests[vin]
+  return _backend.get_vehicle_manifests(vin)
 
 
 
@@ -162,10 +531,24 @@ def get_vehicle_manifests(vin):
 
 def get_last_vehicle_manifest(vin):
   check_vin_registered(vin)
-  if not vehicle_manifests[vin]:
-    return None
-  else:
-    return vehicle_manifests[vin][-1]
+  return _backend.get_last_vehicle_manifest(vin)
+
+
+
+
+
+def get_vehicle_manifest_history(vin):
+  """
+  Returns the Vehicle Manifests kept for the given vehicle, oldest first, along
+  with how many consecutive times each was received and when it was first and
+  last received. e.g.
+    [{'manifest': <vehiclemanifest>, 'count': 1,
+      'first_seen': '2017-05-18T16:37:46Z',
+      'last_seen': '2017-05-18T16:37:46Z'}, ...]
+  """
+  with _lock_for_vin(vin):
+    check_vin_registered(vin)
+    return _backend.get_vehicle_manifest_history(vin)
 
 
 
@@ -173,7 +556,7 @@ def get_last_vehicle_manifest(vin):
 
 def get_ecu_manifests(ecu_serial):
   check_ecu_registered(ecu_serial)
-  return ecu_manifests[ecu_serial]
+  return _backend.get_ecu_manifests(ecu_serial)
 
 
 
@@ -181,10 +564,25 @@ def get_ecu_manifests(ecu_serial):
 
 def get_last_ecu_manifest(ecu_serial):
   check_ecu_registered(ecu_serial)
-  if not ecu_manifests[ecu_serial]:
-    return None
-  else:
-    return ecu_manifests[ecu_serial][-1]
+  return _backend.get_last_ecu_manifest(ecu_serial)
+
+
+
+
+
+def get_ecu_manifest_history(ecu_serial):
+  """
+  Returns the ECU Manifests kept for the given ECU, in the same form as
+  get_vehicle_manifest_history.
+  """
+  check_ecu_registered(ecu_serial)
+
+  # ECU Manifests are saved under the lock for the ECU's vehicle (see
+  # save_ecu_manifests); take it, so that a manifest is never read without its
+  # sighting.
+  vin = _backend.get_vins_for_ecus([ecu_serial]).get(ecu_serial)
+  with _lock_for_vin(vin):
+    return _backend.get_ecu_manifest_history(ecu_serial)
 
 
 
@@ -195,12 +593,14 @@ def save_vehicle_manifest(vin, signed_vehicle_manifest):
   uptane.formats.SIGNABLE_VEHICLE_VERSION_MANIFEST_SCHEMA, save it in an index
   by vin, and save the individual ecu attestations in an index by ecu serial.
   """
-  check_vin_registered(vin) # check arg format and registration
-
   uptane.formats.SIGNABLE_VEHICLE_VERSION_MANIFEST_SCHEMA.check_match(
        signed_vehicle_manifest)
 
-  vehicle_manifests[vin].append(signed_vehicle_manifest)
+  with _lock_for_vin(vin):
+    check_vin_registered(vin) # check arg format and registration
+
+    _backend.save_vehicle_manifest(vin, signed_vehicle_manifest, _now(),
+        MAX_MANIFESTS_KEPT, COLLAPSE_DUPLICATE_MANIFESTS)
 
 
   # Not doing it this way because the Director is going to pass through a
@@ -233,22 +633,59 @@ def get_all_ecu_manifests_from_vehicle(vin):
 
   check_vin_registered(vin) # check arg format and registration
 
-  ecus_in_vehicle = ecus_by_vin[vin]
+  ecus_in_vehicle = _backend.get_ecus_in_vehicle(vin)
 
-  return {serial: ecu_manifests[serial] for serial in ecus_in_vehicle}
+  return {serial: _backend.get_ecu_manifests(serial)
+      for serial in ecus_in_vehicle}
 
 
 
 
 
 def save_ecu_manifest(vin, ecu_serial, signed_ecu_manifest):
+  save_ecu_manifests(vin, [(ecu_serial, signed_ecu_manifest)])
+
+
+
+
+
+def save_ecu_manifests(vin, ecu_serials_and_manifests):
+  """
+  Saves several ECU Manifests at once, as save_ecu_manifest does for one.
+  ecu_serials_and_manifests is a list of (ecu_serial, signed_ecu_manifest)
+  tuples. Backends that support it write them all in one batch.
+
+  If any of the ECU Serials is unknown or any of the manifests is improperly
+  formatted, an exception is raised and none of the manifests are saved.
+  """
+  uptane.formats.VIN_SCHEMA.check_match(vin)
+
+  for ecu_serial, signed_ecu_manifest in ecu_serials_and_manifests:
+    uptane.formats.SIGNABLE_ECU_VERSION_MANIFEST_SCHEMA.check_match(
+        signed_ecu_manifest)
+
+  if not ecu_serials_and_manifests:
+    return
 
-  check_ecu_registered(ecu_serial) # check format and registration
+  for ecu_serial, signed_ecu_manifest in ecu_serials_and_manifests:
+    check_ecu_registered(ecu_serial) # check format and registration
 
-  uptane.formats.SIGNABLE_ECU_VERSION_MANIFEST_SCHEMA.check_match(
-       signed_ecu_manifest)
+  # Each ECU's manifests are saved under the lock for the vehicle that the ECU
+  # is associated with (normally vin), which get_ecu_manifest_history also
+  # takes, so the manifests are grouped by that vehicle.
+  vins_by_ecu = _backend.get_vins_for_ecus(
+      set(ecu_serial for ecu_serial, manifest in ecu_serials_and_manifests))
+  batches = {}
+  for ecu_serial, signed_ecu_manifest in ecu_serials_and_manifests:
+    batches.setdefault(vins_by_ecu.get(ecu_serial), []).append(
+        (ecu_serial, signed_ecu_manifest))
 
-  ecu_manifests[ecu_serial].append(signed_ecu_manifest)
+  seen_time = _now()
+
+  for ecu_vin, batch in batches.items():
+    with _lock_for_vin(ecu_vin):
+      _backend.save_ecu_manifests(vin, batch, seen_time,
+          MAX_MANIFESTS_KEPT, COLLAPSE_DUPLICATE_MANIFESTS)
 
 
 
@@ -289,44 +726,26 @@ def register_ecu(is_primary, vin, ecu_serial, public_key, overwrite=True):
   tuf.formats.ANYKEY_SCHEMA.check_match(public_key)
   tuf.formats.BOOLEAN_SCHEMA.check_match(overwrite)
 
-  assert (ecu_serial in ecu_public_keys) == (ecu_serial in ecu_manifests), \
-      'Programming error: ECU registration is not consistent.'
-
-  if not overwrite:
-
-    # If we aren't supposed to be overwriting public keys or Primary
-    # associations, make sure we don't.
-
-    if is_primary and vin in primary_ecus_by_vin and \
-        primary_ecus_by_vin[vin] is not None:
-      raise uptane.Spoofing('The given VIN, ' + repr(vin) + ', is already '
-          'associated with a Primary ECU.')
-
-    if ecu_serial in ecu_public_keys:
-      raise uptane.Spoofing('The given ECU Serial, ' + repr(ecu_serial) +
-          ', is already associated with a public key.')
+  with _registration_lock, _lock_for_vin(vin):
 
-  # It is expected that the vehicle to which this ECU belongs is already
-  # registered.
-  check_vin_registered(vin)
-
-
-  # Associate the ECU with the vehicle.
-  if ecu_serial not in ecus_by_vin[vin]:
-    ecus_by_vin[vin].append(ecu_serial)
+    if not overwrite:
 
-  if is_primary:
-    # Set the ECU as the vehicle's Primary ECU.
-    primary_ecus_by_vin[vin] = ecu_serial
+      # If we aren't supposed to be overwriting public keys or Primary
+      # associations, make sure we don't.
 
+      if is_primary and _backend.get_primary_ecu_serial(vin) is not None:
+        raise uptane.Spoofing('The given VIN, ' + repr(vin) + ', is already '
+            'associated with a Primary ECU.')
 
-  # Save the ECU's public key.
-  ecu_public_keys[ecu_serial] = public_key
+      if _backend.is_ecu_registered(ecu_serial):
+        raise uptane.Spoofing('The given ECU Serial, ' + repr(ecu_serial) +
+            ', is already associated with a public key.')
 
+    # It is expected that the vehicle to which this ECU belongs is already
+    # registered.
+    check_vin_registered(vin)
 
-  # Create an entry in the ecu_manifests dictionary for future manifests from
-  # the ECU.
-  ecu_manifests[ecu_serial] = []
+    _backend.register_ecu(is_primary, vin, ecu_serial, public_key)
 
 
 
@@ -341,13 +760,13 @@ def register_vehicle(vin, primary_ecu_serial=None, overwrite=True):
 
   tuf.formats.BOOLEAN_SCHEMA.check_match(overwrite)
 
-  if not overwrite and vin in ecus_by_vin:
-    raise uptane.Spoofing('The given VIN, ' + repr(vin) + ', is already '
-        'registered.')
+  with _registration_lock, _lock_for_vin(vin):
+
+    if not overwrite and _backend.is_vin_registered(vin):
+      raise uptane.Spoofing('The given VIN, ' + repr(vin) + ', is already '
+          'registered.')
 
-  ecus_by_vin[vin] = []
-  vehicle_manifests[vin] = []
-  primary_ecus_by_vin[vin] = primary_ecu_serial
+    _backend.register_vehicle(vin, primary_ecu_serial)
 
 
 
@@ -358,7 +777,7 @@ def check_vin_registered(vin):
 
   _check_registration_is_sane(vin)
 
-  if vin not in vehicle_manifests:
+  if not _backend.is_vin_registered(vin):
     # TODO: Should we also log here? Review logging before exceptions
     # throughout the reference implementation.
     raise uptane.UnknownVehicle('The given VIN, ' + repr(vin) + ', is not '
@@ -372,15 +791,16 @@ def _check_registration_is_sane(vin):
   """
   Asserts that a data structure invariant remains correct. A vehicle must be
   in all three of the relevant global dictionaries if it is registered, and in
-  none of them if it is not.
+  none of them if it is not. (Only applicable to the in-memory backend; other
+  backends may enforce such invariants in their own storage.)
   """
 
   uptane.formats.VIN_SCHEMA.check_match(vin)
 
-  # A VIN may be in either none or all three of these dictionaries, and nowhere
-  # in between, or there is a bug.
-  assert (vin in vehicle_manifests) == (vin in ecus_by_vin) == (
-      vin in primary_ecus_by_vin), 'Programming error.'
+  if isinstance(_backend, MemoryBackend):
+    # The lock ensures that we do not observe a registration in progress.
+    with _lock_for_vin(vin):
+      _backend.check_registration_is_sane(vin)
 
 
 
@@ -390,6 +810,6 @@ def check_ecu_registered(ecu_serial):
 
   uptane.formats.ECU_SERIAL_SCHEMA.check_match(ecu_serial)
 
-  if ecu_serial not in ecu_public_keys:
+  if not _backend.is_ecu_registered(ecu_serial):
     raise uptane.UnknownECU('The given ECU serial, ' + repr(ecu_serial) +
         ', is not known.')
@@ -0,0 +1,507 @@
+"""
+<Program Name>
+  inventorydb_sqlite.py
+
+<Purpose>
+  A persistent storage backend for uptane.services.inventorydb, which stores
+  vehicle and ECU registrations and manifests in an SQLite database on disk,
+  in write-ahead-logging (WAL) mode.
+
+  Nothing is loaded into memory when the database is opened: every lookup is
+  an indexed query by VIN or ECU Serial, so the time it takes a Director to
+  restart does not depend on the size of the fleet it serves.
+
+  Manifests are stored as JSON text. (In ASN.1/DER mode, the Director has
+  already converted manifests into JSON-compatible dictionaries before they
+  reach the inventory db.) An ECU Manifest that was received within a Vehicle
+  Manifest is stored as a reference to its position in the stored Vehicle
+  Manifest rather than as a copy; if that Vehicle Manifest is later discarded
+  by the retention policy, the ECU Manifest is copied out of it first.
+
+  Use:
+    import uptane.services.inventorydb as inventory
+    import uptane.services.inventorydb_sqlite as inventorydb_sqlite
+
+    inventory.set_backend(inventorydb_sqlite.SQLiteBackend('inventory.db'))
+
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import uptane # Import before TUF modules; may change tuf.conf values.
+import tuf.formats
+
+import sqlite3
+import json
+import hashlib
+import threading
+import collections
+
+
+_SCHEMA = """
+  CREATE TABLE IF NOT EXISTS vehicles (
+    vin TEXT PRIMARY KEY,
+    primary_ecu_serial TEXT);
+
+  CREATE TABLE IF NOT EXISTS ecus (
+    ecu_serial TEXT PRIMARY KEY,
+    public_key TEXT NOT NULL);
+
+  CREATE TABLE IF NOT EXISTS vehicle_ecus (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    vin TEXT NOT NULL,
+    ecu_serial TEXT NOT NULL,
+    UNIQUE (vin, ecu_serial));
+
+  CREATE INDEX IF NOT EXISTS vehicle_ecus_by_ecu_serial
+    ON vehicle_ecus (ecu_serial, id);
+
+  CREATE TABLE IF NOT EXISTS vehicle_manifests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    vin TEXT NOT NULL,
+    manifest TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL);
+
+  CREATE INDEX IF NOT EXISTS vehicle_manifests_by_vin
+    ON vehicle_manifests (vin, id);
+
+  CREATE TABLE IF NOT EXISTS ecu_manifests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ecu_serial TEXT NOT NULL,
+    -- Either manifest is set, or the ECU Manifest is the manifest_index-th
+    -- ECU Manifest from this ECU in vehicle manifest vehicle_manifest_id.
+    manifest TEXT,
+    vehicle_manifest_id INTEGER,
+    manifest_index INTEGER,
+    digest TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL);
+
+  CREATE INDEX IF NOT EXISTS ecu_manifests_by_ecu_serial
+    ON ecu_manifests (ecu_serial, id);
+
+  CREATE INDEX IF NOT EXISTS ecu_manifests_by_vehicle_manifest
+    ON ecu_manifests (vehicle_manifest_id);
+"""
+
+_SELECT_ECU_MANIFESTS = """
+  SELECT em.ecu_serial, em.manifest, em.vehicle_manifest_id, em.manifest_index,
+    vm.manifest, em.count, em.first_seen, em.last_seen
+  FROM ecu_manifests em
+  LEFT JOIN vehicle_manifests vm ON em.vehicle_manifest_id = vm.id
+  WHERE em.ecu_serial = ?
+"""
+
+# The number of recently saved Vehicle Manifests remembered (one per VIN), so
+# that the ECU Manifests saved after them can be stored as references.
+_RECENT_VEHICLE_MANIFESTS = 64
+
+
+
+
+
+class SQLiteBackend(object):
+  """
+  A storage backend for uptane.services.inventorydb, providing the same
+  methods as uptane.services.inventorydb.MemoryBackend, but storing all data
+  in an SQLite database.
+
+  Fields:
+
+    db_fname
+      The filename of the SQLite database. It is created if it does not
+      exist. If it does exist, data previously stored in it is used.
+      ':memory:' may be used for a non-persistent database (e.g. in testing).
+
+  Each thread reads through its own connection, so reads proceed concurrently
+  with each other and, in WAL mode, with writes. Writes go through a single
+  connection and are serialized. In WAL mode, writes are sequential appends to
+  the log, so individual writes are cheap; several ECU Manifests saved with
+  save_ecu_manifests are written in a single transaction. (With ':memory:',
+  there is only the one database connection, so reads are serialized with
+  writes.)
+  """
+
+  def __init__(self, db_fname):
+
+    tuf.formats.PATH_SCHEMA.check_match(db_fname)
+
+    self.db_fname = db_fname
+
+    # Serializes writes, which all go through self._connection.
+    self._lock = threading.Lock()
+    self._connection = sqlite3.connect(db_fname, check_same_thread=False)
+
+    # Each thread's connection for reads; see _read_connection(). All of them
+    # are also listed, so that close() can close them.
+    self._local = threading.local()
+    self._read_connections = []
+    self._read_connections_lock = threading.Lock()
+
+    # Maps VIN to (row id, manifest) for the last Vehicle Manifest saved for
+    # that vehicle. Bounded; see _RECENT_VEHICLE_MANIFESTS.
+    self._recent_vehicle_manifests = collections.OrderedDict()
+
+    with self._lock:
+      self._connection.execute('PRAGMA journal_mode=WAL')
+      # With WAL, NORMAL is safe from corruption; only the most recent
+      # transactions may be lost on power failure.
+      self._connection.execute('PRAGMA synchronous=NORMAL')
+      self._connection.executescript(_SCHEMA)
+      self._connection.commit()
+
+
+
+
+
+  def close(self):
+    with self._read_connections_lock:
+      for connection in self._read_connections:
+        connection.close()
+      self._read_connections = []
+
+    with self._lock:
+      self._connection.close()
+
+
+
+
+
+  def _read_connection(self):
+    """
+    Returns the calling thread's connection for reads, opening it if need be.
+    """
+    connection = getattr(self._local, 'connection', None)
+
+    if connection is None:
+      # The connection is only used by this thread, but may be closed by
+      # another (see close()).
+      connection = sqlite3.connect(self.db_fname, check_same_thread=False)
+      with self._read_connections_lock:
+        self._read_connections.append(connection)
+      self._local.connection = connection
+
+    return connection
+
+
+
+
+
+  def _query(self, sql, args=()):
+    if self.db_fname == ':memory:':
+      # Another connection would open a different, empty database.
+      with self._lock:
+        return self._connection.execute(sql, args).fetchall()
+
+    return self._read_connection().execute(sql, args).fetchall()
+
+
+
+
+
+  def is_vin_registered(self, vin):
+    return bool(self._query('SELECT 1 FROM vehicles WHERE vin = ?', (vin,)))
+
+
+
+  def is_ecu_registered(self, ecu_serial):
+    return bool(self._query(
+        'SELECT 1 FROM ecus WHERE ecu_serial = ?', (ecu_serial,)))
+
+
+
+  def get_ecu_public_key(self, ecu_serial):
+    rows = self._query(
+        'SELECT public_key FROM ecus WHERE ecu_serial = ?', (ecu_serial,))
+    return json.loads(rows[0][0]) if rows else None
+
+
+
+  def get_primary_ecu_serial(self, vin):
+    rows = self._query(
+        'SELECT primary_ecu_serial FROM vehicles WHERE vin = ?', (vin,))
+    return rows[0][0] if rows else None
+
+
+
+  def get_ecus_in_vehicle(self, vin):
+    return [row[0] for row in self._query(
+        'SELECT ecu_serial FROM vehicle_ecus WHERE vin = ? ORDER BY id',
+        (vin,))]
+
+
+
+  def get_vins_for_ecus(self, ecu_serials):
+    vins = {}
+    for ecu_serial in ecu_serials:
+      rows = self._query(
+          'SELECT vin FROM vehicle_ecus WHERE ecu_serial = ? '
+          'ORDER BY id DESC LIMIT 1', (ecu_serial,))
+      if rows:
+        vins[ecu_serial] = rows[0][0]
+    return vins
+
+
+
+  def get_vehicle_manifests(self, vin):
+    return [entry['manifest']
+        for entry in self.get_vehicle_manifest_history(vin)]
+
+
+
+  def get_vehicle_manifest_history(self, vin):
+    return [
+        {'manifest': json.loads(manifest), 'count': count,
+        'first_seen': first_seen, 'last_seen': last_seen}
+        for manifest, count, first_seen, last_seen in self._query(
+        'SELECT manifest, count, first_seen, last_seen FROM vehicle_manifests '
+        'WHERE vin = ? ORDER BY id', (vin,))]
+
+
+
+  def get_last_vehicle_manifest(self, vin):
+    rows = self._query(
+        'SELECT manifest FROM vehicle_manifests WHERE vin = ? '
+        'ORDER BY id DESC LIMIT 1', (vin,))
+    return json.loads(rows[0][0]) if rows else None
+
+
+
+  def get_ecu_manifests(self, ecu_serial):
+    return [entry['manifest']
+        for entry in self.get_ecu_manifest_history(ecu_serial)]
+
+
+
+  def get_ecu_manifest_history(self, ecu_serial):
+    rows = self._query(_SELECT_ECU_MANIFESTS + ' ORDER BY em.id', (ecu_serial,))
+    return _decode_ecu_manifest_rows(rows)
+
+
+
+  def get_last_ecu_manifest(self, ecu_serial):
+    rows = self._query(
+        _SELECT_ECU_MANIFESTS + ' ORDER BY em.id DESC LIMIT 1', (ecu_serial,))
+    return _decode_ecu_manifest_rows(rows)[0]['manifest'] if rows else None
+
+
+
+  def save_vehicle_manifest(
+      self, vin, signed_vehicle_manifest, seen_time, max_kept, collapse):
+
+    encoded = _encode(signed_vehicle_manifest)
+
+    with self._lock:
+      with self._connection: # Commits, or rolls back on error.
+        row_id = self._append(self._connection, 'vehicle_manifests', 'vin',
+            vin, {'manifest': encoded}, _digest(encoded), seen_time, collapse)
+
+        if max_kept is not None:
+          self._delete_vehicle_manifests(self._connection, [row[0] for row in
+              self._connection.execute(
+              'SELECT id FROM vehicle_manifests WHERE vin = ? '
+              'ORDER BY id DESC LIMIT -1 OFFSET ?', (vin, max_kept))])
+
+      self._recent_vehicle_manifests.pop(vin, None)
+      self._recent_vehicle_manifests[vin] = (row_id, signed_vehicle_manifest)
+      while len(self._recent_vehicle_manifests) > _RECENT_VEHICLE_MANIFESTS:
+        self._recent_vehicle_manifests.popitem(last=False)
+
+
+
+  def save_ecu_manifests(
+      self, vin, ecu_serials_and_manifests, seen_time, max_kept, collapse):
+
+    with self._lock:
+      recent = self._recent_vehicle_manifests.get(vin)
+
+      with self._connection: # Commits, or rolls back on error.
+        for ecu_serial, signed_ecu_manifest in ecu_serials_and_manifests:
+          encoded = _encode(signed_ecu_manifest)
+
+          reference = _find_in_vehicle_manifest(
+              recent, ecu_serial, signed_ecu_manifest)
+          if reference is None:
+            values = {'manifest': encoded}
+          else:
+            values = {'vehicle_manifest_id': reference[0],
+                'manifest_index': reference[1]}
+
+          self._append(self._connection, 'ecu_manifests', 'ecu_serial',
+              ecu_serial, values, _digest(encoded), seen_time, collapse)
+
+          if max_kept is not None:
+            self._connection.execute(
+                'DELETE FROM ecu_manifests WHERE id IN (SELECT id FROM '
+                'ecu_manifests WHERE ecu_serial = ? ORDER BY id DESC '
+                'LIMIT -1 OFFSET ?)', (ecu_serial, max_kept))
+
+
+
+  def register_ecu(self, is_primary, vin, ecu_serial, public_key):
+    with self._lock:
+      with self._connection: # Commits, or rolls back on error.
+        self._connection.execute(
+            'INSERT OR IGNORE INTO vehicle_ecus (vin, ecu_serial) '
+            'VALUES (?, ?)', (vin, ecu_serial))
+        self._connection.execute(
+            'INSERT OR REPLACE INTO ecus (ecu_serial, public_key) '
+            'VALUES (?, ?)', (ecu_serial, json.dumps(public_key)))
+        # (Re)registering an ECU discards its previous ECU Manifests.
+        self._connection.execute(
+            'DELETE FROM ecu_manifests WHERE ecu_serial = ?', (ecu_serial,))
+
+        if is_primary:
+          self._connection.execute(
+              'UPDATE vehicles SET primary_ecu_serial = ? WHERE vin = ?',
+              (ecu_serial, vin))
+
+
+
+  def register_vehicle(self, vin, primary_ecu_serial):
+    with self._lock:
+      with self._connection: # Commits, or rolls back on error.
+        self._connection.execute(
+            'INSERT OR REPLACE INTO vehicles (vin, primary_ecu_serial) '
+            'VALUES (?, ?)', (vin, primary_ecu_serial))
+        # (Re)registering a vehicle discards its previous ECU associations and
+        # Vehicle Manifests.
+        self._connection.execute(
+            'DELETE FROM vehicle_ecus WHERE vin = ?', (vin,))
+        self._delete_vehicle_manifests(self._connection, [row[0] for row in
+            self._connection.execute(
+            'SELECT id FROM vehicle_manifests WHERE vin = ?', (vin,))])
+
+      self._recent_vehicle_manifests.pop(vin, None)
+
+
+
+
+
+  def _append(self, connection, table, owner_column, owner, values, digest,
+      seen_time, collapse):
+    """
+    Adds a manifest row for the given owner (VIN or ECU Serial) to the given
+    table, or, if collapse is True and the owner's last manifest has the same
+    digest, counts another sighting of that one instead. Returns the row id.
+    """
+    if collapse:
+      last = connection.execute(
+          'SELECT id, digest FROM ' + table + ' WHERE ' + owner_column +
+          ' = ? ORDER BY id DESC LIMIT 1', (owner,)).fetchone()
+
+      if last is not None and last[1] == digest:
+        connection.execute('UPDATE ' + table + ' SET count = count + 1, '
+            'last_seen = ? WHERE id = ?', (seen_time, last[0]))
+        return last[0]
+
+    columns = [owner_column, 'digest', 'count', 'first_seen', 'last_seen']
+    args = [owner, digest, 1, seen_time, seen_time]
+    for column in sorted(values):
+      columns.append(column)
+      args.append(values[column])
+
+    return connection.execute('INSERT INTO ' + table + ' (' +
+        ', '.join(columns) + ') VALUES (' + ', '.join('?' * len(columns)) +
+        ')', args).lastrowid
+
+
+
+
+
+  def _delete_vehicle_manifests(self, connection, row_ids):
+    """
+    Deletes the given Vehicle Manifest rows, first copying any ECU Manifests
+    that are stored as references into them.
+    """
+    for row_id in row_ids:
+      vehicle_manifest = None
+
+      for em_id, ecu_serial, index in connection.execute(
+          'SELECT id, ecu_serial, manifest_index FROM ecu_manifests '
+          'WHERE vehicle_manifest_id = ?', (row_id,)).fetchall():
+
+        if vehicle_manifest is None:
+          vehicle_manifest = json.loads(connection.execute(
+              'SELECT manifest FROM vehicle_manifests WHERE id = ?',
+              (row_id,)).fetchone()[0])
+
+        connection.execute('UPDATE ecu_manifests SET manifest = ?, '
+            'vehicle_manifest_id = NULL, manifest_index = NULL WHERE id = ?',
+            (_encode(vehicle_manifest['signed']['ecu_version_manifests']
+            [ecu_serial][index]), em_id))
+
+      connection.execute(
+          'DELETE FROM vehicle_manifests WHERE id = ?', (row_id,))
+
+
+
+
+
+def _encode(manifest):
+  return json.dumps(manifest, sort_keys=True, separators=(',', ':'))
+
+
+
+
+
+def _digest(encoded_manifest):
+  return hashlib.sha256(encoded_manifest.encode('utf-8')).hexdigest()
+
+
+
+
+
+def _find_in_vehicle_manifest(recent, ecu_serial, signed_ecu_manifest):
+  """
+  Given (row id, Vehicle Manifest) for a recently saved Vehicle Manifest (or
+  None), returns (row id, index) locating signed_ecu_manifest among the ECU
+  Manifests from ecu_serial in that Vehicle Manifest, or None if it is not
+  there.
+  """
+  if recent is None:
+    return None
+
+  row_id, vehicle_manifest = recent
+
+  candidates = vehicle_manifest['signed']['ecu_version_manifests'].get(
+      ecu_serial, [])
+
+  for index, candidate in enumerate(candidates):
+    if candidate is signed_ecu_manifest or candidate == signed_ecu_manifest:
+      return row_id, index
+
+  return None
+
+
+
+
+
+def _decode_ecu_manifest_rows(rows):
+  """
+  Converts rows selected with _SELECT_ECU_MANIFESTS into the form returned by
+  get_ecu_manifest_history, resolving references into Vehicle Manifests.
+  """
+  vehicle_manifests = {} # Each referenced Vehicle Manifest is parsed once.
+  history = []
+
+  for (ecu_serial, manifest, vehicle_manifest_id, index, vehicle_manifest,
+      count, first_seen, last_seen) in rows:
+
+    if manifest is not None:
+      manifest = json.loads(manifest)
+
+    else:
+      if vehicle_manifest_id not in vehicle_manifests:
+        vehicle_manifests[vehicle_manifest_id] = json.loads(vehicle_manifest)
+      manifest = vehicle_manifests[vehicle_manifest_id][
+          'signed']['ecu_version_manifests'][ecu_serial][index]
+
+    history.append({'manifest': manifest, 'count': count,
+        'first_seen': first_seen, 'last_seen': last_seen})
+
+  return history
@@ -0,0 +1,333 @@
+"""
+<Program Name>
+  target_store.py
+
+<Purpose>
+  A content-addressed store for target files (e.g. firmware images), which can
+  be shared by the Image Repository and all of the Director's vehicle
+  repositories.
+
+  Each distinct file is stored once, named by its SHA-256 digest, and its
+  length and hashes are computed once, when it is first added. The targets
+  directories of the repositories then hold hard links to the stored file (or
+  copies, where hard links are not possible), so that an image assigned to
+  many vehicles takes up the space of a single file.
+
+  Stored files must never be modified in place, since every repository that
+  links to a file would see the change. To replace a target in a repository,
+  link a different stored file to its path (see TargetStore.link()), or remove
+  the target file before writing a new one.
+
+  Use:
+    import uptane.services.target_store as target_store
+
+    store = target_store.TargetStore('/path/to/store')
+    digest = store.add_file('firmware.img')
+    store.link(digest, os.path.join(repo_dir, 'targets', 'firmware.img'))
+    store.get_fileinfo(digest) # {'length': ..., 'hashes': {...}}
+
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import uptane # Import before TUF modules; may change tuf.conf values.
+import uptane.common
+import tuf
+import tuf.formats
+
+import os
+import copy
+import shutil
+import uuid
+import tempfile
+import threading
+
+
+
+# The hash algorithm by whose digest stored files are named.
+STORE_HASH_ALGORITHM = 'sha256'
+
+
+
+class TargetStore(object):
+  """
+  A content-addressed store of target files in a directory on disk.
+
+  Fields:
+
+    store_dir
+      The directory in which files are stored. Repositories' targets
+      directories should be on the same filesystem, so that they can hard
+      link to the stored files.
+
+    hash_algorithms
+      The hash algorithms computed for each stored file, always including
+      STORE_HASH_ALGORITHM. By default, those that repositories list for the
+      metadata format in effect when the store is created (see
+      uptane.common.get_repository_hash_algorithms()).
+
+  """
+
+  def __init__(self, store_dir, hash_algorithms=None):
+
+    tuf.formats.PATH_SCHEMA.check_match(store_dir)
+
+    if hash_algorithms is None:
+      hash_algorithms = uptane.common.get_repository_hash_algorithms()
+    tuf.formats.HASHALGORITHMS_SCHEMA.check_match(hash_algorithms)
+
+    self.store_dir = store_dir
+    self.hash_algorithms = list(hash_algorithms)
+    if STORE_HASH_ALGORITHM not in self.hash_algorithms:
+      self.hash_algorithms.append(STORE_HASH_ALGORITHM)
+
+    if not os.path.exists(store_dir):
+      os.makedirs(store_dir)
+
+    # Maps the digest of each stored file whose hashes have been computed by
+    # this object to its fileinfo: {'length': ..., 'hashes': {...}}.
+    self._fileinfo_by_digest = {}
+
+    # Maps (absolute path, length, modification time) of each file added to
+    # the digest of its contents, so that adding the same unchanged file again
+    # does not read it again.
+    self._digest_by_source = {}
+
+    self._lock = threading.Lock()
+
+
+
+
+
+  def add_file(self, filepath):
+    """
+    <Purpose>
+      Adds the given file to the store, if a file with the same contents is
+      not already stored, and returns the digest that identifies it.
+
+    <Arguments>
+      filepath
+        The path of the file to add. It is copied into the store, and is not
+        itself modified.
+
+    <Exceptions>
+      IOError or OSError if the file cannot be read or stored.
+
+    <Side Effects>
+      The file is read, unless it was already added and has not changed since.
+
+    <Returns>
+      The hex digest of the file's contents using STORE_HASH_ALGORITHM.
+    """
+    tuf.formats.PATH_SCHEMA.check_match(filepath)
+
+    stat = os.stat(filepath)
+    source_key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime)
+
+    with self._lock:
+      digest = self._digest_by_source.get(source_key)
+
+    if digest is not None and os.path.exists(self._get_blob_filepath(digest)):
+      return digest
+
+    # Copy the file into a temporary file in the store while hashing it, so
+    # that it is read only once. The copy is then renamed into place, so that
+    # a stored file is always complete.
+    temp_fd, temp_filepath = tempfile.mkstemp(
+        prefix='.incoming.', dir=self.store_dir)
+
+    try:
+      with open(filepath, 'rb') as source, os.fdopen(temp_fd, 'wb') as temp:
+        length, hashes = uptane.common.compute_file_hashes(
+            _CopyingReader(source, temp), self.hash_algorithms)
+
+      digest = hashes[STORE_HASH_ALGORITHM]
+      blob_filepath = self._get_blob_filepath(digest)
+
+      if os.path.exists(blob_filepath):
+        os.remove(temp_filepath)
+      else:
+        # Stored files are read-only, as a reminder that they must never be
+        # modified in place.
+        os.chmod(temp_filepath, 0o444)
+        os.rename(temp_filepath, blob_filepath)
+
+    except:
+      if os.path.exists(temp_filepath):
+        os.remove(temp_filepath)
+      raise
+
+    with self._lock:
+      self._fileinfo_by_digest[digest] = {'length': length, 'hashes': hashes}
+      self._digest_by_source[source_key] = digest
+
+    return digest
+
+
+
+
+
+  def get_fileinfo(self, digest):
+    """
+    <Purpose>
+      Returns the length and hashes of the stored file with the given digest,
+      computing them only if this object has not already done so (e.g. if the
+      file was added by another process sharing the store directory).
+
+    <Exceptions>
+      uptane.Error if no file with the given digest is stored.
+
+    <Returns>
+      A dictionary conforming to tuf.formats.FILEINFO_SCHEMA:
+      {'length': ..., 'hashes': {algorithm: hex digest, ...}}, with the hashes
+      in hash_algorithms.
+    """
+    tuf.formats.HEX_SCHEMA.check_match(digest)
+
+    with self._lock:
+      fileinfo = self._fileinfo_by_digest.get(digest)
+
+    if fileinfo is None:
+      blob_filepath = self._get_blob_filepath(digest)
+      if not os.path.exists(blob_filepath):
+        raise uptane.Error('No file with digest ' + repr(digest) + ' is in '
+            'the target store.')
+
+      with open(blob_filepath, 'rb') as fobj:
+        length, hashes = uptane.common.compute_file_hashes(
+            fobj, self.hash_algorithms)
+      fileinfo = {'length': length, 'hashes': hashes}
+
+      with self._lock:
+        self._fileinfo_by_digest[digest] = fileinfo
+
+    return copy.deepcopy(fileinfo)
+
+
+
+
+
+  def link(self, digest, destination_filepath):
+    """
+    <Purpose>
+      Makes destination_filepath (e.g. a path in a repository's targets
+      directory) a hard link to the stored file with the given digest, or a
+      copy of it if a hard link cannot be made (e.g. across filesystems).
+
+    <Arguments>
+      digest
+        The digest of a stored file, as returned by add_file().
+
+      destination_filepath
+        The path at which the file should appear. Missing directories are
+        created. Any existing file there is replaced (atomically), but not
+        modified.
+
+    <Exceptions>
+      uptane.Error if no file with the given digest is stored.
+
+    <Side Effects>
+      Creates or replaces the file at destination_filepath.
+
+    <Returns>
+      None.
+    """
+    tuf.formats.HEX_SCHEMA.check_match(digest)
+    tuf.formats.PATH_SCHEMA.check_match(destination_filepath)
+
+    blob_filepath = self._get_blob_filepath(digest)
+    if not os.path.exists(blob_filepath):
+      raise uptane.Error('No file with digest ' + repr(digest) + ' is in the '
+          'target store.')
+
+    destination_dir = os.path.dirname(os.path.abspath(destination_filepath))
+    if not os.path.exists(destination_dir):
+      os.makedirs(destination_dir)
+
+    # Link or copy to a temporary name, then rename over the destination, so
+    # that any file already there is replaced rather than written through
+    # (it may itself be a link to a different stored file).
+    temp_filepath = os.path.join(
+        destination_dir, '.incoming.' + uuid.uuid4().hex)
+
+    try:
+      os.link(blob_filepath, temp_filepath)
+    except OSError: # e.g. if the destination is on a different filesystem
+      shutil.copyfile(blob_filepath, temp_filepath)
+
+    os.rename(temp_filepath, destination_filepath)
+
+
+
+
+
+  def add_and_link(self, filepath, destination_filepath):
+    """
+    Adds the given file to the store and links it to destination_filepath, as
+    add_file() and then link() would. Returns the file's digest.
+    """
+    digest = self.add_file(filepath)
+    self.link(digest, destination_filepath)
+    return digest
+
+
+
+
+
+  def remove_unreferenced(self):
+    """
+    <Purpose>
+      Removes the stored files that no repository links to any longer (those
+      whose only link is the one in the store). Copies made where links were
+      not possible are not tracked, so a file that was only ever copied out
+      is also removed.
+
+    <Side Effects>
+      Removes files from store_dir.
+
+    <Returns>
+      The number of files removed.
+    """
+    removed = 0
+
+    for filename in os.listdir(self.store_dir):
+      blob_filepath = os.path.join(self.store_dir, filename)
+
+      if filename.startswith('.') or os.stat(blob_filepath).st_nlink > 1:
+        continue
+
+      os.remove(blob_filepath)
+      removed += 1
+
+      with self._lock:
+        self._fileinfo_by_digest.pop(filename, None)
+        for source_key, digest in list(self._digest_by_source.items()):
+          if digest == filename:
+            del self._digest_by_source[source_key]
+
+    return removed
+
+
+
+
+
+  def _get_blob_filepath(self, digest):
+    return os.path.join(self.store_dir, digest)
+
+
+
+
+
+class _CopyingReader(object):
+  """
+  Wraps a file object open for reading, writing everything read from it to
+  another file object, so that a file can be hashed and copied in one pass.
+  """
+  def __init__(self, source, destination):
+    self._source = source
+    self._destination = destination
+
+  def read(self, size=-1):
+    data = self._source.read(size)
+    self._destination.write(data)
+    return data